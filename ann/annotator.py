@@ -3,25 +3,40 @@ import subprocess
 import uuid
 import os
 import json
+import time
 import boto3
 import shutil
+import signal
+import socket
+import hashlib
+import asyncio
+import threading
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
 from datetime import datetime
+from boto3.s3.transfer import TransferConfig
 from botocore.exceptions import NoCredentialsError, ClientError
 from decimal import Decimal
 from configparser import ConfigParser
 
+import run
+import shard
+import journal
+import metrics
+import distributed
+import result_cache
+
+# Shared AWS clients (util/aws_clients.py)
+import util_path
+import aws_clients
+
 # Reference: https://boto3.amazonaws.com/v1/documentation/api/latest/index.html
 
 # Get configuration
 config = ConfigParser()
 config.read('ann_config.ini')
 
-# AWS clients
-sqs = boto3.client('sqs')
-s3 = boto3.client('s3')
-sns = boto3.client('sns')
-dynamodb = boto3.resource('dynamodb')
-
 s3_results_bucket = config.get('aws', 's3_results_bucket')
 queue_url_requests = config.get('aws', 'queue_url_requests')
 queue_url_results = config.get('aws', 'queue_url_results')
@@ -33,95 +48,1693 @@ dynamodb_table_name = config.get('aws', 'dynamodb_table_name')
 input_file_path = config.get('paths', 'input_file_path')
 job_info_dir = config.get('paths', 'job_info_dir')
 
-table = dynamodb.Table(dynamodb_table_name)
+# Annotator tuning
+max_messages = config.getint('annotator', 'max_messages', fallback=10)
+wait_time_seconds = config.getint('annotator', 'wait_time_seconds', fallback=20)
+dispatch_workers = config.getint('annotator', 'dispatch_workers', fallback=10)
+stats_interval = config.getint('annotator', 'stats_interval', fallback=60)
+jobs_per_core = config.getfloat('annotator', 'jobs_per_core', fallback=1.0)
+reap_interval = config.getfloat('annotator', 'reap_interval', fallback=1.0)
+# 'subprocess' starts a fresh run.py per job; 'pool' runs jobs in warm,
+# long-lived worker processes that are recycled every jobs_per_worker jobs;
+# 'pipeline' also uses warm workers but only for AnnTools, with uploads
+# on their own threads so CPU and network work of different jobs overlap
+execution_mode = config.get('annotator', 'execution_mode', fallback='subprocess')
+jobs_per_worker = config.getint('annotator', 'jobs_per_worker', fallback=50)
+prefetch_jobs = config.getint('pipeline', 'prefetch_jobs', fallback=2)
+upload_workers = config.getint('pipeline', 'upload_workers', fallback=4)
+cache_evict_interval = config.getint('cache', 'evict_interval', fallback=3600)
+# 'threads' is the blocking poll loop below; 'asyncio' overlaps polling,
+# downloads, state transitions and reaping in one event loop
+engine = config.get('annotator', 'engine', fallback='threads')
+async_pollers = config.getint('annotator', 'async_pollers', fallback=2)
+# Request messages stay in flight until their job completes; the lease
+# is renewed to visibility_timeout every heartbeat_interval seconds
+visibility_timeout = config.getint('annotator', 'visibility_timeout', fallback=120)
+heartbeat_interval = config.getint('annotator', 'heartbeat_interval', fallback=30)
+# Owner of the jobs this annotator runs, recorded on their job items; it
+# survives a restart, so jobs resumed from the journal stay ours
+job_owner = f"{socket.gethostname()}:{os.path.realpath(job_info_dir)}"
 
-def download_file_from_s3(bucket_name, s3_key, local_file_path):
+# Local Prometheus-style /metrics endpoint
+metrics_enabled = config.getboolean('metrics', 'enabled', fallback=True)
+metrics_host = config.get('metrics', 'host', fallback='127.0.0.1')
+metrics_port = config.getint('metrics', 'port', fallback=9108)
+
+# Drain: on SIGTERM or once control_file exists the annotator stops
+# taking work, lets running jobs finish for up to deadline_seconds and exits
+drain_control_file = config.get('drain', 'control_file', fallback='./DRAIN')
+drain_deadline = config.getfloat('drain', 'deadline_seconds', fallback=80)
+
+# Admission: a job is only started once job_info_dir can hold its input
+# plus everything AnnTools writes next to it
+workspace_factor = config.getfloat('admission', 'workspace_factor', fallback=3.0)
+min_free_bytes = config.getint('admission', 'min_free_mb', fallback=1024) * 1024 * 1024
+max_input_bytes = config.getint('admission', 'max_input_mb', fallback=0) * 1024 * 1024
+defer_seconds = config.getint('admission', 'defer_seconds', fallback=60)
+# Expected uncompressed size of a .gz/.bgz input relative to its size in S3
+compressed_ratio = config.getfloat('input', 'compressed_ratio', fallback=4.0)
+
+# Scheduling: premium jobs may arrive on their own queue, otherwise a
+# job's tier comes from the priority the web app sets on it
+premium_queue_url = config.get('scheduler', 'premium_queue_url', fallback='')
+request_queues = [premium_queue_url, queue_url_requests] if premium_queue_url else [queue_url_requests]
+weights = {
+    'premium': config.getfloat('scheduler', 'premium_weight', fallback=4.0),
+    'free': config.getfloat('scheduler', 'free_weight', fallback=1.0)
+}
+# Concurrent jobs per user; 0 means no cap
+user_max_jobs = {
+    'premium': config.getint('scheduler', 'premium_user_max_jobs', fallback=0),
+    'free': config.getint('scheduler', 'free_user_max_jobs', fallback=2)
+}
+premium_reserved_slots = config.getint('scheduler', 'premium_reserved_slots', fallback=1)
+buffer_size = config.getint('scheduler', 'buffer_size', fallback=20)
+user_buffer_size = config.getint('scheduler', 'user_buffer_size', fallback=2)
+
+# Input downloads use parallel ranged GETs once a file is larger than
+# one part
+download_part_size = config.getint('transfer', 'download_part_size_mb', fallback=16) * 1024 * 1024
+download_concurrency = config.getint('transfer', 'download_concurrency', fallback=10)
+verify_checksum = config.getboolean('transfer', 'verify_checksum', fallback=True)
+download_config = TransferConfig(
+    multipart_threshold=download_part_size,
+    multipart_chunksize=download_part_size,
+    max_concurrency=download_concurrency,
+    use_threads=True
+)
+
+# AWS clients; endpoint URLs are only set to test against local stand-ins.
+# Every dispatch worker shares them, each downloading download_concurrency
+# parts at a time.
+pool_connections = dispatch_workers * download_concurrency
+sqs = aws_clients.client('sqs', config, max_pool_connections=pool_connections)
+s3 = aws_clients.client('s3', config, max_pool_connections=pool_connections)
+sns = aws_clients.client('sns', config, max_pool_connections=pool_connections)
+
+
+# DynamoDB resources aren't thread-safe, so each thread gets its own
+def jobs_table():
+    return aws_clients.resource('dynamodb', config).Table(dynamodb_table_name)
+
+
+class Stats(object):
+    """Thread-safe message rate and per-stage latency counters.
+    Printed and reset every stats_interval seconds so the numbers
+    describe the most recent window only.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.window_start = time.time()
+        self.messages = 0
+        self.stages = {}
+        self.counters = {}
+
+    def count_messages(self, count):
+        messages_received.inc(count)
+        with self.lock:
+            self.messages += count
+
+    def count(self, name, amount=1):
+        events.inc(amount, event=name)
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def record(self, stage, secs):
+        with self.lock:
+            self.stages.setdefault(stage, []).append(secs)
+
+    def timed(self, stage):
+        return StageTimer(self, stage)
+
+    def report(self):
+        with self.lock:
+            elapsed = time.time() - self.window_start
+            rate = self.messages / elapsed if elapsed > 0 else 0.0
+            print(f"[stats] {self.messages} messages in {elapsed:.1f}s ({rate:.2f} msg/s)")
+            for stage, samples in sorted(self.stages.items()):
+                samples.sort()
+                p95 = samples[min(len(samples) - 1, int(len(samples) * 0.95))]
+                print(f"[stats]   {stage}: n={len(samples)} avg={sum(samples) / len(samples):.3f}s "
+                      f"p95={p95:.3f}s max={samples[-1]:.3f}s")
+            if self.counters:
+                print('[stats]   ' + ' '.join(f"{name}={value}" for name, value
+                                              in sorted(self.counters.items())))
+            self.reset()
+
+
+class StageTimer(object):
+    def __init__(self, stats, stage):
+        self.stats = stats
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *args):
+        self.stats.record(self.stage, time.time() - self.start)
+
+
+class Leases(object):
+    """Request messages this annotator is still working on.
+    Their visibility is extended on every heartbeat, so a dead
+    annotator's jobs reappear on the queue within visibility_timeout.
+    The heartbeat also stamps heartbeat_at on the items of the jobs we
+    claimed; only a RUNNING job whose stamp is visibility_timeout old may
+    be taken over. SQS keeps a message in flight for 12 hours at most, so
+    a longer job's message reappears anyway; the annotator receiving it
+    finds a fresh stamp and hides the message again.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.handles = {}
+        self.jobs = {}
+
+    def hold(self, message, job_id=None):
+        with self.lock:
+            self.handles[message['MessageId']] = (message['QueueUrl'], message['ReceiptHandle'])
+            if job_id is not None:
+                self.jobs[message['MessageId']] = job_id
+
+    def release(self, message):
+        with self.lock:
+            self.handles.pop(message['MessageId'], None)
+            self.jobs.pop(message['MessageId'], None)
+
+    def heartbeat(self):
+        with self.lock:
+            held = list(self.handles.items())
+            jobs = list(self.jobs.items())
+        by_queue = {}
+        for message_id, (queue_url, receipt_handle) in held:
+            by_queue.setdefault(queue_url, []).append({
+                'Id': message_id,
+                'ReceiptHandle': receipt_handle,
+                'VisibilityTimeout': visibility_timeout
+            })
+        for queue_url, entries in by_queue.items():
+            # ChangeMessageVisibilityBatch takes at most 10 entries
+            for i in range(0, len(entries), 10):
+                try:
+                    with stats.timed('heartbeat'):
+                        response = sqs.change_message_visibility_batch(
+                            QueueUrl=queue_url,
+                            Entries=entries[i:i + 10]
+                        )
+                    for failure in response.get('Failed', []):
+                        print(f"Failed to extend lease on message {failure['Id']}: {failure.get('Code')}")
+                except Exception as e:
+                    print(f"Failed to extend message leases: {str(e)}")
+
+        now = int(time.time())
+        for message_id, job_id in jobs:
+            try:
+                jobs_table().update_item(
+                    Key={'job_id': job_id},
+                    UpdateExpression='SET heartbeat_at = :now',
+                    ConditionExpression='job_status = :running AND lease_owner = :owner',
+                    ExpressionAttributeValues={
+                        ':now': now,
+                        ':running': 'RUNNING',
+                        ':owner': job_owner
+                    }
+                )
+            except ClientError as e:
+                if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                    print(f"Failed to stamp heartbeat of job {job_id}: {str(e)}")
+                    continue
+                # Completed meanwhile, or taken over after we missed
+                # heartbeats for visibility_timeout
+                print(f"Job {job_id} is no longer leased to this annotator")
+                with self.lock:
+                    self.jobs.pop(message_id, None)
+            except Exception as e:
+                print(f"Failed to stamp heartbeat of job {job_id}: {str(e)}")
+
+    def run(self):
+        while True:
+            time.sleep(heartbeat_interval)
+            self.heartbeat()
+
+
+class WarmPool(object):
+    """Warm worker processes for run.py's jobs.
+    Workers are forked from a server process that has already imported
+    run.py, i.e. AnnTools, boto3, the parsed config and the AWS clients,
+    so a job starts without any of that cold start, and are replaced
+    every jobs_per_worker jobs. A worker that dies mid-job (OOM kill,
+    segfault) breaks the pool: the jobs running in it fail with
+    BrokenProcessPool, so their messages are retried rather than held
+    forever, and the next job starts a fresh pool.
+    """
+    def __init__(self, workers):
+        self.lock = threading.Lock()
+        self.workers = workers
+        self.executor = None
+
+    def start(self):
+        context = multiprocessing.get_context('forkserver')
+        context.set_forkserver_preload(['run'])
+        self.executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=context,
+                                            max_tasks_per_child=jobs_per_worker)
+
+    def submit(self, fn, *args):
+        with self.lock:
+            try:
+                return self.executor.submit(fn, *args)
+            except BrokenProcessPool:
+                print("A warm worker died; starting a new worker pool")
+                self.executor.shutdown(wait=False)
+                self.start()
+                return self.executor.submit(fn, *args)
+
+    def terminate(self):
+        # ProcessPoolExecutor can't kill its workers itself (before
+        # Python 3.14), and shutdown() waits for the jobs they run
+        with self.lock:
+            for process in list((self.executor._processes or {}).values()):
+                process.kill()
+            self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+class PoolJob(object):
+    """Popen-like handle for a job running in the warm worker pool"""
+    def __init__(self, future):
+        self.future = future
+        self.returncode = None
+
+    def poll(self):
+        if self.returncode is None and self.future.done():
+            try:
+                self.returncode = 0 if self.future.result() else 1
+            except Exception as e:
+                print(f"Worker pool job failed: {str(e) or type(e).__name__}")
+                self.returncode = 1
+        return self.returncode
+
+
+class PipelineJob(object):
+    """Popen-like handle for a job moving through the pipeline; its
+    returncode is set once the upload stage has finished with it"""
+    def __init__(self):
+        self.returncode = None
+
+    def poll(self):
+        return self.returncode
+
+
+# Kill a child's whole process group; a child started before children
+# had groups of their own (see ChildProcess) is killed alone
+def kill_group(pid):
     try:
-        s3.download_file(bucket_name, s3_key, local_file_path)
-        return True
+        os.killpg(pid, signal.SIGKILL)
+    except ProcessLookupError:
+        os.kill(pid, signal.SIGKILL)
+
+
+class ChildProcess(subprocess.Popen):
+    """A run.py or distributed.py child in a process group of its own,
+    so kill() also reaches the processes it started (e.g. the workers of
+    a sharded run) instead of leaving them orphaned"""
+    def __init__(self, command):
+        super().__init__(command, start_new_session=True)
+
+    def kill(self):
+        if self.poll() is None:
+            kill_group(self.pid)
+
+
+class AdoptedJob(object):
+    """Popen-like handle for a run.py child started by an earlier
+    annotator process; it is not our child, so it is watched through the
+    journal and /proc, and succeeded if it got its results uploaded"""
+    def __init__(self, entry):
+        self.entry = entry
+        self.pid = entry['pid']
+        self.returncode = None
+
+    def poll(self):
+        if self.returncode is None and not journal.child_alive(self.entry):
+            self.returncode = 0 if journal.reached(self.entry['job_id'], 'uploaded') else 1
+        return self.returncode
+
+    def kill(self):
+        if journal.child_alive(self.entry):
+            kill_group(self.pid)
+
+
+class Pipeline(object):
+    """Download, compute and upload stages connected by bounded queues.
+    Dispatch workers download (the supervisor admits compute workers +
+    prefetch_jobs + upload_workers jobs, which bounds what is waiting
+    between stages), warm worker processes only run AnnTools, and a
+    thread pool uploads results, so job N+1 downloads while job N is
+    annotated and job N-1's results upload.
+    """
+    def __init__(self, compute_workers):
+        self.lock = threading.Lock()
+        self.compute_workers = compute_workers
+        self.pool = None
+        self.uploads = ThreadPoolExecutor(max_workers=upload_workers)
+        self.queued = {'compute': 0, 'upload': 0}
+        self.reset()
+
+    def reset(self):
+        self.window_start = time.time()
+        self.busy = {'download': 0.0, 'compute': 0.0, 'upload': 0.0}
+
+    def start(self):
+        self.pool = WarmPool(self.compute_workers)
+        self.pool.start()
+
+    def record(self, stage, secs):
+        with self.lock:
+            self.busy[stage] += secs
+
+    def move(self, from_stage, to_stage):
+        with self.lock:
+            if from_stage:
+                self.queued[from_stage] -= 1
+            if to_stage:
+                self.queued[to_stage] += 1
+
+    def submit(self, local_file_path, user_id, digest, download_seconds=None):
+        job = PipelineJob()
+        self.move(None, 'compute')
+
+        def computed(profile_values):
+            self.record('compute', profile_values.get('annotate_seconds', 0.0))
+            self.move('compute', 'upload')
+            self.uploads.submit(self.upload, job, local_file_path, user_id, digest,
+                                profile_values)
+
+        def failed(e):
+            print(f"Pipeline compute failed for {local_file_path}: {str(e) or type(e).__name__}")
+            self.move('compute', None)
+            job.returncode = 1
+
+        # A compute worker that dies fails the job with BrokenProcessPool
+        def done(future):
+            try:
+                profile_values = future.result()
+            except Exception as e:
+                failed(e)
+                return
+            computed(profile_values)
+
+        self.pool.submit(run.annotate_job, local_file_path, download_seconds).add_done_callback(done)
+        return job
+
+    def upload(self, job, local_file_path, user_id, digest, profile_values):
+        start = time.time()
+        try:
+            published = run.publish_results(local_file_path, user_id, digest, profile_values)
+        except Exception as e:
+            print(f"Pipeline upload failed for {local_file_path}: {str(e)}")
+            published = False
+        self.record('upload', time.time() - start)
+        self.move('upload', None)
+        job.returncode = 0 if published else 1
+
+    def report(self):
+        # Utilization: busy seconds over the stage's capacity in the window
+        capacity = {'download': dispatch_workers, 'compute': self.compute_workers,
+                    'upload': upload_workers}
+        with self.lock:
+            elapsed = max(time.time() - self.window_start, 1e-6)
+            usage = ' '.join(f"{stage}={100.0 * self.busy[stage] / (capacity[stage] * elapsed):.0f}%"
+                             for stage in ('download', 'compute', 'upload'))
+            print(f"[stats] pipeline utilization {usage} "
+                  f"waiting compute={self.queued['compute']} upload={self.queued['upload']}")
+            self.reset()
+
+
+class Supervisor(object):
+    """Tracks every AnnTools child this annotator has started.
+    A slot is reserved before a message is dispatched and is held until
+    the child exits, so the box never admits more jobs than max_jobs.
+    """
+    def __init__(self, max_jobs):
+        self.lock = threading.Lock()
+        self.max_jobs = max_jobs
+        self.reserved = 0
+        self.children = {}
+        self.completed = 0
+        self.failed = 0
+        self.pool = None
+        self.pipeline = None
+
+    def start_pool(self):
+        self.pool = WarmPool(self.max_jobs)
+        self.pool.start()
+
+    def start_pipeline(self):
+        # max_jobs compute workers, plus room for downloads that are
+        # queued for them and for results still uploading
+        self.pipeline = Pipeline(self.max_jobs)
+        self.pipeline.start()
+        with self.lock:
+            self.max_jobs += prefetch_jobs + upload_workers
+
+    def free_slots(self):
+        with self.lock:
+            return self.max_jobs - self.reserved - len(self.children)
+
+    def reserve(self):
+        with self.lock:
+            if self.reserved + len(self.children) >= self.max_jobs:
+                return False
+            self.reserved += 1
+            return True
+
+    def release(self):
+        with self.lock:
+            self.reserved -= 1
+
+    def launch(self, job_id, message, local_file_path, user_id, digest='', download_seconds=None):
+        # Launch failures propagate to the caller, which releases the slot.
+        # Inputs big enough to shard always get a fresh run.py, as a warm
+        # worker that is killed would leave its shard workers running
+        sharded = may_shard(local_file_path)
+        if self.pipeline is not None and not sharded:
+            child = self.pipeline.submit(local_file_path, user_id, digest, download_seconds)
+        elif self.pool is not None and not sharded:
+            child = PoolJob(self.pool.submit(
+                run.run_job, local_file_path, user_id, digest, download_seconds))
+        else:
+            command = ['python', './run.py', local_file_path, user_id, digest,
+                       '' if download_seconds is None else f"{download_seconds:.3f}"]
+            child = ChildProcess(command)
+        with self.lock:
+            self.reserved -= 1
+            self.children[job_id] = (child, time.time(), message)
+        return child
+
+    def adopt(self, job_id, child, message):
+        with self.lock:
+            self.children[job_id] = (child, time.time(), message)
+
+    def running(self, job_id):
+        with self.lock:
+            return job_id in self.children
+
+    def launch_shard(self, job_id, shard_no, owner):
+        # Leased distributed shards always run as a fresh child; they
+        # settle their own lease, so there is no request message
+        command = ['python', './distributed.py', 'run', job_id, str(shard_no), owner]
+        child = ChildProcess(command)
+        with self.lock:
+            self.reserved -= 1
+            self.children[f"{job_id}:{shard_no}"] = (child, time.time(), None)
+        return child
+
+    def reap(self):
+        with self.lock:
+            finished = [(job_id, child, started, message)
+                        for job_id, (child, started, message) in self.children.items()
+                        if child.poll() is not None]
+            for job_id, child, started, message in finished:
+                del self.children[job_id]
+                if child.returncode == 0:
+                    self.completed += 1
+                else:
+                    self.failed += 1
+
+        for job_id, child, started, message in finished:
+            wall_time = time.time() - started
+            stats.record('annotate', wall_time)
+            job_seconds.observe(wall_time, outcome='completed' if child.returncode == 0 else 'failed')
+            print(f"Job {job_id} exited with status {child.returncode} after {wall_time:.1f}s")
+        return finished
+
+    def abandon(self):
+        """Kills every child still running, with everything it started,
+        and returns them; warm pools are terminated as a whole"""
+        with self.lock:
+            abandoned = [(job_id, child, started, message)
+                         for job_id, (child, started, message) in self.children.items()]
+            self.children = {}
+            self.failed += len(abandoned)
+        for job_id, child, started, message in abandoned:
+            if hasattr(child, 'kill'):
+                child.kill()
+        if self.pool is not None:
+            self.pool.terminate()
+        if self.pipeline is not None:
+            self.pipeline.pool.terminate()
+        return abandoned
+
+    def report(self):
+        with self.lock:
+            print(f"[stats] running={len(self.children)}/{self.max_jobs} "
+                  f"completed={self.completed} failed={self.failed}")
+        if self.pipeline is not None:
+            self.pipeline.report()
+
+
+class DiskBudget(object):
+    """Space in job_info_dir promised to admitted jobs.
+    Each request message, and each distributed shard or merge leased,
+    reserves workspace_factor times its input size until it is settled.
+    Bytes a job has already written count against its own reservation,
+    so free space is never double counted.
+    """
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.path = path
+        self.reservations = {}
+
+    def written(self, job_dir):
+        total = 0
+        for root, dirs, files in os.walk(job_dir):
+            for name in files:
+                try:
+                    total += os.path.getsize(os.path.join(root, name))
+                except OSError:
+                    pass
+        return total
+
+    def admit(self, message_id, job_dir, need):
+        """Reserves need bytes if they fit now. Whether they ever will
+        depends on this box's volume and on what is left on it, so a
+        job that doesn't fit is only ever deferred: another annotator,
+        or this one later, may have the room"""
+        with self.lock:
+            os.makedirs(self.path, exist_ok=True)
+            usage = shutil.disk_usage(self.path)
+            outstanding = sum(max(0, n - self.written(d)) for d, n in self.reservations.values())
+            if need > usage.free - outstanding - min_free_bytes:
+                return False
+            self.reservations[message_id] = (job_dir, need)
+            return True
+
+    def hold(self, message_id, job_dir, need):
+        # Jobs resumed from the journal were admitted before the restart
+        with self.lock:
+            self.reservations[message_id] = (job_dir, need)
+
+    def release(self, message_id):
+        with self.lock:
+            self.reservations.pop(message_id, None)
+
+    def report(self):
+        with self.lock:
+            reserved = sum(n for d, n in self.reservations.values())
+        free = shutil.disk_usage(self.path).free if os.path.isdir(self.path) else 0
+        print(f"[stats] disk reserved={reserved / 1024 ** 2:.1f}MB "
+              f"free={free / 1024 ** 2:.1f}MB jobs={len(self.reservations)}")
+
+
+class Scheduler(object):
+    """Request messages received but not yet started.
+    Jobs start in weighted fair-share order: every user has a virtual
+    clock that advances by 1/weight of their tier each time one of their
+    jobs starts, and the waiting user with the earliest clock goes next.
+    A user with fifty queued files therefore gets one start per turn like
+    everyone else, and a premium user gets premium_weight turns for each
+    free_weight a free user gets. Users at their tier's cap are skipped
+    and free jobs never take the last premium_reserved_slots slots.
+    free_slots() is the supervisor's count of slots jobs can start in.
+    """
+    def __init__(self, max_jobs, free_slots):
+        self.lock = threading.Condition()
+        self.reserved_slots = max(0, min(premium_reserved_slots, max_jobs - 1))
+        self.free_slots = free_slots
+        self.pending = []
+        # Messages pollers are currently receiving, counted as buffered
+        self.receiving = 0
+        self.running = {}
+        self.clocks = {}
+        self.clock = 0.0
+
+    def room(self, queue_url):
+        """Messages queue_url may take: never more than the free slots
+        can start, so a saturated box leaves work to idle annotators.
+        Free jobs can't start in the reserved slots, so with a premium
+        queue the main queue takes nothing while only those are free."""
+        with self.lock:
+            queued = len([m for m, job in self.pending if m['QueueUrl'] == queue_url])
+            free_slots = self.free_slots()
+            if not premium_queue_url:
+                # One queue: a message's tier is only known once received
+                startable = free_slots - len(self.pending) - self.receiving
+            elif queue_url == premium_queue_url:
+                # Buffered free jobs only hold the slots they may start in
+                waiting_free = len([m for m, job in self.pending if job['tier'] == 'free'])
+                held = min(waiting_free, max(0, free_slots - self.reserved_slots))
+                startable = free_slots - (len(self.pending) - waiting_free) - held - self.receiving
+            else:
+                startable = free_slots - self.reserved_slots - len(self.pending) - self.receiving
+            return min(buffer_size - queued, startable)
+
+    def wait_for_room(self, queue_url, timeout):
+        """Waits up to timeout for room and reserves it for a receive;
+        the caller hands it back with received() once the messages are
+        buffered"""
+        with self.lock:
+            self.lock.wait_for(lambda: self.room(queue_url) > 0, timeout)
+            room = max(0, min(max_messages, self.room(queue_url)))
+            self.receiving += room
+        return room
+
+    def received(self, room):
+        with self.lock:
+            self.receiving -= room
+            self.lock.notify_all()
+
+    def add(self, message, job):
+        """Buffers a received message unless its user already has
+        user_buffer_size waiting, so a backlog from one user can't fill
+        the buffer and keep other users' jobs out of it"""
+        with self.lock:
+            waiting = len([m for m, j in self.pending if j['user_id'] == job['user_id']])
+            if waiting >= user_buffer_size:
+                return False
+            self.pending.append((message, job))
+            self.lock.notify_all()
+            return True
+
+    def wait(self, timeout):
+        with self.lock:
+            self.lock.wait(timeout)
+
+    def capped(self, job):
+        cap = user_max_jobs[job['tier']]
+        return cap and len([u for u, t in self.running.values() if u == job['user_id']]) >= cap
+
+    def eligible(self, job, free_slots):
+        if self.capped(job):
+            return False
+        return job['tier'] == 'premium' or free_slots > self.reserved_slots
+
+    def adopt(self, message, job):
+        # A job resumed from the journal counts towards its user's cap
+        with self.lock:
+            self.running[message['MessageId']] = (job['user_id'], job['tier'])
+
+    def next(self, free_slots):
+        with self.lock:
+            best = None
+            for i, (message, job) in enumerate(self.pending):
+                if not self.eligible(job, free_slots):
+                    continue
+                start = max(self.clocks.get(job['user_id'], 0.0), self.clock)
+                # Ties go to the earliest received
+                if best is None or start < best[0]:
+                    best = (start, i)
+            if best is None:
+                return None
+            start, i = best
+            message, job = self.pending.pop(i)
+            self.clock = start
+            self.clocks[job['user_id']] = start + 1.0 / weights[job['tier']]
+            self.running[message['MessageId']] = (job['user_id'], job['tier'])
+            self.lock.notify_all()
+
+        sent = int(message.get('Attributes', {}).get('SentTimestamp', 0)) / 1000.0
+        if sent:
+            stats.record(f"queue_wait_{job['tier']}", time.time() - sent)
+            queue_wait.observe(time.time() - sent, tier=job['tier'])
+        return message, job
+
+    def finish(self, message):
+        with self.lock:
+            self.running.pop(message['MessageId'], None)
+            # Forget idle users that are not ahead of the global clock
+            active = {u for u, t in self.running.values()} | {job['user_id'] for m, job in self.pending}
+            self.clocks = {u: c for u, c in self.clocks.items() if u in active or c > self.clock}
+            self.lock.notify_all()
+
+    def drain(self):
+        """Removes and returns every buffered message"""
+        with self.lock:
+            drained, self.pending = self.pending, []
+            self.lock.notify_all()
+        return drained
+
+    def shed(self):
+        """Removes and returns the buffered messages of users at their
+        cap; only called when slots are free but no buffered job can
+        start, so they are deferred and the room they take goes to other
+        users' jobs. Free jobs kept out only by the reserved slots stay:
+        they start once any job ends, and room() receives no more behind
+        them meanwhile, so the queue isn't received and shed every loop."""
+        with self.lock:
+            shed = [(m, job) for m, job in self.pending if self.capped(job)]
+            self.pending = [(m, job) for m, job in self.pending if not self.capped(job)]
+            self.lock.notify_all()
+        return shed
+
+
+# Durations from seconds to hours, for jobs and the time they queue
+DURATION_BUCKETS = [0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1200, 1800, 3600, 7200, 14400]
+TRANSFER_BUCKETS = [0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600]
+
+messages_received = metrics.Counter(
+    'gas_annotator_messages_received_total', 'Request messages received from SQS')
+jobs_started = metrics.Counter(
+    'gas_annotator_jobs_started_total', 'Annotation jobs launched', ['tier'])
+jobs_completed = metrics.Counter(
+    'gas_annotator_jobs_completed_total', 'Annotation jobs that finished and published results')
+jobs_failed = metrics.Counter(
+    'gas_annotator_jobs_failed_total', 'Annotation jobs that failed and were returned to the queue')
+events = metrics.Counter(
+    'gas_annotator_events_total', 'Admission and recovery events (deferred, rejected, shed, '
+    'resumed, adopted)', ['event'])
+queue_wait = metrics.Histogram(
+    'gas_annotator_queue_wait_seconds', 'Time from SQS SentTimestamp until a job is started',
+    DURATION_BUCKETS, ['tier'])
+job_seconds = metrics.Histogram(
+    'gas_annotator_job_seconds', 'Wall time of a job from launch until its child exits',
+    DURATION_BUCKETS, ['outcome'])
+annotation_seconds = metrics.Histogram(
+    'gas_annotator_annotation_seconds', 'Time AnnTools spent annotating a job', DURATION_BUCKETS)
+download_seconds = metrics.Histogram(
+    'gas_annotator_download_seconds', 'Input download time', TRANSFER_BUCKETS)
+download_bytes = metrics.Counter(
+    'gas_annotator_download_bytes_total', 'Input bytes downloaded from S3')
+upload_seconds = metrics.Histogram(
+    'gas_annotator_upload_seconds', 'Result and log upload time per job', TRANSFER_BUCKETS)
+upload_bytes = metrics.Counter(
+    'gas_annotator_upload_bytes_total', 'Result and log bytes uploaded to S3')
+
+stats = Stats()
+leases = Leases()
+draining = threading.Event()
+drain_started = None
+supervisor = Supervisor(max(1, int(jobs_per_core * (os.cpu_count() or 1))))
+disk_budget = DiskBudget(job_info_dir)
+scheduler = Scheduler(supervisor.max_jobs, supervisor.free_slots)
+shard_owner = distributed.default_owner()
+
+metrics.Gauge('gas_annotator_jobs_running', 'Jobs and shards running now',
+              function=lambda: len(supervisor.children))
+metrics.Gauge('gas_annotator_job_slots', 'Jobs this annotator runs at once',
+              function=lambda: supervisor.max_jobs)
+metrics.Gauge('gas_annotator_jobs_buffered', 'Messages received but not started yet',
+              function=lambda: len(scheduler.pending))
+metrics.Gauge('gas_annotator_disk_free_bytes', 'Free space on the job_info_dir volume',
+              function=lambda: shutil.disk_usage(job_info_dir if os.path.isdir(job_info_dir)
+                                                 else '.').free)
+metrics.Gauge('gas_annotator_disk_reserved_bytes', 'Disk promised to admitted jobs',
+              function=lambda: sum(n for d, n in list(disk_budget.reservations.values())))
+metrics.Gauge('gas_annotator_draining', '1 once the annotator is draining',
+              function=lambda: int(draining.is_set()))
+# This process's own AWS calls are read from aws_clients at every scrape;
+# run.py children report theirs through the journal
+aws_throttles = metrics.Counter(
+    'gas_annotator_aws_throttles_total', 'AWS API attempts answered with a throttling error',
+    ['service'], function=lambda: aws_clients.counts('throttles'))
+aws_retries = metrics.Counter(
+    'gas_annotator_aws_retries_total', 'AWS API calls retried', ['service'],
+    function=lambda: aws_clients.counts('retries'))
+
+
+def file_md5(local_file_path, block_size=8 * 1024 * 1024):
+    md5 = hashlib.md5()
+    with open(local_file_path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            md5.update(block)
+    return md5.hexdigest()
+
+
+def download_file_from_s3(bucket_name, s3_key, local_file_path, head=None):
+    try:
+        if head is None:
+            head = s3.head_object(Bucket=bucket_name, Key=s3_key)
+        start = time.time()
+        s3.download_file(bucket_name, s3_key, local_file_path, Config=download_config)
+        elapsed = time.time() - start
     except Exception as e:
         print(f"Failed to download file from S3: {str(e)}")
         return False
 
-# Poll the message queue in a loop using long polling
-while True:
-    # Attempt to read a message from the queue
-    messages = sqs.receive_message(
-        QueueUrl=queue_url_requests,
-        AttributeNames=['All'],
-        MaxNumberOfMessages=1,
-        WaitTimeSeconds=20  # Use long polling
-    )
+    # Verify what landed on disk against the object we were sent
+    size = os.path.getsize(local_file_path)
+    if size != head['ContentLength']:
+        print(f"Downloaded size mismatch for {s3_key}: expected {head['ContentLength']} bytes, got {size}")
+        return False
+    etag = head.get('ETag', '').strip('"')
+    # Only single-part uploads (e.g. the browser's presigned POST) have
+    # an MD5 ETag; multipart ETags are skipped
+    if verify_checksum and etag and '-' not in etag and file_md5(local_file_path) != etag:
+        print(f"Downloaded checksum mismatch for {s3_key}")
+        return False
 
-    if 'Messages' in messages:
-        for message in messages['Messages']:
-            # Extract job parameters from the message body
-            body1 = json.loads(message['Body'])
-            body = json.loads(body1['Message'])
-            user_id = body['user_id']
-            job_id = body['job_id']
-            input_file_name = body['input_file_name']
-            s3_inputs_bucket = body['s3_inputs_bucket']
-            s3_key_input_file = body['s3_key_input_file']
+    download_seconds.observe(elapsed)
+    download_bytes.inc(size)
+    rate = size / elapsed if elapsed > 0 else 0.0
+    print(f"Downloaded {s3_key}: {size} bytes in {elapsed:.2f}s ({rate / 1024 / 1024:.2f} MB/s)")
+    return True
 
-            # Directory structure for job files
-            local_file_path = os.path.join(job_info_dir, job_id, os.path.basename(s3_key_input_file))
-            os.makedirs(os.path.dirname(local_file_path), exist_ok=True)
 
-            # Download file from S3
+# Complete a claimed job from the result cache without running AnnTools
+def complete_from_cache(job_id, user_id, local_file_path, digest):
+    results_file, log_file, s3_key_results_file, s3_key_log_file = \
+        run.result_locations(local_file_path)
+    if not result_cache.copy_to_job(digest, s3_key_results_file, s3_key_log_file):
+        return False
+    if os.path.isdir(os.path.dirname(local_file_path)):
+        run.delete_local_file(os.path.dirname(local_file_path))
+    journal.remove(job_id)
+    run.complete_job(job_id, user_id, s3_key_results_file, s3_key_log_file)
+    print(f"Job {job_id} completed from result cache.")
+    return True
+
+
+# Complete a job whose results an earlier run uploaded before it was
+# interrupted
+def complete_uploaded(job_id, user_id, local_file_path):
+    item = jobs_table().get_item(Key={'job_id': job_id}).get('Item', {})
+    if item.get('job_status') == 'RUNNING':
+        s3_key_results_file, s3_key_log_file = run.result_locations(local_file_path)[2:]
+        run.complete_job(job_id, user_id, s3_key_results_file, s3_key_log_file)
+    if os.path.isdir(os.path.dirname(local_file_path)):
+        run.delete_local_file(os.path.dirname(local_file_path))
+    journal.remove(job_id)
+    print(f"Job {job_id} completed from its uploaded results.")
+
+
+# Disk is reserved for a shard or merge before it is leased, under the
+# key its child is supervised by
+def admit_shard_work(job_id, shard_no, admitted):
+    if shard_no == distributed.MANIFEST:
+        job_dir = os.path.join(job_info_dir, job_id)
+    else:
+        job_dir = distributed.work_dir(job_id, shard_no)
+    need = int(distributed.item_size(job_id, shard_no) * workspace_factor)
+    if not disk_budget.admit(f"{job_id}:{shard_no}", job_dir, need):
+        return False
+    admitted.append(f"{job_id}:{shard_no}")
+    return True
+
+
+# Fill free job slots with distributed shards from any annotator's jobs
+def lease_shard_work():
+    while not draining.is_set():
+        time.sleep(distributed.poll_interval)
+        while not draining.is_set() and supervisor.reserve():
+            admitted = []
             try:
-                s3.download_file(s3_inputs_bucket, s3_key_input_file, local_file_path)
+                leased = distributed.claim(
+                    shard_owner, lambda job_id, shard_no: admit_shard_work(job_id, shard_no, admitted))
             except Exception as e:
-                print(f"Failed to download file from S3: {str(e)}")
-                continue
+                print(f"Failed to lease shard work: {str(e)}")
+                leased = None
+            # Only the item leased keeps its reservation
+            for key in admitted:
+                if leased is None or key != f"{leased[0]}:{leased[1]}":
+                    disk_budget.release(key)
+            if leased is None:
+                supervisor.release()
+                break
+            try:
+                supervisor.launch_shard(leased[0], leased[1], shard_owner)
+                print(f"Shard {leased[1]} of job {leased[0]} started.")
+            except Exception as e:
+                print(f"Failed to start shard {leased[1]} of job {leased[0]}: {str(e)}")
+                supervisor.release()
+                disk_budget.release(f"{leased[0]}:{leased[1]}")
+                distributed.release(leased[0], leased[1], shard_owner)
+                break
 
-            # Check the current job status
+
+# Resume the jobs an earlier annotator process journaled. A child still
+# running is adopted; otherwise, while the request message's lease is
+# still ours, the job continues from its last completed stage. Jobs
+# whose lease has lapsed are left for the message's redelivery, which
+# reuses the journaled input if it comes back to this annotator.
+def recover_jobs():
+    for entry in journal.entries():
+        job_id = entry['job_id']
+        message = {
+            'MessageId': entry['message_id'],
+            'QueueUrl': entry['queue_url'],
+            'ReceiptHandle': entry['receipt_handle'],
+            'Attributes': {}
+        }
+        job = {'job_id': job_id, 'user_id': entry['user_id'], 'tier': entry['tier'],
+               'local_file_path': entry['local_file_path']}
+        try:
+            sqs.change_message_visibility(
+                QueueUrl=message['QueueUrl'],
+                ReceiptHandle=message['ReceiptHandle'],
+                VisibilityTimeout=visibility_timeout
+            )
+        except Exception as e:
+            print(f"Job {job_id} ({entry['stage']}) lost its lease; "
+                  f"keeping its files for redelivery: {str(e)}")
+            continue
+        leases.hold(message, job_id)
+
+        if entry['stage'] == 'uploaded':
             try:
-                response = table.get_item(
-                    Key={'job_id': job_id}
-                )
-                item = response.get('Item')
-                current_status = item.get('job_status', 'UNKNOWN')
-                print(f"Current status for job_id {job_id}: {current_status}")
+                complete_uploaded(job_id, entry['user_id'], entry['local_file_path'])
+                delete_request_message(job_id, message)
             except Exception as e:
-                print(f"Failed to get job status from DynamoDB: {str(e)}")
-                continue
+                print(f"Failed to complete uploaded job {job_id}: {str(e)}")
+                retry_job(job_id, message)
+            continue
 
-            if current_status == 'PENDING':
-                # Update job status in DynamoDB
-                try:
-                    table.update_item(
-                        Key={'job_id': job_id},
-                        UpdateExpression='SET job_status = :new_status, user_id = :user',
-                        ConditionExpression='job_status = :current_status',
-                        ExpressionAttributeValues={
-                            ':new_status': 'RUNNING',
-                            ':user': user_id,
-                            ':current_status': 'PENDING'
-                        }
-                    )
-                except Exception as e:
-                    print(f"Failed to update job status in DynamoDB: {str(e)}")
+        if journal.child_alive(entry):
+            disk_budget.hold(message['MessageId'], os.path.dirname(entry['local_file_path']),
+                             entry['workspace'])
+            scheduler.adopt(message, job)
+            supervisor.adopt(job_id, AdoptedJob(entry), message)
+            stats.count('adopted')
+            print(f"Job {job_id} is still running as pid {entry['pid']}; adopted.")
+            continue
+
+        if not os.path.isfile(entry['local_file_path']):
+            journal.remove(job_id)
+            retry_job(job_id, message)
+            continue
+        if not supervisor.reserve():
+            # More jobs were journaled than there are slots now
+            retry_job(job_id, message)
+            continue
+        disk_budget.hold(message['MessageId'], os.path.dirname(entry['local_file_path']),
+                         entry['workspace'])
+        scheduler.adopt(message, job)
+        try:
+            child = supervisor.launch(job_id, message, entry['local_file_path'],
+                                      entry['user_id'], entry['digest'] or '')
+            journal.advance(job_id, 'launched', pid=getattr(child, 'pid', None))
+            jobs_started.inc(tier=job['tier'])
+            stats.count('resumed')
+            print(f"Job {job_id} resumed from its {entry['stage']} stage.")
+        except Exception as e:
+            print(f"Failed to resume job {job_id}: {str(e)}")
+            supervisor.release()
+            disk_budget.release(message['MessageId'])
+            scheduler.finish(message)
+            retry_job(job_id, message)
+
+
+# Drop journaled jobs nobody came back for, with whatever they left in
+# job_info_dir
+def expire_journal():
+    while True:
+        time.sleep(min(journal.expire_seconds, 300))
+        cutoff = time.time() - journal.expire_seconds
+        try:
+            with leases.lock:
+                held = set(leases.handles)
+            for entry in journal.entries():
+                if (entry['updated'] >= cutoff or entry['message_id'] in held or
+                        supervisor.running(entry['job_id']) or journal.child_alive(entry)):
                     continue
+                job_dir = os.path.dirname(entry['local_file_path'])
+                if os.path.isdir(job_dir):
+                    run.delete_local_file(job_dir)
+                journal.remove(entry['job_id'])
+                print(f"Job {entry['job_id']} expired from the journal ({entry['stage']}).")
+        except Exception as e:
+            print(f"Failed to expire journaled jobs: {str(e)}")
+
+
+def evict_result_cache():
+    while True:
+        try:
+            result_cache.evict()
+        except Exception as e:
+            print(f"Failed to evict result cache entries: {str(e)}")
+        time.sleep(cache_evict_interval)
+
+
+def delete_request_message(job_id, message):
+    leases.release(message)
+    try:
+        # Delete the message from the queue once the job is handled
+        with stats.timed('delete_message'):
+            sqs.delete_message(
+                QueueUrl=message['QueueUrl'],
+                ReceiptHandle=message['ReceiptHandle']
+            )
+    except Exception as e:
+        print(f"Failed to delete message for job {job_id}: {str(e)}")
+
+
+# Hand a failed job back to the queue for immediate redelivery
+def retry_job(job_id, message):
+    leases.release(message)
+    try:
+        jobs_table().update_item(
+            Key={'job_id': job_id},
+            UpdateExpression='SET job_status = :new_status',
+            ConditionExpression='job_status = :current_status',
+            ExpressionAttributeValues={
+                ':new_status': 'PENDING',
+                ':current_status': 'RUNNING'
+            }
+        )
+        sqs.change_message_visibility(
+            QueueUrl=message['QueueUrl'],
+            ReceiptHandle=message['ReceiptHandle'],
+            VisibilityTimeout=0
+        )
+        print(f"Job {job_id} returned to the queue for retry.")
+    except Exception as e:
+        print(f"Failed to return job {job_id} to the queue: {str(e)}")
+
+
+# The request message is only deleted once run.py has uploaded the
+# results and marked the job COMPLETED, i.e. the child exited cleanly
+def settle_job(job_id, returncode, message):
+    if message is None:
+        # A distributed shard or merge, which settles its own lease
+        disk_budget.release(job_id)
+        return
+    disk_budget.release(message['MessageId'])
+    scheduler.finish(message)
+    observe_timings(job_id)
+    if returncode == 0:
+        jobs_completed.inc()
+        journal.remove(job_id)
+        delete_request_message(job_id, message)
+    else:
+        # The journal keeps the input, so a redelivery to this annotator
+        # starts from what the failed attempt left on disk
+        jobs_failed.inc()
+        retry_job(job_id, message)
+
+
+# Metrics for the work a job's child did, which it reports through the
+# journal
+def observe_timings(job_id):
+    try:
+        timings = journal.take_timings(job_id)
+    except Exception as e:
+        print(f"Failed to read timings of job {job_id}: {str(e)}")
+        return
+    if 'annotate' in timings:
+        annotation_seconds.observe(timings['annotate'])
+    if 'upload' in timings:
+        upload_seconds.observe(timings['upload'])
+        upload_bytes.inc(timings.get('upload_bytes', 0))
+    for name, count in timings.items():
+        # e.g. aws_throttles:dynamodb
+        if name.startswith('aws_'):
+            kind, service = name.split(':', 1)
+            (aws_throttles if kind == 'aws_throttles' else aws_retries).inc(count, service=service)
+
+
+# Extract job parameters from the message body
+def parse_job(message):
+    body1 = json.loads(message['Body'])
+    body = json.loads(body1['Message'])
+    job = {
+        'user_id': body['user_id'],
+        'job_id': body['job_id'],
+        'input_file_name': body['input_file_name'],
+        's3_inputs_bucket': body['s3_inputs_bucket'],
+        's3_key_input_file': body['s3_key_input_file'],
+        'tier': 'premium' if body.get('priority') == 'premium' else 'free'
+    }
+
+    # Directory structure for job files
+    job['local_file_path'] = os.path.join(job_info_dir, job['job_id'],
+                                          os.path.basename(job['s3_key_input_file']))
+    return job
+
+
+# Whether run.py may shard an input; compressed inputs are sharded by
+# their decompressed size, estimated with compressed_ratio
+def may_shard(local_file_path):
+    size = os.path.getsize(local_file_path)
+    if run.vcf_path(local_file_path) != local_file_path:
+        size *= compressed_ratio
+    return shard.wanted(local_file_path, size)
+
+
+# Hide a message this box can't start yet for defer_seconds; another
+# annotator, or this one once running jobs finish, picks it up again
+def defer_message(job, message, reason, seconds=defer_seconds):
+    leases.release(message)
+    try:
+        sqs.change_message_visibility(
+            QueueUrl=message['QueueUrl'],
+            ReceiptHandle=message['ReceiptHandle'],
+            VisibilityTimeout=seconds
+        )
+        print(f"Job {job['job_id']} deferred for {seconds}s: {reason}.")
+    except Exception as e:
+        print(f"Failed to defer job {job['job_id']}: {str(e)}")
+
+
+# Fail a job no annotator could ever run and drop its message
+def reject_job(job, message, reason):
+    stats.count('rejected')
+    try:
+        jobs_table().update_item(
+            Key={'job_id': job['job_id']},
+            UpdateExpression='SET job_status = :new_status, failure_reason = :reason',
+            ConditionExpression='job_status = :current_status',
+            ExpressionAttributeValues={
+                ':new_status': 'FAILED',
+                ':reason': reason,
+                ':current_status': 'PENDING'
+            }
+        )
+        print(f"Job {job['job_id']} rejected: {reason}")
+    except Exception as e:
+        print(f"Failed to mark job {job['job_id']} as failed: {str(e)}")
+    delete_request_message(job['job_id'], message)
+
+
+# Size the input with HeadObject and reserve disk space for the job
+# before anything is downloaded
+def admit_job(job, message):
+    try:
+        with stats.timed('head'):
+            job['head'] = s3.head_object(Bucket=job['s3_inputs_bucket'],
+                                         Key=job['s3_key_input_file'], ChecksumMode='ENABLED')
+    except Exception as e:
+        print(f"Failed to get size of input for job {job['job_id']}: {str(e)}")
+        leases.release(message)
+        return False
+
+    size = job['head']['ContentLength']
+    if max_input_bytes and size > max_input_bytes:
+        reject_job(job, message, f"Input is {size} bytes; the limit is {max_input_bytes}")
+        return False
+    # Results are written uncompressed whatever the input
+    workspace = size * workspace_factor
+    if run.vcf_path(job['local_file_path']) != job['local_file_path']:
+        workspace *= compressed_ratio
+    job['workspace'] = int(workspace)
+    if result_cache.enabled:
+        job['digest'] = result_cache.object_digest(job['head']) or ''
+    if not disk_budget.admit(message['MessageId'], os.path.dirname(job['local_file_path']),
+                             job['workspace']):
+        stats.count('deferred')
+        defer_message(job, message, 'not enough disk space')
+        return False
+    return True
+
+
+def download_input(job):
+    os.makedirs(os.path.dirname(job['local_file_path']), exist_ok=True)
+    # Download file from S3
+    start = time.time()
+    with stats.timed('download'):
+        downloaded = download_file_from_s3(job['s3_inputs_bucket'], job['s3_key_input_file'],
+                                           job['local_file_path'], job.get('head'))
+    job['download_seconds'] = time.time() - start
+    if supervisor.pipeline is not None:
+        supervisor.pipeline.record('download', job['download_seconds'])
+    return downloaded
+
+
+def fetch_input(job, message):
+    # A job journaled by an earlier attempt on this annotator keeps its
+    # input (or its uploaded results) from that attempt
+    if (journal.reached(job['job_id'], 'uploaded') or
+            journal.has_input(job['job_id'], job['local_file_path'],
+                              job['head']['ContentLength'])):
+        print(f"Job {job['job_id']} resumes from its journaled "
+              f"{journal.get(job['job_id'])['stage']} stage")
+        stats.count('resumed')
+        journal.rebind(job['job_id'], message)
+        job['download_seconds'] = 0.0
+        return True
+
+    # A repeat submission found in the result cache by its input's
+    # checksum is completed by start_job without being downloaded
+    if job.get('digest'):
+        with stats.timed('cache_lookup'):
+            job['cached'] = result_cache.lookup(job['digest'])
+        if job['cached']:
+            job['download_seconds'] = 0.0
+            return True
+
+    if not download_input(job):
+        leases.release(message)
+        return False
+    journal.record(job, message, job['workspace'])
+    return True
+
+
+# Read the job's status before anything is downloaded. A PENDING job is
+# ours to claim; a RUNNING one only once it has gone visibility_timeout
+# without a heartbeat, as a message is also redelivered for a healthy
+# job: SQS duplicates, admission deferrals, a late heartbeat and the
+# 12 hour in-flight limit all raise its receive count.
+def check_job(job, message):
+    job_id = job['job_id']
+    try:
+        with stats.timed('get_status'):
+            response = jobs_table().get_item(
+                Key={'job_id': job_id}
+            )
+        item = response.get('Item')
+        current_status = item.get('job_status', 'UNKNOWN')
+        print(f"Current status for job_id {job_id}: {current_status}")
+    except Exception as e:
+        print(f"Failed to get job status from DynamoDB: {str(e)}")
+        leases.release(message)
+        return False
+
+    # Distributed jobs carry no heartbeat; their shards hold leases of
+    # their own
+    if current_status == 'RUNNING' and 'heartbeat_at' in item:
+        if item['heartbeat_at'] >= time.time() - visibility_timeout:
+            defer_message(job, message, f"it is running on {item.get('lease_owner')}",
+                          visibility_timeout)
+            return False
+    elif current_status != 'PENDING':
+        print(f"Job {job_id} is not in PENDING state, skipping.")
+        delete_request_message(job_id, message)
+        return False
+    job['status'] = current_status
+    job['previous_owner'] = item.get('lease_owner')
+    return True
+
+
+# Conditional PENDING->RUNNING transition, or takeover of a RUNNING job
+# whose heartbeat went stale; only one annotator can win it
+def claim_job(job, message):
+    job_id = job['job_id']
+    now = int(time.time())
+    condition = 'job_status = :current_status'
+    values = {
+        ':new_status': 'RUNNING',
+        ':user': job['user_id'],
+        ':owner': job_owner,
+        ':now': now,
+        ':current_status': job['status']
+    }
+    if job['status'] == 'RUNNING':
+        condition += ' AND heartbeat_at < :stale'
+        values[':stale'] = now - visibility_timeout
+
+    # Update job status in DynamoDB
+    try:
+        with stats.timed('claim'):
+            jobs_table().update_item(
+                Key={'job_id': job_id},
+                UpdateExpression='SET job_status = :new_status, user_id = :user, '
+                                 'lease_owner = :owner, heartbeat_at = :now',
+                ConditionExpression=condition,
+                ExpressionAttributeValues=values
+            )
+    except Exception as e:
+        print(f"Failed to update job status in DynamoDB: {str(e)}")
+        leases.release(message)
+        return False
+    if job['status'] == 'RUNNING':
+        stats.count('taken_over')
+        print(f"Job {job_id} taken over from {job['previous_owner']}, whose heartbeat went stale.")
+    leases.hold(message, job_id)
+    return True
+
+
+# Returns True once the job's child process has been handed to the
+# supervisor; any other outcome leaves the reserved slot to be released.
+def start_job(job, message):
+    job_id = job['job_id']
+    user_id = job['user_id']
+    local_file_path = job['local_file_path']
+
+    if journal.reached(job_id, 'uploaded'):
+        try:
+            complete_uploaded(job_id, user_id, local_file_path)
+            delete_request_message(job_id, message)
+        except Exception as e:
+            print(f"Failed to complete uploaded job {job_id}: {str(e)}")
+            retry_job(job_id, message)
+        return False
+
+    # Repeat submissions are served from the result cache, keyed by the
+    # input object's checksum where it has one, else by the downloaded
+    # content; fetch_input may already have found the entry missing
+    digest = job.get('digest', '')
+    if result_cache.enabled and job.get('cached') is not False:
+        try:
+            with stats.timed('cache_lookup'):
+                digest = digest or result_cache.content_digest(local_file_path)
+                hit = complete_from_cache(job_id, user_id, local_file_path, digest)
+            if hit:
+                delete_request_message(job_id, message)
+                return False
+        except Exception as e:
+            print(f"Failed to complete job {job_id} from result cache: {str(e)}")
+    if job.get('cached'):
+        # Evicted since fetch_input looked; annotate it after all
+        if not download_input(job):
+            retry_job(job_id, message)
+            return False
+        journal.record(job, message, job['workspace'])
+
+    # Oversized inputs are annotated by the whole fleet
+    if distributed.wanted(local_file_path):
+        try:
+            with stats.timed('distribute'):
+                distributed.submit(job_id, user_id, local_file_path, digest)
+            run.delete_local_file(os.path.dirname(local_file_path))
+            journal.remove(job_id)
+            delete_request_message(job_id, message)
+        except Exception as e:
+            print(f"Failed to distribute job {job_id}: {str(e)}")
+            retry_job(job_id, message)
+            return False
+        try:
+            # The shard leases keep the job alive from here on
+            jobs_table().update_item(Key={'job_id': job_id},
+                              UpdateExpression='REMOVE heartbeat_at, lease_owner')
+        except Exception as e:
+            print(f"Failed to clear the heartbeat of distributed job {job_id}: {str(e)}")
+        return False
+
+    # A draining annotator hands jobs it has not started yet straight back
+    if draining.is_set():
+        retry_job(job_id, message)
+        return False
+
+    # Launch annotation job as a background process
+    try:
+        with stats.timed('launch'):
+            child = supervisor.launch(job_id, message, local_file_path, user_id, digest,
+                                      job.get('download_seconds'))
+        jobs_started.inc(tier=job['tier'])
+        print(f"Job {job_id} started successfully ({execution_mode}).")
+    except Exception as e:
+        print(f"Failed to start job {job_id}: {str(e)}")
+        retry_job(job_id, message)
+        return False
+    try:
+        journal.advance(job_id, 'launched', pid=getattr(child, 'pid', None), digest=digest)
+    except Exception as e:
+        print(f"Failed to journal launch of job {job_id}: {str(e)}")
+    return True
+
+
+def handle_message(message, job):
+    return (check_job(job, message) and
+            admit_job(job, message) and
+            fetch_input(job, message) and
+            claim_job(job, message) and
+            start_job(job, message))
+
+
+def dispatch(message, job):
+    start = time.time()
+    launched = False
+    try:
+        launched = handle_message(message, job)
+    except Exception as e:
+        print(f"Failed to process message {message.get('MessageId')}: {str(e)}")
+        leases.release(message)
+    finally:
+        if not launched:
+            supervisor.release()
+            disk_budget.release(message['MessageId'])
+            scheduler.finish(message)
+        stats.record('total', time.time() - start)
+
+
+# Receive up to capacity messages from queue_url into the scheduler,
+# leased until their jobs finish
+def receive_batch(queue_url, capacity):
+    with stats.timed('receive'):
+        messages = sqs.receive_message(
+            QueueUrl=queue_url,
+            AttributeNames=['All'],
+            MaxNumberOfMessages=capacity,
+            WaitTimeSeconds=wait_time_seconds  # Use long polling
+        )
+
+    batch = messages.get('Messages', [])
+    stats.count_messages(len(batch))
+    for message in batch:
+        message['QueueUrl'] = queue_url
+        leases.hold(message)
+        try:
+            job = parse_job(message)
+        except Exception as e:
+            print(f"Failed to parse message {message['MessageId']}: {str(e)}")
+            leases.release(message)
+            continue
+        if queue_url == premium_queue_url:
+            job['tier'] = 'premium'
+        if draining.is_set():
+            # A long poll that was already waiting when the drain began
+            defer_message(job, message, 'the annotator is draining', 0)
+            continue
+        if not scheduler.add(message, job):
+            stats.count('shed')
+            defer_message(job, message, 'its user already has jobs waiting to start')
+    return len(batch)
+
+
+def poll(queue_url):
+    while not draining.is_set():
+        # No receive while every slot is taken or already spoken for
+        room = scheduler.wait_for_room(queue_url, reap_interval)
+        if room <= 0:
+            continue
+        try:
+            receive_batch(queue_url, room)
+        except Exception as e:
+            print(f"Failed to receive messages: {str(e)}")
+            time.sleep(reap_interval)
+        finally:
+            scheduler.received(room)
+
+
+# Take up to capacity jobs in fair-share order, reserving a job slot for
+# each. If slots are free but no buffered job can start, the messages of
+# users at their cap are deferred so the jobs stuck behind them in SQS
+# get a look in.
+def schedule(capacity):
+    picked = []
+    while len(picked) < capacity and not draining.is_set():
+        free_slots = supervisor.free_slots()
+        if free_slots <= 0:
+            break
+        entry = scheduler.next(free_slots)
+        if entry is None:
+            for message, job in scheduler.shed():
+                stats.count('shed')
+                defer_message(job, message, 'its user is at their concurrent job cap')
+            break
+        supervisor.reserve()
+        picked.append(entry)
+    return picked
+
+
+def begin_drain(reason):
+    global drain_started
+    if not draining.is_set():
+        drain_started = time.time()
+        draining.set()
+        print(f"Draining ({reason}): no new jobs; running jobs have {drain_deadline:.0f}s to finish")
+
+
+def check_control_file():
+    if os.path.exists(drain_control_file):
+        begin_drain(f"found {drain_control_file}")
+
+
+# Return buffered messages to the queue, settle running jobs until they
+# are done or the drain deadline passes, then requeue whatever is left
+def finish_drain():
+    returned = finished = 0
+    completed = supervisor.completed
+    while True:
+        # Pollers may still add what an in-flight long poll brought back
+        for message, job in scheduler.drain():
+            defer_message(job, message, 'the annotator is draining', 0)
+            scheduler.finish(message)
+            returned += 1
+        for job_id, child, started, message in supervisor.reap():
+            settle_job(job_id, child.returncode, message)
+            finished += 1
+        if not supervisor.children or time.time() >= drain_started + drain_deadline:
+            break
+        time.sleep(reap_interval)
+
+    abandoned = supervisor.abandon()
+    for job_id, child, started, message in abandoned:
+        print(f"Job {job_id} cut off by the drain deadline after {time.time() - started:.1f}s")
+        settle_job(job_id, 1, message)
+    print(f"Drained in {time.time() - drain_started:.1f}s: {finished} running jobs finished "
+          f"({supervisor.completed - completed} succeeded), {returned} buffered messages "
+          f"returned, {len(abandoned)} jobs cut off and requeued")
+
+
+async def poll_async(queue_url, wake):
+    while not draining.is_set():
+        room = await asyncio.to_thread(scheduler.wait_for_room, queue_url, reap_interval)
+        if room <= 0:
+            continue
+        try:
+            await asyncio.to_thread(receive_batch, queue_url, room)
+        except Exception as e:
+            print(f"Failed to receive messages: {str(e)}")
+            await asyncio.sleep(reap_interval)
+        finally:
+            scheduler.received(room)
+        wake.set()
+
+
+async def schedule_async(queue, wake):
+    while not draining.is_set():
+        room = queue.maxsize - queue.qsize()
+        for entry in await asyncio.to_thread(schedule, room):
+            await queue.put(entry)
+        # Woken early by new messages, freed slots and free dispatchers
+        try:
+            await asyncio.wait_for(wake.wait(), reap_interval)
+        except asyncio.TimeoutError:
+            pass
+        wake.clear()
+
+
+async def dispatch_async(queue, wake):
+    while True:
+        message, job = await queue.get()
+        start = time.time()
+        launched = False
+        try:
+            # Each blocking AWS call runs on the loop's thread pool so
+            # other jobs' steps proceed while it waits on the network
+            launched = (await asyncio.to_thread(check_job, job, message) and
+                        await asyncio.to_thread(admit_job, job, message) and
+                        await asyncio.to_thread(fetch_input, job, message) and
+                        await asyncio.to_thread(claim_job, job, message) and
+                        await asyncio.to_thread(start_job, job, message))
+        except Exception as e:
+            print(f"Failed to process message {message.get('MessageId')}: {str(e)}")
+            leases.release(message)
+        finally:
+            if not launched:
+                supervisor.release()
+                disk_budget.release(message['MessageId'])
+                scheduler.finish(message)
+            stats.record('total', time.time() - start)
+            queue.task_done()
+            wake.set()
+
+
+async def reap_async(wake):
+    last_report = time.time()
+    while True:
+        check_control_file()
+        for job_id, child, started, message in supervisor.reap():
+            await asyncio.to_thread(settle_job, job_id, child.returncode, message)
+            wake.set()
+        if time.time() - last_report >= stats_interval:
+            stats.report()
+            supervisor.report()
+            disk_budget.report()
+            last_report = time.time()
+        await asyncio.sleep(reap_interval)
+
+
+async def heartbeat_async():
+    while True:
+        await asyncio.sleep(heartbeat_interval)
+        await asyncio.to_thread(leases.heartbeat)
+
+
+async def main_async():
+    pollers = async_pollers * len(request_queues)
+    asyncio.get_running_loop().set_default_executor(
+        ThreadPoolExecutor(max_workers=dispatch_workers + pollers + 3))
+    queue = asyncio.Queue(maxsize=dispatch_workers)
+    wake = asyncio.Event()
+    scheduling = asyncio.ensure_future(schedule_async(queue, wake))
+    workers = asyncio.gather(
+        *[poll_async(queue_url, wake) for queue_url in request_queues
+          for _ in range(async_pollers)],
+        *[dispatch_async(queue, wake) for _ in range(dispatch_workers)],
+        reap_async(wake)
+    )
+    heartbeat = asyncio.ensure_future(heartbeat_async())
+
+    # Scheduling stops once draining; jobs it already queued are returned
+    # by start_job, then the drain settles what is still running
+    await scheduling
+    await queue.join()
+    workers.cancel()
+    try:
+        await workers
+    except asyncio.CancelledError:
+        pass
+    await asyncio.to_thread(finish_drain)
+    heartbeat.cancel()
+
+
+def main():
+    # Each request queue is long polled by its own thread into the
+    # scheduler's bounded buffer. This loop starts buffered jobs in
+    # fair-share order as job slots and dispatch workers free up, so the
+    # box never takes more work than it can run and one user's backlog
+    # waits in SQS rather than in front of everyone else's jobs.
+    if execution_mode == 'pool':
+        supervisor.start_pool()
+    elif execution_mode == 'pipeline':
+        supervisor.start_pipeline()
+    if metrics_enabled:
+        try:
+            metrics.serve(metrics_host, metrics_port)
+        except OSError as e:
+            print(f"Failed to serve metrics on {metrics_host}:{metrics_port}: {str(e)}")
+    if journal.enabled:
+        recover_jobs()
+        threading.Thread(target=expire_journal, daemon=True).start()
+    # Embedded runs (e.g. bench_annotator.py) start main() on a thread,
+    # where only the control file can start a drain
+    if threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGTERM, lambda signum, frame: begin_drain('SIGTERM'))
+    if result_cache.enabled:
+        threading.Thread(target=evict_result_cache, daemon=True).start()
+    if distributed.enabled:
+        threading.Thread(target=lease_shard_work, daemon=True).start()
+    print(f"Annotator running up to {supervisor.max_jobs} concurrent jobs ({execution_mode}, {engine})")
+    if engine == 'asyncio':
+        asyncio.run(main_async())
+        return
+
+    threading.Thread(target=leases.run, daemon=True).start()
+    for queue_url in request_queues:
+        threading.Thread(target=poll, args=(queue_url,), daemon=True).start()
+    dispatcher = ThreadPoolExecutor(max_workers=dispatch_workers)
+    in_flight = set()
+    last_report = time.time()
+
+    while not draining.is_set():
+        check_control_file()
+        for job_id, child, started, message in supervisor.reap():
+            settle_job(job_id, child.returncode, message)
+        if time.time() - last_report >= stats_interval:
+            stats.report()
+            supervisor.report()
+            disk_budget.report()
+            last_report = time.time()
+
+        in_flight = {f for f in in_flight if not f.done()}
+        for message, job in schedule(dispatch_workers - len(in_flight)):
+            in_flight.add(dispatcher.submit(dispatch, message, job))
+
+        if len(in_flight) >= dispatch_workers:
+            wait(in_flight, timeout=reap_interval, return_when=FIRST_COMPLETED)
+        else:
+            scheduler.wait(reap_interval)
+
+    # Dispatches under way return their jobs rather than launch them
+    wait(in_flight)
+    finish_drain()
+
+
+if __name__ == '__main__':
+    main()
 
-                # Launch annotation job as a background process
-                try:
-                    command = ['python', './run.py', local_file_path, user_id]
-                    job = subprocess.Popen(command)
-                    print("Successfully Started Popen")
-
-                    # Delete the message from the queue if job was successfully submitted
-                    sqs.delete_message(
-                        QueueUrl=queue_url_requests,
-                        ReceiptHandle=message['ReceiptHandle']
-                    )
-                    print(f"Job {job_id} started successfully.")
-                except Exception as e:
-                    print(f"Failed to start job {job_id}: {str(e)}")
-            else:
-                print(f"Job {job_id} is not in PENDING state, skipping.")
-    #else:
-        #print("No messages received")
 
 
 # Load configuration
@@ -0,0 +1,267 @@
+# bench_annotator.py
+#
+# Compares jobs admitted per minute by the threaded and asyncio annotator
+# engines against local stand-ins for SQS, S3 and DynamoDB, with the
+# annotator's original serial loop (one message received, downloaded,
+# claimed and launched at a time) as the baseline
+#
+# Run from the ann directory (annotator.py reads ann_config.ini):
+#   python bench_annotator.py --messages 2000 --duration 30 --latency-ms 20
+#
+##
+
+import os
+import sys
+import time
+import json
+import uuid
+import argparse
+import threading
+import multiprocessing
+from collections import deque
+
+import annotator
+
+
+class LocalSQS(object):
+    def __init__(self, messages, latency):
+        self.lock = threading.Lock()
+        self.latency = latency
+        self.visible = deque(messages)
+        self.in_flight = {}
+
+    def receive_message(self, QueueUrl, MaxNumberOfMessages=1, WaitTimeSeconds=0, **kwargs):
+        time.sleep(self.latency)
+        batch = []
+        with self.lock:
+            while self.visible and len(batch) < MaxNumberOfMessages:
+                message = dict(self.visible.popleft())
+                message['ReceiptHandle'] = str(uuid.uuid4())
+                self.in_flight[message['ReceiptHandle']] = message
+                batch.append(message)
+        if not batch:
+            time.sleep(min(WaitTimeSeconds, 1))
+            return {}
+        return {'Messages': batch}
+
+    def delete_message(self, QueueUrl, ReceiptHandle):
+        time.sleep(self.latency)
+        with self.lock:
+            self.in_flight.pop(ReceiptHandle, None)
+
+    def change_message_visibility(self, QueueUrl, ReceiptHandle, VisibilityTimeout):
+        time.sleep(self.latency)
+        with self.lock:
+            message = self.in_flight.pop(ReceiptHandle, None)
+            if message is not None and VisibilityTimeout == 0:
+                self.visible.append(message)
+
+    def change_message_visibility_batch(self, QueueUrl, Entries):
+        time.sleep(self.latency)
+        return {'Successful': [{'Id': entry['Id']} for entry in Entries], 'Failed': []}
+
+
+class LocalS3(object):
+    def __init__(self, latency, download_latency, object_size):
+        self.latency = latency
+        self.download_latency = download_latency
+        self.object_size = object_size
+
+    def head_object(self, Bucket, Key, **kwargs):
+        time.sleep(self.latency)
+        # Multipart-style ETag so the benchmark skips the MD5 check
+        return {'ContentLength': self.object_size, 'ETag': '"bench-1"'}
+
+    def download_file(self, Bucket, Key, Filename, **kwargs):
+        time.sleep(self.download_latency)
+        with open(Filename, 'wb') as f:
+            f.write(b'#' * self.object_size)
+
+
+class LocalTable(object):
+    def __init__(self, job_ids, latency):
+        self.lock = threading.Lock()
+        self.latency = latency
+        self.items = {job_id: {'job_id': job_id, 'job_status': 'PENDING'} for job_id in job_ids}
+        self.claimed = []
+
+    def get_item(self, Key, **kwargs):
+        time.sleep(self.latency)
+        with self.lock:
+            return {'Item': dict(self.items[Key['job_id']])}
+
+    def update_item(self, Key, UpdateExpression, ConditionExpression=None,
+                    ExpressionAttributeValues=None, **kwargs):
+        # Only the job_status transitions the annotator makes are modelled
+        time.sleep(self.latency)
+        values = ExpressionAttributeValues or {}
+        with self.lock:
+            item = self.items[Key['job_id']]
+            if ':new_status' not in values:
+                # e.g. heartbeat stamps
+                return
+            if ConditionExpression and item['job_status'] != values[':current_status']:
+                raise Exception('ConditionalCheckFailedException')
+            item['job_status'] = values[':new_status']
+            if values[':new_status'] == 'RUNNING':
+                self.claimed.append(time.time())
+
+
+class LocalChild(object):
+    """Stands in for a run.py child that exits after job_seconds"""
+    def __init__(self, job_seconds):
+        self.done_at = time.time() + job_seconds
+        self.returncode = None
+
+    def poll(self):
+        if self.returncode is None and time.time() >= self.done_at:
+            self.returncode = 0
+        return self.returncode
+
+
+def make_messages(count):
+    messages = []
+    for i in range(count):
+        job_id = str(uuid.uuid4())
+        body = {
+            'job_id': job_id,
+            'user_id': f"bench-user-{i % 10}",
+            'input_file_name': 'bench.vcf',
+            's3_inputs_bucket': 'bench-inputs',
+            's3_key_input_file': f"bench/{job_id}~bench.vcf"
+        }
+        messages.append({
+            'MessageId': str(uuid.uuid4()),
+            'Body': json.dumps({'Message': json.dumps(body)}),
+            'Attributes': {'ApproximateReceiveCount': '1',
+                           'SentTimestamp': str(int(time.time() * 1000))}
+        })
+    return messages
+
+
+"""The annotator's loop before the engines, as the baseline
+One message per receive is downloaded, checked, claimed and launched
+before the next receive. Like the engines, it waits for a free slot.
+"""
+def serial_loop(args, sqs, s3, table, work_dir):
+    children = []
+    while True:
+        children = [child for child in children if child.poll() is None]
+        if len(children) >= args.slots:
+            time.sleep(0.01)
+            continue
+        messages = sqs.receive_message(QueueUrl='bench', AttributeNames=['All'],
+                                       MaxNumberOfMessages=1, WaitTimeSeconds=20)
+        for message in messages.get('Messages', []):
+            body = json.loads(json.loads(message['Body'])['Message'])
+            local_file_path = os.path.join(work_dir, body['job_id'],
+                                           os.path.basename(body['s3_key_input_file']))
+            os.makedirs(os.path.dirname(local_file_path), exist_ok=True)
+            try:
+                s3.download_file(body['s3_inputs_bucket'], body['s3_key_input_file'],
+                                 local_file_path)
+                item = table.get_item(Key={'job_id': body['job_id']})['Item']
+                if item['job_status'] != 'PENDING':
+                    continue
+                table.update_item(
+                    Key={'job_id': body['job_id']},
+                    UpdateExpression='SET job_status = :new_status, user_id = :user',
+                    ConditionExpression='job_status = :current_status',
+                    ExpressionAttributeValues={':new_status': 'RUNNING', ':user': body['user_id'],
+                                               ':current_status': 'PENDING'}
+                )
+            except Exception:
+                continue
+            children.append(LocalChild(args.job_seconds))
+            sqs.delete_message(QueueUrl='bench', ReceiptHandle=message['ReceiptHandle'])
+
+
+def bench_engine(engine, args, results):
+    messages = make_messages(args.messages)
+    job_ids = [json.loads(json.loads(m['Body'])['Message'])['job_id'] for m in messages]
+    latency = args.latency_ms / 1000.0
+    table = LocalTable(job_ids, latency)
+    sqs = LocalSQS(messages, latency)
+    s3 = LocalS3(latency, args.download_ms / 1000.0, args.object_size)
+    work_dir = os.path.join(args.work_dir, engine)
+
+    # Silence the annotator's per-job output for the rest of this process
+    sys.stdout = open(os.devnull, 'w')
+    if engine == 'serial':
+        threading.Thread(target=serial_loop, args=(args, sqs, s3, table, work_dir),
+                         daemon=True).start()
+    else:
+        start_engine(engine, args, sqs, s3, table, work_dir)
+    start = time.time()
+    time.sleep(args.duration)
+    with table.lock:
+        admitted = len([t for t in table.claimed if t - start <= args.duration])
+    results.put((engine, admitted))
+    # The engine threads never return; exit without waiting for them
+    results.close()
+    results.join_thread()
+    os._exit(0)
+
+
+def start_engine(engine, args, sqs, s3, table, work_dir):
+    annotator.sqs = sqs
+    annotator.s3 = s3
+    annotator.jobs_table = lambda: table
+    annotator.engine = engine
+    annotator.execution_mode = 'subprocess'
+    annotator.result_cache.enabled = False
+    annotator.journal.enabled = False
+    annotator.metrics_enabled = False
+    annotator.job_info_dir = work_dir
+    annotator.supervisor.max_jobs = args.slots
+    # Measure raw admission, not the per-user fair-share limits
+    annotator.user_max_jobs = {'premium': 0, 'free': 0}
+    annotator.user_buffer_size = args.messages
+
+    def launch(job_id, message, local_file_path, user_id, digest='', download_seconds=None):
+        with annotator.supervisor.lock:
+            annotator.supervisor.reserved -= 1
+            annotator.supervisor.children[job_id] = (LocalChild(args.job_seconds), time.time(), message)
+    annotator.supervisor.launch = launch
+    threading.Thread(target=annotator.main, daemon=True).start()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Annotator engine admission benchmark')
+    parser.add_argument('--messages', type=int, default=2000)
+    parser.add_argument('--duration', type=float, default=30, help='seconds per engine')
+    parser.add_argument('--latency-ms', type=float, default=20, help='per AWS call')
+    parser.add_argument('--download-ms', type=float, default=200, help='per input download')
+    parser.add_argument('--object-size', type=int, default=1024)
+    parser.add_argument('--job-seconds', type=float, default=5)
+    parser.add_argument('--slots', type=int, default=64)
+    parser.add_argument('--work-dir', default='./bench_jobs')
+    parser.add_argument('--engines', default='serial,threads,asyncio',
+                        help='serial is the original one-message-at-a-time loop')
+    args = parser.parse_args()
+
+    # Each engine runs in its own process so neither sees the other's
+    # threads or module state
+    context = multiprocessing.get_context('fork')
+    results = context.Queue()
+    report = {}
+    for engine in args.engines.split(','):
+        worker = context.Process(target=bench_engine, args=(engine, args, results))
+        worker.start()
+        engine_name, admitted = results.get()
+        worker.join()
+        report[engine_name] = admitted * 60.0 / args.duration
+        print(f"{engine_name}: {admitted} jobs admitted in {args.duration:.0f}s "
+              f"({report[engine_name]:.1f} jobs/min)")
+    if report.get('serial'):
+        for engine_name in report:
+            if engine_name != 'serial':
+                print(f"{engine_name}: {report[engine_name] / report['serial']:.1f}x the serial loop")
+
+    print(json.dumps({'args': vars(args), 'jobs_per_minute': report}, indent=2))
+
+
+if __name__ == '__main__':
+    main()
+
+### EOF
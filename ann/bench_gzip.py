@@ -0,0 +1,175 @@
+# bench_gzip.py
+#
+# Compares end-to-end time of a gzip-compressed and a raw VCF input:
+# the user's upload, the annotator's download, the annotation
+# run.annotate actually performs (streamed for the compressed input) and
+# the results upload, all timed against a real S3 endpoint
+#
+# Transfers go to --endpoint-url, or [aws] endpoint_url_s3, or else a
+# local moto server started for the run; use MinIO or S3 itself for
+# figures that include the network. The download and results upload use
+# the annotator's own download_file_from_s3 and run.upload_file_to_s3.
+# The transfer time the same bytes would take at --bandwidth-mbps is
+# reported alongside, separately, as a modelled estimate only.
+#
+# Run from the ann directory (run.py reads ann_config.ini):
+#   python bench_gzip.py --records 500000 --bandwidth-mbps 100
+#
+##
+
+import os
+import sys
+import time
+import gzip
+import json
+import random
+import shutil
+import socket
+import argparse
+import subprocess
+
+import run
+import annotator
+import aws_clients
+
+BASES = 'ACGT'
+HEADER = ('##fileformat=VCFv4.1\n'
+          '#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n')
+
+
+def write_vcf(path, records, seed):
+    rng = random.Random(seed)
+    with open(path, 'w') as f:
+        f.write(HEADER)
+        pos = 0
+        for i in range(records):
+            pos += rng.randint(1, 2000)
+            ref, alt = rng.sample(BASES, 2)
+            f.write(f"chr{1 + i * 22 // records}\t{pos}\trs{rng.randint(1, 10 ** 8)}\t"
+                    f"{ref}\t{alt}\t{rng.randint(10, 99)}\tPASS\tDP={rng.randint(1, 200)}\n")
+
+
+def compress(path, gz_path, level):
+    with open(path, 'rb') as f, gzip.open(gz_path, 'wb', compresslevel=level) as out:
+        shutil.copyfileobj(f, out, 1024 * 1024)
+
+
+def start_moto_server():
+    # In its own process, so serving requests doesn't compete with the
+    # benchmark for the GIL
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+    server = subprocess.Popen([sys.executable, '-m', 'moto.server', '-H', '127.0.0.1', '-p', str(port)],
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return server, f"http://127.0.0.1:{port}"
+        except OSError:
+            time.sleep(0.1)
+    server.kill()
+    raise RuntimeError('moto server did not start')
+
+
+def use_endpoint(endpoint_url, bucket):
+    # The annotator's and run.py's transfers both go to endpoint_url
+    s3 = aws_clients.client('s3', run.config, endpoint_url=endpoint_url)
+    run.s3 = annotator.s3 = s3
+    try:
+        s3.head_bucket(Bucket=bucket)
+    except Exception:
+        s3.create_bucket(Bucket=bucket)
+    return s3
+
+
+def timed(fn, *args):
+    start = time.time()
+    if fn(*args) is False:
+        raise RuntimeError(f"{fn.__name__} failed")
+    return time.time() - start
+
+
+# Upload input_file_path as a user would, then download and annotate it
+# in its own job directory and upload the results, as run_job would
+def bench_input(name, input_file_path, s3, args):
+    job_dir = os.path.join(args.work_dir, name)
+    shutil.rmtree(job_dir, ignore_errors=True)
+    os.makedirs(job_dir)
+    path = os.path.join(job_dir, os.path.basename(input_file_path))
+    key = f"bench-gzip/{name}/{os.path.basename(input_file_path)}"
+
+    size = os.path.getsize(input_file_path)
+    upload_secs = timed(s3.upload_file, input_file_path, args.bucket, key)
+    download_secs = timed(annotator.download_file_from_s3, args.bucket, key, path)
+    annotate_secs = timed(run.annotate, path)
+    results_file, log_file = run.result_locations(path)[:2]
+    results_secs = timed(run.upload_file_to_s3, args.bucket, key + '.annot.vcf', results_file) + \
+        timed(run.upload_file_to_s3, args.bucket, key + '.count.log', log_file)
+
+    transferred = 2 * size + os.path.getsize(results_file) + os.path.getsize(log_file)
+    total_secs = upload_secs + download_secs + annotate_secs + results_secs
+    return {
+        'bytes': size,
+        'upload_seconds': round(upload_secs, 3),
+        'download_seconds': round(download_secs, 3),
+        'annotate_seconds': round(annotate_secs, 3),
+        'results_upload_seconds': round(results_secs, 3),
+        'total_seconds': round(total_secs, 3),
+        # Not measured: the same bytes at --bandwidth-mbps
+        'estimated_transfer_seconds': round(transferred * 8 / (args.bandwidth_mbps * 1000 * 1000), 3)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compressed vs raw input benchmark')
+    parser.add_argument('--records', type=int, default=500000)
+    parser.add_argument('--bandwidth-mbps', type=float, default=100,
+                        help='bandwidth for the modelled transfer estimate')
+    parser.add_argument('--endpoint-url', default=None,
+                        help='S3 endpoint (default [aws] endpoint_url_s3, else a local moto server)')
+    parser.add_argument('--bucket', default='bench-gzip')
+    parser.add_argument('--level', type=int, default=6, help='gzip compression level')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--work-dir', default='./bench_gzip')
+    args = parser.parse_args()
+
+    os.makedirs(args.work_dir, exist_ok=True)
+    raw_path = os.path.join(args.work_dir, 'bench.vcf')
+    gz_path = raw_path + '.gz'
+    write_vcf(raw_path, args.records, args.seed)
+    compress(raw_path, gz_path, args.level)
+
+    server = None
+    endpoint_url = args.endpoint_url or run.config.get('aws', 'endpoint_url_s3', fallback='')
+    if not endpoint_url:
+        server, endpoint_url = start_moto_server()
+        for name in ('AWS_ACCESS_KEY_ID', 'AWS_SECRET_ACCESS_KEY'):
+            os.environ.setdefault(name, 'bench')
+    args.endpoint_url = endpoint_url
+
+    report = {}
+    try:
+        s3 = use_endpoint(endpoint_url, args.bucket)
+        for name, path in [('raw', raw_path), ('gzip', gz_path)]:
+            result = report[name] = bench_input(name, path, s3, args)
+            print(f"{name}: {result['bytes']} bytes, upload {result['upload_seconds']:.2f}s + "
+                  f"download {result['download_seconds']:.2f}s + annotate "
+                  f"{result['annotate_seconds']:.2f}s + results {result['results_upload_seconds']:.2f}s = "
+                  f"{result['total_seconds']:.2f}s measured "
+                  f"(estimate at {args.bandwidth_mbps:g} Mbps: transfers "
+                  f"{result['estimated_transfer_seconds']:.2f}s)")
+    finally:
+        if server is not None:
+            server.kill()
+
+    report['compression_ratio'] = round(report['raw']['bytes'] / report['gzip']['bytes'], 2)
+    report['speedup'] = round(report['raw']['total_seconds'] / report['gzip']['total_seconds'], 2)
+    print(json.dumps({'args': vars(args), 'results': report}, indent=2))
+
+
+if __name__ == '__main__':
+    main()
+
+### EOF
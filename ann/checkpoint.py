@@ -0,0 +1,129 @@
+# checkpoint.py
+#
+# S3 checkpoints of sharded annotation runs
+#
+# While a sharded job runs, every finished shard's .annot.vcf and
+# .count.log are uploaded under the job's result prefix
+# (<prefix>/checkpoints/), next to a manifest of the shard boundaries and
+# the shards done. An annotator that picks up the redelivered message of
+# an interrupted job, e.g. one whose spot instance was reclaimed,
+# downloads the finished shards and annotates only the rest. The
+# checkpoint is deleted once the job completes.
+#
+##
+
+import os
+import json
+import time
+import threading
+from botocore.exceptions import ClientError
+from configparser import ConfigParser
+
+import result_cache
+
+# Shared AWS clients (util/aws_clients.py)
+import util_path
+import aws_clients
+
+# Reference: https://boto3.amazonaws.com/v1/documentation/api/latest/index.html
+
+# Get configuration
+config = ConfigParser()
+config.read('ann_config.ini')
+
+s3_results_bucket = config.get('aws', 's3_results_bucket')
+enabled = config.getboolean('checkpoint', 'enabled', fallback=True)
+
+s3 = aws_clients.client('s3', config)
+
+MANIFEST_NAME = 'manifest.json'
+
+
+def checkpoint_prefix(s3_key_results_file):
+    return s3_key_results_file.rsplit('/', 1)[0] + '/checkpoints/'
+
+
+class Checkpoint(object):
+    """Checkpoint of one job's sharded run
+
+    Upload failures are printed and otherwise ignored: a checkpoint only
+    saves work, the run never depends on it.
+    """
+    def __init__(self, s3_key_results_file):
+        self.prefix = checkpoint_prefix(s3_key_results_file)
+        self.lock = threading.Lock()
+        self.manifest = None
+
+    def shard_key(self, index, suffix):
+        return f"{self.prefix}shard_{index:04d}{suffix}"
+
+    """Returns the manifest an earlier run of the same input left, or None
+    The input digest (which covers the reference version) must match, so
+    a checkpoint is never applied to different records.
+    """
+    def resume(self, input_file_path):
+        self.digest = result_cache.content_digest(input_file_path)
+        try:
+            response = s3.get_object(Bucket=s3_results_bucket, Key=self.prefix + MANIFEST_NAME)
+            manifest = json.loads(response['Body'].read())
+        except ClientError as e:
+            if e.response['Error']['Code'] not in ('NoSuchKey', '404'):
+                print(f"Failed to read checkpoint {self.prefix}: {str(e)}")
+            return None
+        except Exception as e:
+            print(f"Failed to read checkpoint {self.prefix}: {str(e)}")
+            return None
+        if manifest.get('input_digest') != self.digest:
+            print(f"Ignoring checkpoint {self.prefix}: it was made for a different input")
+            return None
+        return manifest
+
+    def fetch_shard(self, index, results_path, log_path):
+        try:
+            s3.download_file(s3_results_bucket, self.shard_key(index, '.annot.vcf'), results_path)
+            s3.download_file(s3_results_bucket, self.shard_key(index, '.count.log'), log_path)
+            return True
+        except Exception as e:
+            print(f"Failed to fetch checkpointed shard {index}: {str(e)}")
+            return False
+
+    def start(self, boundaries, done):
+        with self.lock:
+            self.manifest = {'input_digest': self.digest, 'boundaries': boundaries,
+                             'done': sorted(done)}
+            self.write_manifest()
+
+    # The shard's outputs go up before the manifest names it as done
+    def save_shard(self, index, results_path, log_path):
+        try:
+            s3.upload_file(results_path, s3_results_bucket, self.shard_key(index, '.annot.vcf'))
+            s3.upload_file(log_path, s3_results_bucket, self.shard_key(index, '.count.log'))
+        except Exception as e:
+            print(f"Failed to checkpoint shard {index}: {str(e)}")
+            return
+        with self.lock:
+            self.manifest['done'] = sorted(self.manifest['done'] + [index])
+            self.write_manifest()
+
+    def write_manifest(self):
+        self.manifest['updated'] = int(time.time())
+        try:
+            s3.put_object(Bucket=s3_results_bucket, Key=self.prefix + MANIFEST_NAME,
+                          Body=json.dumps(self.manifest).encode('utf-8'))
+        except Exception as e:
+            print(f"Failed to write checkpoint manifest {self.prefix}: {str(e)}")
+
+
+# Delete a job's checkpoint, if it has one
+def clear(s3_key_results_file):
+    prefix = checkpoint_prefix(s3_key_results_file)
+    try:
+        paginator = s3.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=s3_results_bucket, Prefix=prefix):
+            keys = [{'Key': obj['Key']} for obj in page.get('Contents', [])]
+            if keys:
+                s3.delete_objects(Bucket=s3_results_bucket, Delete={'Objects': keys})
+    except Exception as e:
+        print(f"Failed to delete checkpoint {prefix}: {str(e)}")
+
+### EOF
@@ -0,0 +1,471 @@
+# distributed.py
+#
+# Multi-node annotation of a single huge job
+#
+# The annotator that claims an oversized job splits it into shards,
+# uploads them to S3 and records one work item per shard in a DynamoDB
+# lease table. Any annotator with a free job slot leases a shard,
+# annotates it and uploads its partial results; the last shard to finish
+# turns the job's manifest item into a merge work item, and whoever
+# leases that merges every shard's output and completes the job the way
+# run.py does.
+#
+# Usage:
+#   python distributed.py create-table       # once, creates the lease table
+#   python distributed.py work                # stand-alone shard worker
+#   python distributed.py run <job_id> <shard_no> <owner>
+#                                             # one leased item (annotator child)
+#   python distributed.py status <job_id>
+#
+# For local testing point [aws] endpoint_url_dynamodb and endpoint_url_s3
+# at DynamoDB Local and an S3 stand-in (e.g. MinIO), create the table and
+# run several annotators (or `work` processes), each from its own copy
+# of this directory so their job_info_dirs don't collide.
+#
+##
+
+import os
+import sys
+import time
+import math
+import shutil
+import socket
+import threading
+from configparser import ConfigParser
+
+import run
+import shard
+import result_cache
+
+# Shared AWS clients (util/aws_clients.py)
+import util_path
+import aws_clients
+
+# Reference: https://boto3.amazonaws.com/v1/documentation/api/latest/index.html
+
+# Get configuration
+config = ConfigParser()
+config.read('ann_config.ini')
+
+s3_results_bucket = config.get('aws', 's3_results_bucket')
+dynamodb_table_name = config.get('aws', 'dynamodb_table_name')
+job_info_dir = config.get('paths', 'job_info_dir')
+cnet_id = config.get('info', 'cnet_id')
+
+enabled = config.getboolean('distributed', 'enabled', fallback=False)
+shard_table_name = config.get('distributed', 'shard_table_name',
+                              fallback=f"{dynamodb_table_name}_shards")
+min_size = config.getint('distributed', 'min_size_mb', fallback=2048) * 1024 * 1024
+shard_size = config.getint('distributed', 'shard_size_mb', fallback=256) * 1024 * 1024
+lease_seconds = config.getint('distributed', 'lease_seconds', fallback=300)
+max_attempts = config.getint('distributed', 'max_attempts', fallback=3)
+poll_interval = config.getfloat('distributed', 'poll_interval', fallback=5)
+# Expected uncompressed size of a .gz/.bgz input relative to its size in S3
+compressed_ratio = config.getfloat('input', 'compressed_ratio', fallback=4.0)
+
+s3 = aws_clients.client('s3', config)
+
+# The manifest item of a job sorts before its shards
+MANIFEST = -1
+CLAIMABLE_INDEX = 'claimable-lease_expires-index'
+
+
+# DynamoDB resources aren't thread-safe, so each thread gets its own
+def shard_table():
+    return aws_clients.resource('dynamodb', config).Table(shard_table_name)
+
+
+def jobs_table():
+    return aws_clients.resource('dynamodb', config).Table(dynamodb_table_name)
+
+
+def create_table():
+    aws_clients.resource('dynamodb', config).create_table(
+        TableName=shard_table_name,
+        KeySchema=[
+            {'AttributeName': 'job_id', 'KeyType': 'HASH'},
+            {'AttributeName': 'shard_no', 'KeyType': 'RANGE'}
+        ],
+        AttributeDefinitions=[
+            {'AttributeName': 'job_id', 'AttributeType': 'S'},
+            {'AttributeName': 'shard_no', 'AttributeType': 'N'},
+            {'AttributeName': 'claimable', 'AttributeType': 'S'},
+            {'AttributeName': 'lease_expires', 'AttributeType': 'N'}
+        ],
+        # Sparse index: only items some annotator may still have to work
+        # on carry 'claimable', ordered by when their lease runs out
+        GlobalSecondaryIndexes=[{
+            'IndexName': CLAIMABLE_INDEX,
+            'KeySchema': [
+                {'AttributeName': 'claimable', 'KeyType': 'HASH'},
+                {'AttributeName': 'lease_expires', 'KeyType': 'RANGE'}
+            ],
+            'Projection': {'ProjectionType': 'KEYS_ONLY'}
+        }],
+        BillingMode='PAY_PER_REQUEST'
+    )
+    print(f"Created shard lease table {shard_table_name}")
+
+
+# A compressed input is sized as the VCF its shards are split from
+def wanted(input_file_path):
+    size = os.path.getsize(input_file_path)
+    if run.vcf_path(input_file_path) != input_file_path:
+        size *= compressed_ratio
+    return enabled and size >= min_size
+
+
+def shard_key(job_id, shard_no, suffix='.vcf'):
+    return f"{cnet_id}/shards/{job_id}/shard_{shard_no:04d}{suffix}"
+
+
+def shard_dir(job_id):
+    return os.path.join(job_info_dir, job_id, 'shards')
+
+
+def work_dir(job_id, shard_no):
+    # Shards of one job may run side by side on the same annotator
+    return os.path.join(job_info_dir, job_id, f"shard_{shard_no:04d}")
+
+
+"""Disk a leased item needs before workspace_factor: one shard's input,
+or for a merge every shard's results
+"""
+def item_size(job_id, shard_no):
+    if shard_no != MANIFEST:
+        return shard_size
+    manifest = shard_table().get_item(Key={'job_id': job_id, 'shard_no': MANIFEST})['Item']
+    return int(manifest['shard_count']) * shard_size
+
+
+def job_items(job_id):
+    return shard_table().query(
+        KeyConditionExpression='job_id = :job_id',
+        ExpressionAttributeValues={':job_id': job_id},
+        ConsistentRead=True
+    )['Items']
+
+
+"""Split a claimed job's input into shard work items
+The job stays RUNNING in the annotations table until the merge
+completes it.
+"""
+def submit(job_id, user_id, local_file_path, digest=''):
+    # Shards are byte ranges of the uncompressed VCF
+    vcf_path = run.vcf_path(local_file_path)
+    if vcf_path != local_file_path:
+        run.decompress(local_file_path, vcf_path)
+        os.remove(local_file_path)
+        local_file_path = vcf_path
+    count = max(1, math.ceil(os.path.getsize(local_file_path) / shard_size))
+    paths = shard.split(local_file_path, shard_dir(job_id), count)
+    for shard_no, path in enumerate(paths):
+        s3.upload_file(path, s3_results_bucket, shard_key(job_id, shard_no))
+        os.remove(path)
+
+    # A redelivered job starts over: drop what an earlier attempt wrote
+    with shard_table().batch_writer() as batch:
+        for item in job_items(job_id):
+            batch.delete_item(Key={'job_id': job_id, 'shard_no': item['shard_no']})
+
+    # Manifest first, so every finished shard has a count to add to
+    shard_table().put_item(Item={
+        'job_id': job_id,
+        'shard_no': MANIFEST,
+        'shard_status': 'OPEN',
+        'user_id': user_id,
+        'input_name': os.path.basename(local_file_path),
+        'digest': digest or '',
+        'shard_count': len(paths),
+        'done_count': 0,
+        'attempts': 0,
+        'submit_time': int(time.time())
+    })
+    with shard_table().batch_writer() as batch:
+        for shard_no in range(len(paths)):
+            batch.put_item(Item={
+                'job_id': job_id,
+                'shard_no': shard_no,
+                'shard_status': 'PENDING',
+                'claimable': 'Y',
+                'lease_expires': 0,
+                'attempts': 0
+            })
+    print(f"Job {job_id} split into {len(paths)} distributed shards")
+    return len(paths)
+
+
+"""Lease the next shard or merge whose lease is free or has expired
+Items for which admit(job_id, shard_no), when given, returns False are
+left to other annotators. Returns (job_id, shard_no) or None.
+"""
+def claim(owner, admit=None):
+    now = int(time.time())
+    response = shard_table().query(
+        IndexName=CLAIMABLE_INDEX,
+        KeyConditionExpression='claimable = :y AND lease_expires < :now',
+        ExpressionAttributeValues={':y': 'Y', ':now': now},
+        Limit=25
+    )
+    for item in response.get('Items', []):
+        if admit is not None and not admit(item['job_id'], int(item['shard_no'])):
+            continue
+        try:
+            leased = shard_table().update_item(
+                Key={'job_id': item['job_id'], 'shard_no': item['shard_no']},
+                UpdateExpression='SET lease_owner = :owner, lease_expires = :expires, '
+                                 'attempts = attempts + :one',
+                ConditionExpression='claimable = :y AND lease_expires < :now',
+                ExpressionAttributeValues={
+                    ':owner': owner,
+                    ':expires': now + lease_seconds,
+                    ':one': 1,
+                    ':y': 'Y',
+                    ':now': now
+                },
+                ReturnValues='ALL_NEW'
+            )['Attributes']
+        except Exception:
+            # Another annotator got there first
+            continue
+        if leased['attempts'] > max_attempts:
+            fail_job(item['job_id'], f"Shard {int(item['shard_no'])} failed {max_attempts} times")
+            continue
+        return item['job_id'], int(item['shard_no'])
+    return None
+
+
+class Lease(object):
+    """Renews a held lease every lease_seconds / 3 until the block exits"""
+    def __init__(self, job_id, shard_no, owner):
+        self.key = {'job_id': job_id, 'shard_no': shard_no}
+        self.owner = owner
+        self.done = threading.Event()
+
+    def renew(self):
+        while not self.done.wait(lease_seconds / 3):
+            try:
+                shard_table().update_item(
+                    Key=self.key,
+                    UpdateExpression='SET lease_expires = :expires',
+                    ConditionExpression='lease_owner = :owner',
+                    ExpressionAttributeValues={
+                        ':expires': int(time.time()) + lease_seconds,
+                        ':owner': self.owner
+                    }
+                )
+            except Exception as e:
+                print(f"Failed to renew lease on {self.key}: {str(e)}")
+
+    def __enter__(self):
+        threading.Thread(target=self.renew, daemon=True).start()
+        return self
+
+    def __exit__(self, *args):
+        self.done.set()
+
+
+def release(job_id, shard_no, owner):
+    # Make the item claimable again straight away
+    try:
+        shard_table().update_item(
+            Key={'job_id': job_id, 'shard_no': shard_no},
+            UpdateExpression='SET lease_expires = :zero',
+            ConditionExpression='lease_owner = :owner',
+            ExpressionAttributeValues={':zero': 0, ':owner': owner}
+        )
+    except Exception as e:
+        print(f"Failed to release lease on {job_id}/{shard_no}: {str(e)}")
+
+
+def delete_shard_objects(job_id):
+    paginator = s3.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=s3_results_bucket, Prefix=f"{cnet_id}/shards/{job_id}/"):
+        keys = [{'Key': obj['Key']} for obj in page.get('Contents', [])]
+        if keys:
+            s3.delete_objects(Bucket=s3_results_bucket, Delete={'Objects': keys})
+
+
+def fail_job(job_id, reason):
+    # Nothing of a failed job is worth working on any more
+    for item in job_items(job_id):
+        shard_table().update_item(
+            Key={'job_id': job_id, 'shard_no': item['shard_no']},
+            UpdateExpression='REMOVE claimable'
+        )
+    shard_table().update_item(
+        Key={'job_id': job_id, 'shard_no': MANIFEST},
+        UpdateExpression='SET shard_status = :failed',
+        ExpressionAttributeValues={':failed': 'FAILED'}
+    )
+    jobs_table().update_item(
+        Key={'job_id': job_id},
+        UpdateExpression='SET job_status = :failed, failure_reason = :reason',
+        ExpressionAttributeValues={':failed': 'FAILED', ':reason': reason}
+    )
+    delete_shard_objects(job_id)
+    print(f"Distributed job {job_id} failed: {reason}")
+
+
+"""Annotate one leased shard and upload its partial results
+The shard is marked DONE and counted on the manifest in one
+transaction, which for the job's last shard also makes the merge
+claimable. Returns True if this was the job's last shard.
+"""
+def run_shard(job_id, shard_no, owner):
+    local_dir = work_dir(job_id, shard_no)
+    os.makedirs(local_dir, exist_ok=True)
+    path = os.path.join(local_dir, f"shard_{shard_no:04d}.vcf")
+    s3.download_file(s3_results_bucket, shard_key(job_id, shard_no), path)
+
+    run.annotate(path)
+    s3.upload_file(path.replace('.vcf', '.annot.vcf'), s3_results_bucket,
+                   shard_key(job_id, shard_no, '.annot.vcf'))
+    s3.upload_file(path + '.count.log', s3_results_bucket,
+                   shard_key(job_id, shard_no, '.vcf.count.log'))
+    run.delete_local_file(local_dir)
+
+    # The count is only bumped from the value read, so exactly one
+    # finisher sees the last shard and, in the same transaction, turns the
+    # manifest into a merge item. Were that a second step, a finisher
+    # dying in between would leave the job RUNNING for good. The merge is
+    # leased like any shard, by an annotator with the disk space for it.
+    manifest_key = {'job_id': job_id, 'shard_no': MANIFEST}
+    while True:
+        manifest = shard_table().get_item(Key=manifest_key, ConsistentRead=True)['Item']
+        done, count = int(manifest['done_count']), int(manifest['shard_count'])
+        last = done + 1 >= count
+        update = 'SET done_count = :next'
+        values = {':next': done + 1, ':seen': done, ':open': 'OPEN'}
+        if last:
+            update += ', shard_status = :merge, claimable = :y, lease_expires = :zero ' \
+                      'REMOVE lease_owner'
+            values.update({':merge': 'MERGE', ':y': 'Y', ':zero': 0})
+        try:
+            aws_clients.resource('dynamodb', config).meta.client.transact_write_items(TransactItems=[
+                {'Update': {
+                    'TableName': shard_table_name,
+                    'Key': {'job_id': job_id, 'shard_no': shard_no},
+                    'UpdateExpression': 'SET shard_status = :done REMOVE claimable',
+                    'ConditionExpression': 'lease_owner = :owner AND shard_status = :pending',
+                    'ExpressionAttributeValues': {':done': 'DONE', ':owner': owner, ':pending': 'PENDING'}
+                }},
+                {'Update': {
+                    'TableName': shard_table_name,
+                    'Key': manifest_key,
+                    'UpdateExpression': update,
+                    'ConditionExpression': 'shard_status = :open AND done_count = :seen',
+                    'ExpressionAttributeValues': values
+                }}
+            ])
+            break
+        except Exception:
+            # Try again only if another shard was counted meanwhile
+            current = shard_table().get_item(Key=manifest_key, ConsistentRead=True).get('Item', {})
+            if current.get('shard_status') != 'OPEN' or current.get('done_count') == done:
+                raise
+    print(f"Shard {shard_no} of job {job_id} done ({done + 1}/{count})")
+    return last
+
+
+"""Merge every shard's results in order and complete the job
+"""
+def merge(job_id, owner):
+    manifest = shard_table().get_item(Key={'job_id': job_id, 'shard_no': MANIFEST},
+                              ConsistentRead=True)['Item']
+    count = int(manifest['shard_count'])
+    local_dir = shard_dir(job_id)
+    os.makedirs(local_dir, exist_ok=True)
+
+    results, logs = [], []
+    for shard_no in range(count):
+        path = os.path.join(local_dir, f"shard_{shard_no:04d}.vcf")
+        s3.download_file(s3_results_bucket, shard_key(job_id, shard_no, '.annot.vcf'),
+                         path.replace('.vcf', '.annot.vcf'))
+        s3.download_file(s3_results_bucket, shard_key(job_id, shard_no, '.vcf.count.log'),
+                         path + '.count.log')
+        results.append(path.replace('.vcf', '.annot.vcf'))
+        logs.append(path + '.count.log')
+
+    input_file_path = os.path.join(job_info_dir, job_id, manifest['input_name'])
+    results_file, log_file, s3_key_results_file, s3_key_log_file = \
+        run.result_locations(input_file_path)
+    shard.merge_results(results, results_file)
+    shard.merge_logs(logs, log_file)
+
+    if not (run.upload_file_to_s3(run.s3_results_bucket, s3_key_results_file, results_file) and
+            run.upload_file_to_s3(run.s3_results_bucket, s3_key_log_file, log_file)):
+        raise RuntimeError(f"Failed to upload merged results of job {job_id}")
+    if result_cache.enabled and manifest.get('digest'):
+        result_cache.store(manifest['digest'], s3_key_results_file, run.job_log(log_file))
+    profile = run.Profile()
+    result_summary = run.summarize_results(job_id, results_file, profile)
+    run.delete_local_file(os.path.join(job_info_dir, job_id))
+
+    run.complete_job(job_id, manifest['user_id'], s3_key_results_file, s3_key_log_file,
+                     profile, result_summary)
+    shard_table().update_item(
+        Key={'job_id': job_id, 'shard_no': MANIFEST},
+        UpdateExpression='SET shard_status = :completed REMOVE claimable',
+        ExpressionAttributeValues={':completed': 'COMPLETED'}
+    )
+    delete_shard_objects(job_id)
+    with shard_table().batch_writer() as batch:
+        for shard_no in range(count):
+            batch.delete_item(Key={'job_id': job_id, 'shard_no': shard_no})
+    print(f"Distributed job {job_id} merged from {count} shards and completed")
+
+
+"""Work on one leased item: a shard, or a job's merge once all its
+shards are done. Returns True on success; on failure the lease is
+released for another attempt.
+"""
+def process(job_id, shard_no, owner):
+    try:
+        with Lease(job_id, shard_no, owner):
+            if shard_no == MANIFEST:
+                merge(job_id, owner)
+            else:
+                run_shard(job_id, shard_no, owner)
+        return True
+    except Exception as e:
+        print(f"Failed to process {job_id}/{shard_no}: {str(e)}")
+        shutil.rmtree(work_dir(job_id, shard_no), ignore_errors=True)
+        release(job_id, shard_no, owner)
+        return False
+
+
+def default_owner():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def work(owner):
+    while True:
+        leased = claim(owner)
+        if leased is None:
+            time.sleep(poll_interval)
+            continue
+        process(leased[0], leased[1], owner)
+
+
+def status(job_id):
+    for item in job_items(job_id):
+        print(f"{int(item['shard_no']):>5} {item['shard_status']:<9} "
+              f"attempts={int(item.get('attempts', 0))} owner={item.get('lease_owner', '-')}")
+
+
+if __name__ == '__main__':
+    command = sys.argv[1] if len(sys.argv) > 1 else ''
+    if command == 'create-table':
+        create_table()
+    elif command == 'work':
+        work(default_owner())
+    elif command == 'run' and len(sys.argv) > 4:
+        sys.exit(0 if process(sys.argv[2], int(sys.argv[3]), sys.argv[4]) else 1)
+    elif command == 'status' and len(sys.argv) > 2:
+        status(sys.argv[2])
+    else:
+        print("Usage: distributed.py create-table | work | run <job_id> <shard_no> <owner> | status <job_id>")
+        sys.exit(1)
+
+### EOF
@@ -0,0 +1,185 @@
+# journal.py
+#
+# Crash-safe journal of the jobs this annotator has in flight
+#
+# Every job that has been downloaded gets a row in a local SQLite store
+# (WAL mode, so the annotator and its run.py children write it
+# concurrently) recording how far it got: downloaded, launched,
+# annotated or uploaded. After a restart the annotator reads the journal
+# back and resumes each job from its last completed stage, reusing the
+# input and results already on disk.
+#
+##
+
+import os
+import json
+import time
+import sqlite3
+import threading
+from configparser import ConfigParser
+
+# Get configuration
+config = ConfigParser()
+config.read('ann_config.ini')
+
+enabled = config.getboolean('journal', 'enabled', fallback=True)
+db_path = config.get('journal', 'path', fallback='./annotator_journal.db')
+expire_seconds = config.getint('journal', 'expire_seconds', fallback=3600)
+
+STAGES = ['downloaded', 'launched', 'annotated', 'uploaded']
+COLUMNS = ['job_id', 'message_id', 'queue_url', 'receipt_handle', 'user_id', 'tier',
+           'local_file_path', 'input_size', 'workspace', 'digest', 'stage', 'pid', 'updated',
+           'timings']
+
+_local = threading.local()
+
+
+def get_db():
+    # One connection per thread, as add_timings and take_timings run
+    # transactions from the annotator's upload threads and its main
+    # thread at once; pool workers are forked so never reuse a parent's
+    # connection
+    db = getattr(_local, 'db', None)
+    if db is None or getattr(_local, 'pid', None) != os.getpid():
+        db = sqlite3.connect(db_path, timeout=60, isolation_level=None)
+        db.execute('PRAGMA journal_mode=WAL')
+        # A stage is only worth recording if it survives a power cut
+        db.execute('PRAGMA synchronous=FULL')
+        db.execute('CREATE TABLE IF NOT EXISTS jobs ('
+                   'job_id TEXT PRIMARY KEY, message_id TEXT, queue_url TEXT, '
+                   'receipt_handle TEXT, user_id TEXT, tier TEXT, local_file_path TEXT, '
+                   'input_size INTEGER, workspace INTEGER, digest TEXT, stage TEXT, '
+                   'pid INTEGER, updated INTEGER, timings TEXT)')
+        # Journals written before timings were kept
+        if 'timings' not in [row[1] for row in db.execute('PRAGMA table_info(jobs)')]:
+            db.execute('ALTER TABLE jobs ADD COLUMN timings TEXT')
+        _local.db = db
+        _local.pid = os.getpid()
+    return db
+
+
+"""Journal a job whose input is on disk, replacing any earlier attempt
+"""
+def record(job, message, workspace):
+    if not enabled:
+        return
+    get_db().execute(
+        'INSERT OR REPLACE INTO jobs (%s) VALUES (%s)'
+        % (', '.join(COLUMNS), ', '.join('?' * len(COLUMNS))),
+        (job['job_id'], message['MessageId'], message['QueueUrl'], message['ReceiptHandle'],
+         job['user_id'], job['tier'], job['local_file_path'],
+         os.path.getsize(job['local_file_path']), workspace, '', 'downloaded', None,
+         int(time.time()), None))
+
+
+"""Move a job forward to stage; a job never moves back, as the annotator
+and the job's child record stages concurrently
+"""
+def advance(job_id, stage, pid=None, digest=None):
+    if not enabled:
+        return
+    order = ' '.join(f"WHEN '{s}' THEN {i}" for i, s in enumerate(STAGES))
+    get_db().execute(
+        f"UPDATE jobs SET stage = CASE WHEN (CASE stage {order} END) < ? THEN ? ELSE stage END, "
+        'pid = COALESCE(?, pid), digest = COALESCE(?, digest), updated = ? WHERE job_id = ?',
+        (STAGES.index(stage), stage, pid, digest, int(time.time()), job_id))
+
+
+# A redelivered message for a journaled job takes over its row
+def rebind(job_id, message):
+    if not enabled:
+        return
+    get_db().execute(
+        'UPDATE jobs SET message_id = ?, queue_url = ?, receipt_handle = ?, updated = ? '
+        'WHERE job_id = ?',
+        (message['MessageId'], message['QueueUrl'], message['ReceiptHandle'],
+         int(time.time()), job_id))
+
+
+"""Add to the durations and byte counts a job's child reports back to
+the annotator, e.g. add_timings(job_id, annotate=12.5)
+"""
+def add_timings(job_id, **values):
+    if not enabled:
+        return
+    db = get_db()
+    db.execute('BEGIN IMMEDIATE')
+    try:
+        row = db.execute('SELECT timings FROM jobs WHERE job_id = ?', (job_id,)).fetchone()
+        if row is not None:
+            timings = json.loads(row[0] or '{}')
+            for name, value in values.items():
+                timings[name] = timings.get(name, 0) + value
+            db.execute('UPDATE jobs SET timings = ? WHERE job_id = ?',
+                       (json.dumps(timings), job_id))
+        db.execute('COMMIT')
+    except Exception:
+        db.execute('ROLLBACK')
+        raise
+
+
+# Returns the timings reported since the last call and clears them
+def take_timings(job_id):
+    if not enabled:
+        return {}
+    db = get_db()
+    db.execute('BEGIN IMMEDIATE')
+    try:
+        row = db.execute('SELECT timings FROM jobs WHERE job_id = ?', (job_id,)).fetchone()
+        db.execute('UPDATE jobs SET timings = NULL WHERE job_id = ?', (job_id,))
+        db.execute('COMMIT')
+    except Exception:
+        db.execute('ROLLBACK')
+        raise
+    return json.loads(row[0]) if row and row[0] else {}
+
+
+def remove(job_id):
+    if enabled:
+        get_db().execute('DELETE FROM jobs WHERE job_id = ?', (job_id,))
+
+
+def entries():
+    if not enabled:
+        return []
+    rows = get_db().execute('SELECT %s FROM jobs ORDER BY updated' % ', '.join(COLUMNS))
+    return [dict(zip(COLUMNS, row)) for row in rows]
+
+
+def get(job_id):
+    if not enabled:
+        return None
+    row = get_db().execute('SELECT %s FROM jobs WHERE job_id = ?' % ', '.join(COLUMNS),
+                           (job_id,)).fetchone()
+    return dict(zip(COLUMNS, row)) if row else None
+
+
+def reached(job_id, stage):
+    entry = get(job_id)
+    return entry is not None and STAGES.index(entry['stage']) >= STAGES.index(stage)
+
+
+"""True if a journaled input for job_id is complete on disk, so a
+redelivered message can skip the download
+"""
+def has_input(job_id, local_file_path, size):
+    entry = get(job_id)
+    return (entry is not None and entry['local_file_path'] == local_file_path and
+            entry['input_size'] == size and os.path.isfile(local_file_path) and
+            os.path.getsize(local_file_path) == size)
+
+
+"""True while the journaled child process of a job is still running
+Only subprocess children outlive the annotator; the pid is matched
+against the job so a recycled pid is never mistaken for it.
+"""
+def child_alive(entry):
+    if not entry['pid']:
+        return False
+    try:
+        with open(f"/proc/{entry['pid']}/cmdline", 'rb') as f:
+            return entry['job_id'].encode('utf-8') in f.read()
+    except OSError:
+        return False
+
+### EOF
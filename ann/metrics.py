@@ -0,0 +1,176 @@
+# metrics.py
+#
+# Prometheus-style metrics for the annotator
+#
+# Counters, gauges and histograms kept in the annotator process and
+# served in the Prometheus text exposition format on /metrics by a small
+# http.server thread, for a Prometheus server or the CloudWatch agent to
+# scrape.
+#
+##
+
+import math
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+registry = []
+
+
+def format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = [(n, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+               for n, v in pairs]
+    return '{' + ','.join(f'{n}="{v}"' for n, v in escaped) + '}'
+
+
+def format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric(object):
+    """A named family of samples, one per combination of label values"""
+    kind = 'untyped'
+
+    def __init__(self, name, help, labels=()):
+        self.lock = threading.Lock()
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values = {}
+        # Unlabelled series exist, at zero, from the start
+        if not self.labels:
+            self.values[()] = self.zero()
+        registry.append(self)
+
+    def zero(self):
+        return 0
+
+    def key(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.labels)
+
+    def samples(self):
+        with self.lock:
+            return [(self.name, key, (), value) for key, value in sorted(self.values.items())]
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for name, key, extra, value in self.samples():
+            lines.append(f"{name}{format_labels(self.labels, key, extra)} {format_value(value)}")
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    """Incremented directly; for a counter with one label, function can
+    add counts kept elsewhere at every scrape, as {label value: count}"""
+    kind = 'counter'
+
+    def __init__(self, name, help, labels=(), function=None):
+        super().__init__(name, help, labels)
+        self.function = function
+
+    def inc(self, amount=1, **labels):
+        with self.lock:
+            key = self.key(labels)
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        samples = super().samples()
+        if self.function is None:
+            return samples
+        try:
+            counts = self.function()
+        except Exception as e:
+            print(f"Failed to read metric {self.name}: {str(e)}")
+            return samples
+        totals = {key: value for name, key, extra, value in samples}
+        for label, count in counts.items():
+            totals[(str(label),)] = totals.get((str(label),), 0) + count
+        return [(self.name, key, (), value) for key, value in sorted(totals.items())]
+
+
+class Gauge(Metric):
+    """Set directly, or read from function at every scrape"""
+    kind = 'gauge'
+
+    def __init__(self, name, help, labels=(), function=None):
+        super().__init__(name, help, labels)
+        self.function = function
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[self.key(labels)] = value
+
+    def samples(self):
+        if self.function is not None:
+            try:
+                self.set(self.function())
+            except Exception as e:
+                print(f"Failed to read metric {self.name}: {str(e)}")
+        return super().samples()
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, buckets, labels=()):
+        self.buckets = sorted(buckets) + [math.inf]
+        super().__init__(name, help, labels)
+
+    def zero(self):
+        return ([0] * len(self.buckets), 0.0)
+
+    def observe(self, value, **labels):
+        with self.lock:
+            key = self.key(labels)
+            counts, total = self.values.get(key, self.zero())
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self.values[key] = (counts, total + value)
+
+    def samples(self):
+        with self.lock:
+            samples = []
+            for key, (counts, total) in sorted(self.values.items()):
+                for bound, count in zip(self.buckets, counts):
+                    samples.append((f"{self.name}_bucket", key, [('le', format_value(bound))], count))
+                samples.append((f"{self.name}_sum", key, (), total))
+                samples.append((f"{self.name}_count", key, (), counts[-1]))
+            return samples
+
+
+def render():
+    return '\n'.join(metric.render() for metric in registry) + '\n'
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes every few seconds would drown the annotator's own output
+        pass
+
+
+def serve(host, port):
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"Serving metrics on http://{host}:{port}/metrics")
+    return server
+
+### EOF
@@ -0,0 +1,232 @@
+# progress.py
+#
+# Progressive results of long-running jobs
+#
+# While AnnTools runs, a watcher thread reads the complete records
+# written to the job's output so far and uploads them to S3 in ordered
+# parts under the job's result prefix (<prefix>/partial/), header first.
+# Every upload records on the job item how many parts there are, how
+# many records they hold and the percentage of the input annotated, so
+# the details page can show progress and offer the prefix for download.
+# The parts are deleted once the job is COMPLETED, so a page that read
+# the job while it ran may find them gone; the web app treats that as
+# the job having completed.
+#
+##
+
+import os
+import gzip
+import threading
+from configparser import ConfigParser
+
+# Shared AWS clients (util/aws_clients.py)
+import util_path
+import aws_clients
+
+# Reference: https://boto3.amazonaws.com/v1/documentation/api/latest/index.html
+
+# Get configuration
+config = ConfigParser()
+config.read('ann_config.ini')
+
+s3_results_bucket = config.get('aws', 's3_results_bucket')
+dynamodb_table_name = config.get('aws', 'dynamodb_table_name')
+enabled = config.getboolean('progress', 'enabled', fallback=False)
+min_size = config.getint('progress', 'min_size_mb', fallback=64) * 1024 * 1024
+interval = config.getfloat('progress', 'interval', fallback=60)
+min_part_size = config.getint('progress', 'min_part_mb', fallback=1) * 1024 * 1024
+max_part_size = max(config.getint('progress', 'max_part_mb', fallback=64) * 1024 * 1024,
+                    min_part_size)
+
+s3 = aws_clients.client('s3', config)
+
+
+# DynamoDB resources aren't thread-safe, so each thread gets its own
+def jobs_table():
+    return aws_clients.resource('dynamodb', config).Table(dynamodb_table_name)
+
+
+READ_BLOCK = 8 * 1024 * 1024
+# As run.COMPRESSED_SUFFIXES; run imports this module
+COMPRESSED_SUFFIXES = ('.gz', '.bgz')
+
+
+def wanted(input_file_path):
+    return enabled and os.path.getsize(input_file_path) >= min_size
+
+
+def partial_prefix(s3_key_results_file):
+    return s3_key_results_file.rsplit('/', 1)[0] + '/partial/'
+
+
+# Parts are numbered from 1; web/views.py builds the same keys
+def part_key(prefix, number):
+    return f"{prefix}part_{number:05d}.annot.vcf"
+
+
+def count_records(input_file_path):
+    opener = gzip.open if input_file_path.endswith(COMPRESSED_SUFFIXES) else open
+    count = 0
+    with opener(input_file_path, 'rb') as f:
+        for line in f:
+            if not line.startswith(b'#') and line.strip():
+                count += 1
+    return count
+
+
+def header_length(data):
+    # Bytes of leading header lines in data, which starts at a line start
+    end = 0
+    while data.startswith(b'#', end):
+        newline = data.find(b'\n', end)
+        if newline < 0:
+            break
+        end = newline + 1
+    return end
+
+
+class Progress(object):
+    """Uploads the annotated prefix of one running job
+
+    The output is a sequence of files in input order: one .annot.vcf, or
+    a sharded run's shard outputs, whose headers after the first are
+    dropped. A file's records are only read once every file before it
+    is finished, so the parts are always a prefix of the final results.
+    Failures are printed and otherwise ignored; the job never depends
+    on its partial results.
+    """
+    def __init__(self, job_id, input_file_path, s3_key_results_file):
+        self.job_id = job_id
+        self.input_file_path = input_file_path
+        self.prefix = partial_prefix(s3_key_results_file)
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.paths = []
+        self.finished_paths = set()
+        self.index = 0
+        self.offset = 0
+        self.parts = 0
+        self.records = 0
+        self.pending = b''
+        self.pending_records = 0
+        self.total = None
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    """Output files to read, in order, as AnnTools will write them
+    """
+    def watch(self, paths):
+        with self.lock:
+            self.paths = list(paths)
+
+    def finished(self, index):
+        with self.lock:
+            self.finished_paths.add(index)
+
+    """Stop watching; returns the number of parts uploaded
+    Called before the outputs are merged or moved.
+    """
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        return self.parts
+
+    def run(self):
+        try:
+            self.total = count_records(self.input_file_path)
+        except Exception as e:
+            print(f"Failed to count records of job {self.job_id}: {str(e)}")
+        while not self.stopped.wait(interval):
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"Failed to upload partial results of job {self.job_id}: {str(e)}")
+
+    """Up to limit bytes of complete records not read yet, as (data, records)
+    Called only from the watcher thread.
+    """
+    def read_new(self, limit):
+        chunks, size, records = [], 0, 0
+        with self.lock:
+            paths, finished_paths = list(self.paths), set(self.finished_paths)
+        while self.index < len(paths) and size < limit and os.path.exists(paths[self.index]):
+            wanted_bytes = min(READ_BLOCK, limit - size)
+            with open(paths[self.index], 'rb') as f:
+                f.seek(self.offset)
+                data = f.read(wanted_bytes)
+            at_end = len(data) < wanted_bytes
+            done = at_end and self.index in finished_paths
+            if not done:
+                # A record still being written waits for a later part
+                data = data[:data.rfind(b'\n') + 1]
+            header = header_length(data) if self.offset == 0 else 0
+            self.offset += len(data)
+            if self.index > 0:
+                # Every shard repeats the header; the first one's is kept
+                data = data[header:]
+                header = 0
+            if data and not data.endswith(b'\n'):
+                data += b'\n'
+            records += data.count(b'\n') - data[:header].count(b'\n')
+            chunks.append(data)
+            size += len(data)
+            if done:
+                self.index += 1
+                self.offset = 0
+            elif at_end or not data:
+                break
+        return b''.join(chunks), records
+
+    def flush(self):
+        while True:
+            data, records = self.read_new(max_part_size - len(self.pending))
+            self.pending += data
+            self.pending_records += records
+            # Small tails wait for more records, except for the first part
+            if not self.pending or (len(self.pending) < min_part_size and self.parts > 0):
+                return
+            s3.put_object(Bucket=s3_results_bucket, Key=part_key(self.prefix, self.parts + 1),
+                          Body=self.pending)
+            self.parts += 1
+            self.records += self.pending_records
+            self.pending, self.pending_records = b'', 0
+            self.save()
+
+    def save(self):
+        update = 'SET s3_key_partial_prefix = :prefix, partial_parts = :parts, ' \
+                 'partial_records = :records'
+        values = {':prefix': self.prefix, ':parts': self.parts, ':records': self.records,
+                  ':running': 'RUNNING'}
+        if self.total:
+            update += ', progress_percent = :percent'
+            values[':percent'] = min(99, int(100 * self.records / self.total))
+        try:
+            # A job that completed meanwhile keeps its final state
+            jobs_table().update_item(
+                Key={'job_id': self.job_id},
+                UpdateExpression=update,
+                ConditionExpression='job_status = :running',
+                ExpressionAttributeValues=values
+            )
+        except Exception as e:
+            print(f"Failed to record progress of job {self.job_id}: {str(e)}")
+
+
+# Delete a job's partial results, if it has any
+def clear(s3_key_results_file):
+    prefix = partial_prefix(s3_key_results_file)
+    try:
+        paginator = s3.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=s3_results_bucket, Prefix=prefix):
+            keys = [{'Key': obj['Key']} for obj in page.get('Contents', [])]
+            if keys:
+                s3.delete_objects(Bucket=s3_results_bucket, Delete={'Objects': keys})
+    except Exception as e:
+        print(f"Failed to delete partial results {prefix}: {str(e)}")
+
+### EOF
@@ -0,0 +1,150 @@
+# result_cache.py
+#
+# Content-addressed cache of AnnTools results
+#
+# Results are stored in the results bucket under
+# <cache_prefix>/<digest>/, where the digest is the SHA-256 of the input
+# file plus the annotation reference version. A repeat submission of the
+# same VCF is completed by copying the cached objects server-side.
+#
+# Where the input object's own checksum identifies its content (a
+# full-object SHA-256 checksum, or the MD5 ETag of a single-part upload)
+# the digest is taken from that instead, so a hit is found from
+# HeadObject before the input is downloaded.
+#
+##
+
+import os
+import time
+import hashlib
+from configparser import ConfigParser
+
+# Shared AWS clients (util/aws_clients.py)
+import util_path
+import aws_clients
+
+# Reference: https://boto3.amazonaws.com/v1/documentation/api/latest/index.html
+
+# Get configuration
+config = ConfigParser()
+config.read('ann_config.ini')
+
+s3_results_bucket = config.get('aws', 's3_results_bucket')
+cnet_id = config.get('info', 'cnet_id')
+enabled = config.getboolean('cache', 'enabled', fallback=False)
+reference_version = config.get('cache', 'reference_version', fallback='')
+cache_prefix = config.get('cache', 'cache_prefix', fallback=f"{cnet_id}/result_cache")
+max_age_days = config.getfloat('cache', 'max_age_days', fallback=30)
+max_size_gb = config.getfloat('cache', 'max_size_gb', fallback=50)
+
+s3 = aws_clients.client('s3', config)
+
+RESULT_NAME = 'result.annot.vcf'
+LOG_NAME = 'result.count.log'
+
+
+def content_digest(local_file_path, block_size=8 * 1024 * 1024):
+    sha256 = hashlib.sha256(reference_version.encode('utf-8') + b'\0')
+    with open(local_file_path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+"""Digest of an input object from its HeadObject response, or None
+when neither its checksum nor its ETag identifies the content, as for
+multipart uploads, whose ETags and checksums are per part
+"""
+def object_digest(head):
+    checksum = head.get('ChecksumSHA256', '')
+    etag = head.get('ETag', '').strip('"')
+    if checksum and '-' not in checksum and head.get('ChecksumType', 'FULL_OBJECT') == 'FULL_OBJECT':
+        source = f"sha256:{checksum}"
+    elif etag and '-' not in etag:
+        source = f"md5:{etag}"
+    else:
+        return None
+    return hashlib.sha256(f"{reference_version}\0{source}".encode('utf-8')).hexdigest()
+
+
+def cache_keys(digest):
+    return (f"{cache_prefix}/{digest}/{RESULT_NAME}",
+            f"{cache_prefix}/{digest}/{LOG_NAME}")
+
+
+def copy_object(source_key, dest_key):
+    # Managed copy so results over 5GB are copied in parts
+    s3.copy({'Bucket': s3_results_bucket, 'Key': source_key},
+            s3_results_bucket, dest_key)
+
+
+def lookup(digest):
+    try:
+        for key in cache_keys(digest):
+            s3.head_object(Bucket=s3_results_bucket, Key=key)
+        return True
+    except Exception:
+        return False
+
+
+"""Copy a cached result into a job's result keys
+Returns False on a cache miss or if the copy fails.
+"""
+def copy_to_job(digest, s3_key_results_file, s3_key_log_file):
+    if not lookup(digest):
+        return False
+    cached_result_key, cached_log_key = cache_keys(digest)
+    try:
+        copy_object(cached_result_key, s3_key_results_file)
+        copy_object(cached_log_key, s3_key_log_file)
+        print(f"Result cache hit for {digest}")
+        return True
+    except Exception as e:
+        print(f"Failed to copy cached result {digest}: {str(e)}")
+        return False
+
+
+"""Add a completed job's uploaded results to the cache
+log is the job's log without its job profile, which describes that
+job's run and not the jobs the entry will complete.
+"""
+def store(digest, s3_key_results_file, log):
+    cached_result_key, cached_log_key = cache_keys(digest)
+    try:
+        # Log first: lookup() requires both, so a partly stored entry
+        # is never served
+        s3.put_object(Bucket=s3_results_bucket, Key=cached_log_key, Body=log.encode('utf-8'))
+        copy_object(s3_key_results_file, cached_result_key)
+        print(f"Stored result in cache as {digest}")
+    except Exception as e:
+        print(f"Failed to store result in cache: {str(e)}")
+
+
+"""Drop entries older than max_age_days, then the oldest entries until
+the cache fits in max_size_gb
+"""
+def evict():
+    entries = {}
+    paginator = s3.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=s3_results_bucket, Prefix=cache_prefix + '/'):
+        for obj in page.get('Contents', []):
+            digest = obj['Key'][len(cache_prefix) + 1:].split('/')[0]
+            keys, size, modified = entries.get(digest, ([], 0, obj['LastModified']))
+            entries[digest] = (keys + [obj['Key']], size + obj['Size'],
+                               min(modified, obj['LastModified']))
+
+    now = time.time()
+    max_bytes = max_size_gb * 1024 ** 3
+    total = sum(size for keys, size, modified in entries.values())
+    evicted = []
+    for digest, (keys, size, modified) in sorted(entries.items(), key=lambda e: e[1][2]):
+        if now - modified.timestamp() > max_age_days * 86400 or total > max_bytes:
+            evicted.append(digest)
+            total -= size
+            s3.delete_objects(Bucket=s3_results_bucket,
+                              Delete={'Objects': [{'Key': key} for key in keys]})
+    if evicted:
+        print(f"Evicted {len(evicted)} result cache entries; {total / 1024 ** 3:.2f} GB remain")
+    return evicted
+
+### EOF
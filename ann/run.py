@@ -11,28 +11,172 @@ __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 # Reference: https://boto3.amazonaws.com/v1/documentation/api/latest/index.html
 
 import sys
+import gzip
+import zlib
+import base64
+import hashlib
+import signal
 import time
 import driver
-import boto3
 import os
 import shutil
 import json
+import resource
+import functools
+import multiprocessing
+import threading
+import shard
+import summary
+import checkpoint
+import progress
+import journal
+import result_cache
+import variant_cache
+from concurrent.futures import ThreadPoolExecutor
+from boto3.s3.transfer import TransferConfig
 from datetime import datetime, timezone
+from decimal import Decimal
 from configparser import ConfigParser
 
+# Shared AWS clients (util/aws_clients.py)
+import util_path
+import aws_clients
+
 #reference: https://boto3.amazonaws.com/v1/documentation/api/latest/index.html
 
 
 
+# Load configuration
+config = ConfigParser()
+config.read('ann_config.ini')
+s3_results_bucket = config.get('aws', 's3_results_bucket')
+queue_url_requests = config.get('aws', 'queue_url_requests')
+queue_url_results = config.get('aws', 'queue_url_results')
+queue_url_archive = config.get('aws', 'queue_url_archive')
+topic_arn_requests = config.get('aws', 'topic_arn_requests')
+topic_arn_results = config.get('aws', 'topic_arn_results')
+topic_arn_archive = config.get('aws', 'topic_arn_archive')
+dynamodb_table_name = config.get('aws', 'dynamodb_table_name')
+input_file_path = config.get('paths', 'input_file_path')
+job_info_dir = config.get('paths', 'job_info_dir')
+cnet_id = config.get('info', 'cnet_id')
+user_prefix = config.get('info', 'user_id')
+# Feed gzip/bgzip inputs to AnnTools through a pipe instead of writing
+# an uncompressed copy first
+stream_compressed = config.getboolean('input', 'stream_compressed', fallback=True)
+
+# Result uploads: multipart part size, parallel parts per file and the
+# checksum S3 checks every part against (empty for none)
+upload_part_size = config.getint('transfer', 'upload_part_size_mb', fallback=16) * 1024 * 1024
+upload_concurrency = config.getint('transfer', 'upload_concurrency', fallback=10)
+checksum_algorithm = config.get('transfer', 'upload_checksum_algorithm', fallback='SHA256').upper()
+verify_upload = config.getboolean('transfer', 'verify_upload', fallback=True)
+upload_config = TransferConfig(
+    multipart_threshold=upload_part_size,
+    multipart_chunksize=upload_part_size,
+    max_concurrency=upload_concurrency,
+    use_threads=True
+)
+
+COMPRESSED_SUFFIXES = ('.gz', '.bgz')
+# Checksums that can be recomputed locally to verify an uploaded object
+LOCAL_CHECKSUMS = {
+    'SHA256': hashlib.sha256,
+    'SHA1': hashlib.sha1,
+    'CRC32': None
+}
+# CRC32C needs botocore[crt], which isn't installed; without it every
+# upload would fail, so refuse to start instead
+if checksum_algorithm and checksum_algorithm not in LOCAL_CHECKSUMS:
+    raise ValueError(f"Unsupported [transfer] upload_checksum_algorithm {checksum_algorithm}; "
+                     f"use one of {', '.join(LOCAL_CHECKSUMS)} or leave it empty")
+
+# AWS clients are created once per process; warm pool workers (see
+# annotator.py) reuse them for every job they run. A job uploads its
+# results and log side by side in upload_concurrency parts each, and the
+# pipeline's upload workers publish that many jobs at once.
+pool_connections = 2 * upload_concurrency * config.getint('pipeline', 'upload_workers', fallback=4)
+sqs = aws_clients.client('sqs', config)
+s3 = aws_clients.client('s3', config, max_pool_connections=pool_connections)
+sns = aws_clients.client('sns', config)
+
+
+# DynamoDB resources aren't thread-safe, so each thread gets its own
+def jobs_table():
+    return aws_clients.resource('dynamodb', config).Table(dynamodb_table_name)
+
+
 """A rudimentary timer for coarse-grained profiling
 """
 def upload_file_to_s3(bucket_name, s3_key, local_file_path):
-    s3 = boto3.client('s3')
     try:
-        s3.upload_file(local_file_path, bucket_name, s3_key)
+        extra_args = {'ChecksumAlgorithm': checksum_algorithm} if checksum_algorithm else None
+        s3.upload_file(local_file_path, bucket_name, s3_key,
+                       Config=upload_config, ExtraArgs=extra_args)
+        if verify_upload and not upload_intact(bucket_name, s3_key, local_file_path):
+            print(f"Uploaded {bucket_name}/{s3_key} does not match {local_file_path}")
+            return False
         print(f"File {local_file_path} uploaded successfully to {bucket_name}/{s3_key}")
+        return True
     except Exception as e:
         print(f"Failed to upload file to S3: {str(e)}")
+        return False
+
+
+class Crc32(object):
+    # hashlib-style wrapper so CRC32 checksums are computed like the others
+    def __init__(self, data=b''):
+        self.value = zlib.crc32(data)
+
+    def update(self, data):
+        self.value = zlib.crc32(data, self.value)
+
+    def digest(self):
+        return self.value.to_bytes(4, 'big')
+
+
+def new_checksum(data=b''):
+    return (LOCAL_CHECKSUMS[checksum_algorithm] or Crc32)(data)
+
+
+"""Local equivalent of an object's checksum as S3 reports it, and the
+number of upload parts: a checksum of the whole file, or for a composite
+multipart checksum, a checksum of the part checksums
+"""
+def local_checksum(local_file_path, composite=False):
+    whole = new_checksum()
+    part_checksums = []
+    with open(local_file_path, 'rb') as f:
+        for block in iter(lambda: f.read(upload_part_size), b''):
+            if composite:
+                part_checksums.append(new_checksum(block).digest())
+            else:
+                whole.update(block)
+    if composite:
+        whole = new_checksum(b''.join(part_checksums))
+    return base64.b64encode(whole.digest()).decode('ascii'), len(part_checksums)
+
+
+"""True unless the uploaded object's size or checksum differs from the
+local file. S3 already rejects parts that don't match their checksum;
+this catches a file changed or truncated during the upload.
+"""
+def upload_intact(bucket_name, s3_key, local_file_path):
+    head = s3.head_object(Bucket=bucket_name, Key=s3_key, ChecksumMode='ENABLED')
+    if head['ContentLength'] != os.path.getsize(local_file_path):
+        return False
+    remote = head.get(f"Checksum{checksum_algorithm}") if checksum_algorithm else None
+    if remote is None or checksum_algorithm not in LOCAL_CHECKSUMS:
+        return True
+    # Composite checksums carry the part count as "<value>-<parts>"
+    value, _, parts = remote.partition('-')
+    composite = head.get('ChecksumType') != 'FULL_OBJECT' and (
+        bool(parts) or head['ContentLength'] >= upload_part_size)
+    expected, local_parts = local_checksum(local_file_path, composite)
+    if parts and int(parts) != local_parts:
+        print(f"Can't reproduce the {parts} parts of {s3_key}; checked its size only")
+        return True
+    return expected == value
 
 
 def delete_local_file(local_file_path):
@@ -44,24 +188,22 @@ def delete_local_file(local_file_path):
 
 
 def update_dynamodb(job_id, data):
-    dynamodb = boto3.resource('dynamodb')
-    table = dynamodb.Table('qixshawnchen_annotations')
-    table.update_item(
+    jobs_table().update_item(
         Key={'job_id': job_id},
-        UpdateExpression='SET s3_results_bucket = :bucket, s3_key_result_file = :result_key, s3_key_log_file = :log_key, complete_time = :complete, job_status = :status',
+        UpdateExpression='SET s3_results_bucket = :bucket, s3_key_result_file = :result_key, s3_key_log_file = :log_key, complete_time = :complete, job_status = :status, progress_percent = :progress REMOVE s3_key_partial_prefix, partial_parts, partial_records',
         ExpressionAttributeValues={
             ':bucket': data['s3_results_bucket'],
             ':result_key': data['s3_key_result_file'],
             ':log_key': data['s3_key_log_file'],
             ':complete': data['complete_time'],
-            ':status': 'COMPLETED'
+            ':status': 'COMPLETED',
+            ':progress': 100
         }
     )
     print("DynamoDB updated successfully.")
 
 
 def publish_sns_message(topic_arn, message):
-    sns = boto3.client('sns')
     try:
         response = sns.publish(
             TopicArn = topic_arn,
@@ -91,90 +233,418 @@ class Timer(object):
         if self.verbose:
             print(f"Approximate runtime: {self.secs:.2f} seconds")
 
-#./jobs/397717f3-d953-414c-88a2-6ef6cde203d0/397717f3-d953-414c-88a2-6ef6cde203d0~test.vcf
+class Profile(object):
+    """Per-phase timings and resource usage of one job. The values are
+    plain numbers so they can be handed between processes; they end up
+    in the job's DynamoDB item and at the end of its count log.
+    """
+    def __init__(self, values=None):
+        self.values = dict(values or {})
 
+    def add(self, phase, secs):
+        key = f"{phase}_seconds"
+        self.values[key] = self.values.get(key, 0.0) + secs
 
-if __name__ == '__main__':
-    # Load configuration
-    config = ConfigParser()
-    config.read('ann_config.ini')
-    sqs = boto3.client('sqs')
-    s3 = boto3.client('s3')
-    sns = boto3.client('sns')
-    s3_results_bucket = config.get('aws', 's3_results_bucket')
-    queue_url_requests = config.get('aws', 'queue_url_requests')
-    queue_url_results = config.get('aws', 'queue_url_results')
-    queue_url_archive = config.get('aws', 'queue_url_archive')
-    topic_arn_requests = config.get('aws', 'topic_arn_requests')
-    topic_arn_results = config.get('aws', 'topic_arn_results')
-    topic_arn_archive = config.get('aws', 'topic_arn_archive')
-    dynamodb_table_name = config.get('aws', 'dynamodb_table_name')
-    input_file_path = config.get('paths', 'input_file_path')
-    job_info_dir = config.get('paths', 'job_info_dir')
-    cnet_id = config.get('info', 'cnet_id')
-    user_prefix = config.get('info', 'user_id')
-    dynamodb = boto3.resource('dynamodb')
-    table = dynamodb.Table(dynamodb_table_name)
-    
+    def phase(self, phase):
+        return PhaseTimer(self, phase)
 
-    # Call the AnnTools pipeline
-    if len(sys.argv) > 1:
-        input_file_path = sys.argv[1].strip()
-        user_id = sys.argv[2]
-        job_id = input_file_path.split('/')[-2]
-        
+    def summary(self):
+        return ' '.join(f"{k}={v:.3f}" if isinstance(v, float) else f"{k}={v}"
+                        for k, v in self.values.items())
 
-        with Timer():
-            results_file = input_file_path.replace('.vcf', '.annot.vcf')
-            log_file = (input_file_path + '.count.log').strip()
-            driver.run(input_file_path, 'vcf')
 
-        unique_id = os.path.basename(job_id).split('~')[0]
-        results_file_name1 = results_file.split('/')[-1]
-        results_file_name = results_file_name1.split('~')[-1]
-        log_file_name1 = log_file.split('/')[-1]
-        log_file_name = log_file_name1.split('~')[-1]
+class PhaseTimer(object):
+    def __init__(self, profile, phase):
+        self.profile = profile
+        self.phase = phase
 
-        s3_key_results_file = f"{cnet_id}/{user_prefix}/{unique_id}/{results_file_name}"
-        s3_key_log_file = f"{cnet_id}/{user_prefix}/{unique_id}/{log_file_name}"
-        path_to_del_local = os.path.dirname(results_file)
+    def __enter__(self):
+        self.start = time.time()
+        return self
 
-        upload_file_to_s3(s3_results_bucket, s3_key_results_file, results_file)
-        upload_file_to_s3(s3_results_bucket, s3_key_log_file, log_file)
+    def __exit__(self, *args):
+        self.profile.add(self.phase, time.time() - self.start)
 
 
+# CPU seconds and peak RSS (MB) of this process and the children it has
+# waited for, e.g. shard workers
+def resource_usage():
+    usages = [resource.getrusage(resource.RUSAGE_SELF),
+              resource.getrusage(resource.RUSAGE_CHILDREN)]
+    cpu = sum(u.ru_utime + u.ru_stime for u in usages)
+    return cpu, max(u.ru_maxrss for u in usages) / 1024.0
 
-        # Clean up local files
-        delete_local_file(path_to_del_local)
 
-        # Prepare data for DynamoDB update
-        # { "N" : { "S" : "1716009696.830354" } }
-        data = {
-            's3_results_bucket': s3_results_bucket,
-            's3_key_result_file': s3_key_results_file,
-            's3_key_log_file': s3_key_log_file,
-            'complete_time': int(time.time()),
-        }
+def count_variants(results_file):
+    count = 0
+    with open(results_file, 'rb') as f:
+        for line in f:
+            if not line.startswith(b'#') and line.strip():
+                count += 1
+    return count
+
+
+PROFILE_MARKER = '# Job profile\n'
+
+
+# The log as AnnTools wrote it, without any job profile appended
+def job_log(log_file):
+    with open(log_file) as f:
+        return f.read().split('\n' + PROFILE_MARKER)[0].rstrip('\n') + '\n'
+
+
+def append_profile(log_file, profile):
+    # A retried job replaces the profile an earlier attempt appended
+    log = job_log(log_file)
+    with open(log_file, 'w') as f:
+        f.write(log + '\n' + PROFILE_MARKER)
+        for name, value in profile.values.items():
+            f.write(f"# {name}: {round(value, 3) if isinstance(value, float) else value}\n")
+
+
+def save_profile(job_id, profile, result_summary=None):
+    try:
+        values = {k: round(v, 3) if isinstance(v, float) else v for k, v in profile.values.items()}
+        update = 'SET job_profile = :profile'
+        attributes = {':profile': json.loads(json.dumps(values), parse_float=Decimal)}
+        if result_summary is not None:
+            update += ', result_summary = :summary'
+            attributes[':summary'] = result_summary
+        jobs_table().update_item(
+            Key={'job_id': job_id},
+            UpdateExpression=update,
+            ExpressionAttributeValues=attributes
+        )
+    except Exception as e:
+        print(f"Failed to save profile of job {job_id}: {str(e)}")
+
+#./jobs/397717f3-d953-414c-88a2-6ef6cde203d0/397717f3-d953-414c-88a2-6ef6cde203d0~test.vcf
+
+
+"""Local result/log paths and S3 keys for a downloaded input file
+"""
+def result_locations(input_file_path):
+    job_id = input_file_path.split('/')[-2]
+    # Results of x.vcf.gz are the uncompressed x.annot.vcf and x.vcf.count.log
+    input_file_path = vcf_path(input_file_path)
+    results_file = input_file_path.replace('.vcf', '.annot.vcf')
+    log_file = (input_file_path + '.count.log').strip()
+
+    unique_id = os.path.basename(job_id).split('~')[0]
+    results_file_name1 = results_file.split('/')[-1]
+    results_file_name = results_file_name1.split('~')[-1]
+    log_file_name1 = log_file.split('/')[-1]
+    log_file_name = log_file_name1.split('~')[-1]
+
+    s3_key_results_file = f"{cnet_id}/{user_prefix}/{unique_id}/{results_file_name}"
+    s3_key_log_file = f"{cnet_id}/{user_prefix}/{unique_id}/{log_file_name}"
+    return results_file, log_file, s3_key_results_file, s3_key_log_file
+
+
+"""Mark a job COMPLETED once its results are in S3 and notify archive
+With a profile, the two steps are timed and the profile is saved with
+the job, along with the results summary if there is one.
+"""
+def complete_job(job_id, user_id, s3_key_results_file, s3_key_log_file, profile=None,
+                 result_summary=None):
+    timed = profile or Profile()
+    # Prepare data for DynamoDB update
+    # { "N" : { "S" : "1716009696.830354" } }
+    data = {
+        's3_results_bucket': s3_results_bucket,
+        's3_key_result_file': s3_key_results_file,
+        's3_key_log_file': s3_key_log_file,
+        'complete_time': int(time.time()),
+    }
+    with timed.phase('dynamodb_update'):
         update_dynamodb(job_id, data)
 
-        # Publish notification to SNS result
-        #message_result = {'message_type': 'result_message',
-                          #'job_id': job_id,
-                          #'s3_results_bucket': s3_results_bucket}
-        
-        #publish_sns_message(topic_arn_results, message_result)
-
-        # Publish notification to SNS archive
-        message_archive = {'message_type': 'archive_message',
-                           'job_id': job_id,
-                           'user_id': user_id}
-        
+    # Publish notification to SNS result; the notifier (util/notify)
+    # emails the user
+    message_result = {'message_type': 'result_message',
+                      'job_id': job_id,
+                      'user_id': user_id,
+                      's3_results_bucket': s3_results_bucket}
+
+    with timed.phase('sns_publish'):
+        publish_sns_message(topic_arn_results, message_result)
+
+    # Publish notification to SNS archive
+    message_archive = {'message_type': 'archive_message',
+                       'job_id': job_id,
+                       'user_id': user_id}
+    
+    with timed.phase('sns_publish'):
         publish_sns_message(topic_arn_archive, message_archive)
 
+    if profile is not None:
+        save_profile(job_id, profile, result_summary)
+        print(f"Job {job_id} profile: {profile.summary()}")
 
 
+"""Path of the uncompressed VCF an input file is annotated as
+"""
+def vcf_path(input_file_path):
+    for suffix in COMPRESSED_SUFFIXES:
+        if input_file_path.endswith(suffix):
+            return input_file_path[:-len(suffix)]
+    return input_file_path
+
+
+def decompress(input_file_path, output_path):
+    # gzip reads bgzip's concatenated members as one stream
+    with gzip.open(input_file_path, 'rb') as f, open(output_path, 'wb') as out:
+        shutil.copyfileobj(f, out, 1024 * 1024)
+
+
+def feed_pipe(input_file_path, pipe_path, errors):
+    try:
+        decompress(input_file_path, pipe_path)
+    except Exception as e:
+        errors.append(e)
+
+
+"""Annotate a compressed input read through a named pipe
+AnnTools reads the pipe like a file while a thread decompresses into
+it, so no uncompressed copy of the input is ever written.
+"""
+def annotate_streamed(input_file_path, pipe_path):
+    errors = []
+    os.mkfifo(pipe_path)
+    writer = threading.Thread(target=feed_pipe, args=(input_file_path, pipe_path, errors),
+                              daemon=True)
+    writer.start()
+    try:
+        run_anntools(pipe_path)
+    finally:
+        # If AnnTools stopped reading early, open and close the read end
+        # until the writer fails instead of blocking forever
+        while writer.is_alive():
+            os.close(os.open(pipe_path, os.O_RDONLY | os.O_NONBLOCK))
+            writer.join(0.1)
+        os.remove(pipe_path)
+    if errors:
+        raise errors[0]
+
+
+"""Run AnnTools over an input file, through the variant cache if enabled
+Compressed inputs are streamed when nothing needs to read them twice;
+the variant cache and sharding get a decompressed copy. A sharded run
+saves its progress to job_checkpoint (checkpoint.Checkpoint) if given;
+job_progress (progress.Progress) is told which outputs to upload as
+they grow.
+"""
+def annotate(input_file_path, job_checkpoint=None, job_progress=None):
+    path = vcf_path(input_file_path)
+    if path != input_file_path:
+        if stream_compressed and not variant_cache.enabled and not shard.enabled:
+            if job_progress is not None:
+                job_progress.watch([path.replace('.vcf', '.annot.vcf')])
+            annotate_streamed(input_file_path, path)
+            return
+        decompress(input_file_path, path)
+
+    try:
+        annotate_path = functools.partial(annotate_file, job_checkpoint=job_checkpoint,
+                                          job_progress=job_progress)
+        if variant_cache.enabled:
+            variant_cache.annotate(path, annotate_path)
+        else:
+            annotate_path(path)
+    finally:
+        if path != input_file_path and os.path.exists(path):
+            os.remove(path)
+
+
+# Large inputs (or a large set of variant cache misses) are split across
+# every core, except in the annotator's daemonic pool workers, which
+# can't start a pool of their own
+def annotate_file(input_file_path, job_checkpoint=None, job_progress=None):
+    if shard.wanted(input_file_path) and not multiprocessing.current_process().daemon:
+        shard.annotate(input_file_path, run_anntools, job_checkpoint, job_progress)
+    else:
+        if job_progress is not None:
+            job_progress.watch([input_file_path.replace('.vcf', '.annot.vcf')])
+        run_anntools(input_file_path)
+
+
+def run_anntools(input_file_path):
+    driver.run(input_file_path, 'vcf')
+
+
+"""Annotate a job's input unless the journal shows an earlier run of
+the same job already finished annotating it
+"""
+def annotate_once(input_file_path, profile):
+    job_id = input_file_path.split('/')[-2]
+    results_file, log_file, s3_key_results_file = result_locations(input_file_path)[:3]
+    profile.values['input_bytes'] = os.path.getsize(input_file_path)
+    if (journal.reached(job_id, 'annotated') and os.path.exists(results_file) and
+            os.path.exists(log_file)):
+        print(f"Job {job_id} was already annotated; reusing its results")
+    else:
+        cpu_before = resource_usage()[0]
+        start = time.time()
+        # Another annotator may have been part-way through this job
+        job_checkpoint = None
+        if checkpoint.enabled and shard.enabled:
+            job_checkpoint = checkpoint.Checkpoint(s3_key_results_file)
+        # Records of a variant cache run are annotated out of input order,
+        # so only direct runs upload partial results
+        job_progress = None
+        if progress.wanted(input_file_path) and not variant_cache.enabled:
+            job_progress = progress.Progress(job_id, input_file_path, s3_key_results_file)
+            job_progress.start()
+        try:
+            annotate(input_file_path, job_checkpoint, job_progress)
+        finally:
+            if job_progress is not None:
+                profile.values['partial_parts'] = job_progress.stop()
+        profile.add('annotate', time.time() - start)
+        cpu_after, peak_rss_mb = resource_usage()
+        # Warm pool workers run many jobs, so CPU is measured as a delta;
+        # peak RSS is the worker's high-water mark
+        profile.values['cpu_seconds'] = cpu_after - cpu_before
+        profile.values['peak_rss_mb'] = peak_rss_mb
+        journal.add_timings(job_id, annotate=profile.values['annotate_seconds'])
+        journal.advance(job_id, 'annotated')
+    profile.values['variants'] = count_variants(results_file)
+
+
+"""Summary of a job's results for the details page, or None
+Computed while the results upload; a failure only costs the summary.
+"""
+def summarize_results(job_id, results_file, profile):
+    if not summary.enabled:
+        return None
+    try:
+        with profile.phase('summary'):
+            return summary.summarize(results_file)
+    except Exception as e:
+        print(f"Failed to summarize results of job {job_id}: {str(e)}")
+        return None
+
+
+def aws_counts():
+    return {f"aws_{kind}:{service}": count for kind in ['throttles', 'retries']
+            for service, count in aws_clients.counts(kind).items()}
+
+
+# Hand the AWS throttles and retries of a job's calls to the annotator's
+# metrics; a process runs one job at a time, so the change is the job's
+def report_aws_counts(job_id, before):
+    counts = {name: count - before.get(name, 0) for name, count in aws_counts().items()
+              if count > before.get(name, 0)}
+    if counts:
+        try:
+            journal.add_timings(job_id, **counts)
+        except Exception as e:
+            print(f"Failed to report AWS retries of job {job_id}: {str(e)}")
+
+
+"""Annotate one downloaded input file and publish the results
+Called by the __main__ block below for one-shot runs and directly by
+the annotator's warm worker pool; download_seconds is how long the
+annotator took to fetch the input. Returns True on success.
+"""
+def run_job(input_file_path, user_id, digest=None, download_seconds=None):
+    input_file_path = input_file_path.strip()
+    profile = Profile()
+    if download_seconds is not None:
+        profile.values['download_seconds'] = download_seconds
+    aws_before = aws_counts()
+
+    try:
+        # Call the AnnTools pipeline
+        annotate_once(input_file_path, profile)
+
+        return publish_results(input_file_path, user_id, digest, profile.values)
+    finally:
+        report_aws_counts(input_file_path.split('/')[-2], aws_before)
+
+
+"""Compute stage of the annotator's pipelined execution mode
+Annotates without publishing; returns the job's profile values so far.
+"""
+def annotate_job(input_file_path, download_seconds=None):
+    profile = Profile()
+    if download_seconds is not None:
+        profile.values['download_seconds'] = download_seconds
+    annotate_once(input_file_path.strip(), profile)
+    return profile.values
+
+
+"""Upload an annotated job's results, clean up and mark it COMPLETED
+profile_values carries the timings of the earlier phases. Returns False
+if an upload fails.
+"""
+def publish_results(input_file_path, user_id, digest=None, profile_values=None):
+    job_id = input_file_path.split('/')[-2]
+    results_file, log_file, s3_key_results_file, s3_key_log_file = \
+        result_locations(input_file_path)
+    if result_cache.enabled and not digest:
+        digest = result_cache.content_digest(input_file_path)
+    profile = Profile(profile_values)
+
+    path_to_del_local = os.path.dirname(results_file)
+
+    # The log can only carry the phases finished before it is uploaded;
+    # the job item gets them all
+    append_profile(log_file, profile)
+
+    def upload(phase, s3_key, local_file_path):
+        upload_start = time.time()
+        uploaded = upload_file_to_s3(s3_results_bucket, s3_key, local_file_path)
+        profile.add(phase, time.time() - upload_start)
+        return uploaded
+
+    # Results and log upload side by side, each in parallel parts, while
+    # the results are summarized; a failed upload fails the job so the
+    # annotator redelivers it
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=3) as uploads:
+        summarized = uploads.submit(summarize_results, job_id, results_file, profile)
+        uploaded = list(uploads.map(
+            lambda args: upload(*args),
+            [('upload_results', s3_key_results_file, results_file),
+             ('upload_log', s3_key_log_file, log_file)]))
+        result_summary = summarized.result()
+    if not all(uploaded):
+        return False
+    upload_secs = time.time() - start
+    upload_bytes = os.path.getsize(results_file) + os.path.getsize(log_file)
+    profile.values['upload_bytes'] = upload_bytes
+    profile.values['upload_mb_per_s'] = upload_bytes / (1024.0 * 1024.0) / max(upload_secs, 1e-6)
+    journal.add_timings(job_id, upload=upload_secs, upload_bytes=upload_bytes)
+    journal.advance(job_id, 'uploaded')
+
+    if result_cache.enabled:
+        result_cache.store(digest, s3_key_results_file, job_log(log_file))
+
+    # Clean up local files
+    with profile.phase('cleanup'):
+        delete_local_file(path_to_del_local)
+        if checkpoint.enabled and shard.enabled:
+            checkpoint.clear(s3_key_results_file)
+
+    complete_job(job_id, user_id, s3_key_results_file, s3_key_log_file, profile,
+                 result_summary)
+    # Partial results are offered for as long as the job is RUNNING
+    if progress.enabled:
+        progress.clear(s3_key_results_file)
+    return True
+
+
+if __name__ == '__main__':
+    # The annotator decides when a running job is cut off while it drains
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    if len(sys.argv) > 2:
+        digest = sys.argv[3] if len(sys.argv) > 3 else None
+        download_seconds = float(sys.argv[4]) if len(sys.argv) > 4 and sys.argv[4] else None
+        sys.exit(0 if run_job(sys.argv[1], sys.argv[2], digest, download_seconds) else 1)
     else:
         print("A valid .vcf file and job ID must be provided as input to this program.")
+        sys.exit(1)
     
 
-### EOF
\ No newline at end of file
+### EOF
@@ -0,0 +1,225 @@
+# shard.py
+#
+# Intra-job sharding of large VCFs
+#
+# Splits an input at record boundaries into shards that each carry the
+# original header, annotates the shards in a process pool and merges the
+# results back into one .annot.vcf (records in input order) and one
+# .count.log, so a single large file keeps every core busy. Finished
+# shards can be checkpointed to S3 (see checkpoint.py) so an interrupted
+# run resumes where it stopped.
+#
+##
+
+import os
+import re
+import time
+import shutil
+import multiprocessing
+from configparser import ConfigParser
+
+# Get configuration
+config = ConfigParser()
+config.read('ann_config.ini')
+
+enabled = config.getboolean('shard', 'enabled', fallback=False)
+min_size = config.getint('shard', 'min_size_mb', fallback=256) * 1024 * 1024
+workers = config.getint('shard', 'workers', fallback=0) or os.cpu_count() or 1
+shards_per_worker = config.getint('shard', 'shards_per_worker', fallback=2)
+
+COPY_BLOCK = 8 * 1024 * 1024
+COUNT_LINE = re.compile(r'^(.*?)(\s*[:=\t]\s*)(\d+)\s*$')
+
+
+# size overrides the file's own, e.g. for the uncompressed size of a
+# compressed input
+def wanted(input_file_path, size=None):
+    if size is None:
+        size = os.path.getsize(input_file_path)
+    return enabled and workers > 1 and size >= min_size
+
+
+def header_end(f):
+    # Byte offset of the first data record
+    f.seek(0)
+    while True:
+        offset = f.tell()
+        line = f.readline()
+        if not line or not line.startswith(b'#'):
+            return offset
+
+
+def copy_range(src, dst, start, end):
+    src.seek(start)
+    remaining = end - start
+    while remaining > 0:
+        block = src.read(min(COPY_BLOCK, remaining))
+        if not block:
+            break
+        dst.write(block)
+        remaining -= len(block)
+
+
+"""Byte offsets splitting input_file_path into up to count shards of
+roughly equal size: the start of the first record, each shard boundary
+and the end of the file. Boundaries are moved forward to the next
+record, so no record is ever split.
+"""
+def plan(input_file_path, count):
+    size = os.path.getsize(input_file_path)
+    with open(input_file_path, 'rb') as f:
+        data_start = header_end(f)
+        boundaries = [data_start]
+        for i in range(1, count):
+            f.seek(max(data_start, data_start + (size - data_start) * i // count - 1))
+            f.readline()
+            if boundaries[-1] < f.tell() < size:
+                boundaries.append(f.tell())
+        boundaries.append(size)
+    return boundaries
+
+
+def shard_path(shard_dir, index):
+    return os.path.join(shard_dir, f"shard_{index:04d}.vcf")
+
+
+"""Write the shards of input_file_path between boundaries, each with
+the original header; shards in skip are left out. Returns every shard's
+path in input order.
+"""
+def write_shards(input_file_path, shard_dir, boundaries, skip=()):
+    os.makedirs(shard_dir, exist_ok=True)
+    with open(input_file_path, 'rb') as f:
+        header = f.read(boundaries[0])
+        paths = []
+        for i, (start, end) in enumerate(zip(boundaries, boundaries[1:])):
+            path = shard_path(shard_dir, i)
+            if i not in skip:
+                with open(path, 'wb') as out:
+                    out.write(header)
+                    copy_range(f, out, start, end)
+            paths.append(path)
+    return paths
+
+
+"""Split input_file_path into up to count shards of roughly equal size
+Returns the shard paths in input order.
+"""
+def split(input_file_path, shard_dir, count):
+    return write_shards(input_file_path, shard_dir, plan(input_file_path, count))
+
+
+def annotate_shard(args):
+    annotate_file, path, index = args
+    start = time.time()
+    annotate_file(path)
+    # The shard's input is no longer needed; free its disk for the merge
+    os.remove(path)
+    return index, time.time() - start
+
+
+def merge_results(paths, results_file):
+    with open(results_file, 'wb') as out:
+        for i, path in enumerate(paths):
+            with open(path, 'rb') as f:
+                data_start = header_end(f)
+                # Every shard has the same header; keep the first
+                if i == 0:
+                    f.seek(0)
+                    copy_range(f, out, 0, data_start)
+                f.seek(data_start)
+                shutil.copyfileobj(f, out, COPY_BLOCK)
+            os.remove(path)
+
+
+"""Combine the shards' count logs
+Logs made only of "label: count" lines with the same labels are summed
+line by line; anything else is concatenated shard by shard.
+"""
+def merge_logs(paths, log_file):
+    logs = []
+    for path in paths:
+        with open(path) as f:
+            logs.append(f.read().splitlines())
+
+    parsed = [[COUNT_LINE.match(line) for line in log] for log in logs]
+    labels = [[m.group(1) if m else None for m in p] for p in parsed]
+    summable = all(m for p in parsed for m in p) and all(l == labels[0] for l in labels)
+
+    with open(log_file, 'w') as out:
+        if summable:
+            for i, m in enumerate(parsed[0]):
+                total = sum(int(p[i].group(3)) for p in parsed)
+                out.write(f"{m.group(1)}{m.group(2)}{total}\n")
+        else:
+            for i, log in enumerate(logs):
+                out.write(f"# shard {i}\n")
+                out.writelines(line + '\n' for line in log)
+
+
+"""Annotate input_file_path in shards
+annotate_file(path) must write path's .annot.vcf and .count.log the way
+driver.run does; it is called in forked worker processes. Produces the
+same two output files for the whole input. With a checkpoint
+(checkpoint.Checkpoint), shards an earlier run finished are fetched
+instead of annotated, and each newly finished shard is saved to it.
+With a progress (progress.Progress), the shard outputs are uploaded in
+order as they are written.
+"""
+def annotate(input_file_path, annotate_file, checkpoint=None, progress=None):
+    job_dir = os.path.dirname(input_file_path)
+    shard_dir = os.path.join(job_dir, 'shards')
+    results_file = input_file_path.replace('.vcf', '.annot.vcf')
+    log_file = input_file_path + '.count.log'
+
+    start = time.time()
+    manifest = checkpoint.resume(input_file_path) if checkpoint is not None else None
+    done = set()
+    if manifest is not None:
+        # Reuse the earlier run's boundaries; this box may have a
+        # different number of workers
+        boundaries = manifest['boundaries']
+        os.makedirs(shard_dir, exist_ok=True)
+        for i in manifest['done']:
+            path = shard_path(shard_dir, i)
+            if checkpoint.fetch_shard(i, path.replace('.vcf', '.annot.vcf'), path + '.count.log'):
+                done.add(i)
+        print(f"Resuming from checkpoint: {len(done)} of {len(boundaries) - 1} shards done")
+    else:
+        boundaries = plan(input_file_path, workers * shards_per_worker)
+    paths = write_shards(input_file_path, shard_dir, boundaries, skip=done)
+    if checkpoint is not None:
+        checkpoint.start(boundaries, done)
+    if progress is not None:
+        progress.watch([p.replace('.vcf', '.annot.vcf') for p in paths])
+        for i in done:
+            progress.finished(i)
+    split_secs = time.time() - start
+
+    todo = [(annotate_file, path, i) for i, path in enumerate(paths) if i not in done]
+    shard_secs = [0.0]
+    if todo:
+        # Fork so the workers inherit the loaded AnnTools modules
+        with multiprocessing.get_context('fork').Pool(min(workers, len(todo))) as pool:
+            for i, secs in pool.imap_unordered(annotate_shard, todo):
+                shard_secs.append(secs)
+                if progress is not None:
+                    progress.finished(i)
+                if checkpoint is not None:
+                    checkpoint.save_shard(i, paths[i].replace('.vcf', '.annot.vcf'),
+                                          paths[i] + '.count.log')
+
+    # The shard outputs are about to be merged away
+    if progress is not None:
+        progress.stop()
+    merge_start = time.time()
+    merge_results([p.replace('.vcf', '.annot.vcf') for p in paths], results_file)
+    merge_logs([p + '.count.log' for p in paths], log_file)
+    shutil.rmtree(shard_dir, ignore_errors=True)
+
+    print(f"Annotated {len(todo)} of {len(paths)} shards on {min(workers, len(todo) or 1)} "
+          f"workers in {time.time() - start:.2f}s (split {split_secs:.2f}s, "
+          f"slowest shard {max(shard_secs):.2f}s, merge {time.time() - merge_start:.2f}s)")
+    return len(paths)
+
+### EOF
@@ -0,0 +1,158 @@
+# summary.py
+#
+# Compact summary of an annotated VCF
+#
+# Computed once at completion in a single streaming pass over the
+# results file: variant counts by chromosome, variant type and
+# consequence, and allele-frequency histograms. Records are read in
+# chunks and parsed with vectorized NumPy string operations. The summary
+# is stored on the job item so the details page never has to read the
+# results file or its log.
+#
+##
+
+import math
+from itertools import islice
+from configparser import ConfigParser
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Get configuration
+config = ConfigParser()
+config.read('ann_config.ini')
+
+enabled = config.getboolean('summary', 'enabled', fallback=True) and np is not None
+chunk_lines = config.getint('summary', 'chunk_lines', fallback=100000)
+# INFO keys holding a record's consequence; for pipe-delimited
+# annotations (VEP CSQ, SnpEff ANN) the second field of the first entry
+consequence_keys = [k.strip() for k in
+                    config.get('summary', 'consequence_keys', fallback='CSQ,ANN').split(',') if k.strip()]
+# INFO keys with allele frequencies to histogram, e.g. AF,gnomAD_AF
+frequency_keys = [k.strip() for k in
+                  config.get('summary', 'frequency_keys', fallback='AF').split(',') if k.strip()]
+frequency_bins = config.getint('summary', 'frequency_bins', fallback=10)
+# Chromosomes and consequences beyond the most frequent max_categories
+# are counted together as "other", keeping the item small
+max_categories = config.getint('summary', 'max_categories', fallback=40)
+
+
+def partition(a, sep):
+    # (before, sep, after) arrays; NumPy 2's np.strings.partition sizes
+    # each to its contents, np.char.partition stacks full-width copies
+    if np is not None and hasattr(getattr(np, 'strings', None), 'partition'):
+        return np.strings.partition(a, sep)
+    parts = np.char.partition(a, sep)
+    return parts[:, 0], parts[:, 1], parts[:, 2]
+
+
+def columns(lines, count):
+    # Peel the first count tab-separated columns off every line at once
+    cols = []
+    rest = lines
+    for i in range(count):
+        col, _, rest = partition(rest, '\t')
+        cols.append(col)
+    return cols
+
+
+def info_values(info, key):
+    # Value of key in each INFO field ('' where absent); the leading ';'
+    # anchors the match so AF doesn't find gnomAD_AF
+    after = partition(np.char.add(';', info), f";{key}=")[2]
+    return partition(after, ';')[0]
+
+
+def consequences(info):
+    found = np.full(info.shape, '', dtype=object)
+    for key in consequence_keys:
+        first = partition(info_values(info, key), ',')[0]
+        before, sep, after = partition(first, '|')
+        value = np.where(sep == '|', partition(after, '|')[0], first)
+        found = np.where(found == '', value.astype(object), found)
+    return np.where(found == '', 'unannotated', found).astype(str)
+
+
+def frequencies(info, key):
+    values = partition(info_values(info, key), ',')[0]
+    values = np.where((values == '') | (values == '.'), 'nan', values)
+    try:
+        return values.astype(float)
+    except ValueError:
+        return np.array([to_float(v) for v in values], dtype=float)
+
+
+def to_float(value):
+    try:
+        return float(value)
+    except ValueError:
+        return math.nan
+
+
+def variant_types(ref, alt):
+    first_alt = partition(alt, ',')[0]
+    ref_len = np.char.str_len(ref)
+    alt_len = np.char.str_len(first_alt)
+    types = np.where(ref_len == alt_len, np.where(ref_len == 1, 'SNV', 'MNV'),
+                     np.where(ref_len < alt_len, 'insertion', 'deletion'))
+    types = np.where(np.char.startswith(first_alt, '<'), 'symbolic', types)
+    return np.where(np.char.find(alt, ',') >= 0, 'multiallelic', types)
+
+
+def add_counts(totals, values):
+    keys, counts = np.unique(values, return_counts=True)
+    for key, count in zip(keys.tolist(), counts.tolist()):
+        totals[key] = totals.get(key, 0) + count
+
+
+def top(counts):
+    ranked = sorted(counts.items(), key=lambda kv: -kv[1])
+    kept = dict(ranked[:max_categories])
+    if len(ranked) > max_categories:
+        kept['other'] = sum(count for key, count in ranked[max_categories:])
+    return kept
+
+
+"""Summarize an annotated VCF; returns a dict of plain ints and strings
+"""
+def summarize(results_file):
+    edges = np.linspace(0.0, 1.0, frequency_bins + 1)
+    chromosomes, types, effects = {}, {}, {}
+    histograms = {key: np.zeros(frequency_bins, dtype=np.int64) for key in frequency_keys}
+    missing = {key: 0 for key in frequency_keys}
+    total = 0
+
+    with open(results_file, errors='replace') as f:
+        records = (line for line in f if line.strip() and not line.startswith('#'))
+        while True:
+            chunk = list(islice(records, chunk_lines))
+            if not chunk:
+                break
+            lines = np.array([line.rstrip('\n') for line in chunk])
+            chrom, pos, vid, ref, alt, qual, filt, info = columns(lines, 8)
+            total += len(lines)
+            add_counts(chromosomes, chrom)
+            add_counts(types, variant_types(ref, alt))
+            add_counts(effects, consequences(info))
+            for key in frequency_keys:
+                values = frequencies(info, key)
+                valid = np.isfinite(values) & (values >= 0.0) & (values <= 1.0)
+                histograms[key] += np.histogram(values[valid], bins=edges)[0]
+                missing[key] += int(len(values) - valid.sum())
+
+    return {
+        'variants': total,
+        'by_chromosome': top(chromosomes),
+        'by_type': types,
+        'by_consequence': top(effects),
+        'allele_frequency': {
+            key: {'bin_edges': [f"{edge:.2f}" for edge in edges],
+                  'counts': [int(c) for c in histograms[key]],
+                  'missing': missing[key]}
+            for key in frequency_keys
+        }
+    }
+
+### EOF
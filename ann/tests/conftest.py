@@ -0,0 +1,138 @@
+# conftest.py
+#
+# Shared setup for the annotator tests
+#
+# The annotator modules read ann_config.ini from the working directory
+# and create their AWS clients when imported, so the tests run from a
+# scratch copy of the config with moto standing in for AWS. moto is
+# imported first so every client the modules create is routed to it.
+# AnnTools (driver.py) is installed next to the annotator, not kept in
+# this repository; where it is missing, a stand-in that writes the same
+# two output files takes its place.
+#
+# Run from the repository root:
+#   python -m pytest -q ann/tests
+#
+##
+
+import os
+import sys
+import json
+import types
+import shutil
+import tempfile
+
+import pytest
+
+ANN_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+os.environ.update({
+    'AWS_ACCESS_KEY_ID': 'testing',
+    'AWS_SECRET_ACCESS_KEY': 'testing',
+    'AWS_SECURITY_TOKEN': 'testing',
+    'AWS_SESSION_TOKEN': 'testing',
+    'AWS_DEFAULT_REGION': 'us-east-1'
+})
+
+from moto import mock_aws
+
+WORK_DIR = tempfile.mkdtemp(prefix='ann-tests-')
+shutil.copy(os.path.join(ANN_DIR, 'ann_config.ini'), WORK_DIR)
+os.chdir(WORK_DIR)
+sys.path.insert(0, ANN_DIR)
+
+
+def annotate_vcf(input_file_path, kind):
+    # Writes what AnnTools writes: the input with an ANN= INFO key on
+    # every record that has an INFO column, and a .count.log of the
+    # records it read
+    count = 0
+    with open(input_file_path) as f, \
+            open(input_file_path.replace('.vcf', '.annot.vcf'), 'w') as out:
+        for line in f:
+            if line.startswith('#') or not line.strip():
+                out.write(line)
+                continue
+            columns = line.rstrip('\n').split('\t')
+            if len(columns) > 7:
+                columns[7] = f"{columns[7]};ANN={columns[0]}_{columns[1]}"
+            out.write('\t'.join(columns) + '\n')
+            count += 1
+    with open(input_file_path + '.count.log', 'w') as log:
+        log.write(f"Total number of variants annotated: {count}\n")
+
+
+try:
+    import driver
+except ImportError:
+    driver = types.ModuleType('driver')
+    driver.run = annotate_vcf
+    sys.modules['driver'] = driver
+
+
+class AWS(object):
+    """The resources named in ann_config.ini, created in moto"""
+    def __init__(self):
+        import boto3
+        import annotator
+        self.sqs = boto3.client('sqs')
+        self.s3 = boto3.client('s3')
+        self.dynamodb = boto3.resource('dynamodb')
+        self.table = self.dynamodb.create_table(
+            TableName=annotator.dynamodb_table_name,
+            KeySchema=[{'AttributeName': 'job_id', 'KeyType': 'HASH'}],
+            AttributeDefinitions=[{'AttributeName': 'job_id', 'AttributeType': 'S'}],
+            BillingMode='PAY_PER_REQUEST'
+        )
+        self.queue_url = self.sqs.create_queue(QueueName='job_requests')['QueueUrl']
+        self.s3.create_bucket(Bucket=annotator.s3_results_bucket)
+        self.s3.create_bucket(Bucket='gas-inputs')
+
+    def send(self, job_id, user_id='user-1', key=None, priority=None):
+        """Sends a request message for job_id and receives it, as the
+        annotator's poller would"""
+        body = {
+            'job_id': job_id,
+            'user_id': user_id,
+            'input_file_name': 'test.vcf',
+            's3_inputs_bucket': 'gas-inputs',
+            's3_key_input_file': key or f"inputs/{user_id}/{job_id}~test.vcf"
+        }
+        if priority:
+            body['priority'] = priority
+        self.sqs.send_message(QueueUrl=self.queue_url,
+                              MessageBody=json.dumps({'Message': json.dumps(body)}))
+        return self.receive()
+
+    def receive(self):
+        messages = self.sqs.receive_message(QueueUrl=self.queue_url, AttributeNames=['All'],
+                                            MaxNumberOfMessages=1).get('Messages', [])
+        if not messages:
+            return None
+        messages[0]['QueueUrl'] = self.queue_url
+        return messages[0]
+
+    def visible(self):
+        attributes = self.sqs.get_queue_attributes(
+            QueueUrl=self.queue_url, AttributeNames=['ApproximateNumberOfMessages'])
+        return int(attributes['Attributes']['ApproximateNumberOfMessages'])
+
+
+@pytest.fixture
+def aws():
+    with mock_aws():
+        yield AWS()
+
+
+@pytest.fixture
+def work_dir(tmp_path, monkeypatch):
+    # Each test gets its own job_info_dir and journal
+    import annotator
+    import journal
+    job_dir = str(tmp_path / 'jobs')
+    monkeypatch.setattr(annotator, 'job_info_dir', job_dir)
+    monkeypatch.setattr(journal, 'db_path', str(tmp_path / 'journal.db'))
+    monkeypatch.setattr(journal, '_local', type(journal._local)())
+    return tmp_path
+
+### EOF
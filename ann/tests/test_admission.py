@@ -0,0 +1,126 @@
+# test_admission.py
+#
+# Disk admission: jobs and distributed shards reserve workspace before
+# they start, and only the max_input_mb limit fails a job outright
+#
+##
+
+import os
+import collections
+
+import pytest
+
+import annotator
+import distributed
+
+MB = 1024 * 1024
+Usage = collections.namedtuple('Usage', 'total used free')
+
+
+@pytest.fixture
+def free_disk(monkeypatch, work_dir):
+    # Free space on the job volume, as the test sets it
+    free = {'bytes': 100 * MB}
+    monkeypatch.setattr(annotator.shutil, 'disk_usage',
+                        lambda path: Usage(1000 * MB, 1000 * MB - free['bytes'], free['bytes']))
+    monkeypatch.setattr(annotator, 'min_free_bytes', 10 * MB)
+    monkeypatch.setattr(annotator, 'disk_budget', annotator.DiskBudget(str(work_dir / 'jobs')))
+    return free
+
+
+def test_jobs_are_admitted_while_they_fit(free_disk, work_dir):
+    budget = annotator.disk_budget
+    assert budget.admit('m1', str(work_dir / 'jobs' / 'j1'), 50 * MB)
+    assert not budget.admit('m2', str(work_dir / 'jobs' / 'j2'), 50 * MB)
+    budget.release('m1')
+    assert budget.admit('m2', str(work_dir / 'jobs' / 'j2'), 50 * MB)
+
+
+def test_bytes_written_count_against_their_own_reservation(free_disk, work_dir):
+    budget = annotator.disk_budget
+    job_dir = work_dir / 'jobs' / 'j1'
+    assert budget.admit('m1', str(job_dir), 50 * MB)
+    # The job writes 40MB of its 50MB, which the volume reports as used
+    os.makedirs(job_dir)
+    with open(job_dir / 'input.vcf', 'wb') as f:
+        f.truncate(40 * MB)
+    free_disk['bytes'] -= 40 * MB
+    assert budget.admit('m2', str(work_dir / 'jobs' / 'j2'), 40 * MB)
+    assert not budget.admit('m3', str(work_dir / 'jobs' / 'j3'), 1 * MB)
+
+
+def put_input(aws, job_id, size):
+    key = f"inputs/user-1/{job_id}~test.vcf"
+    aws.s3.put_object(Bucket='gas-inputs', Key=key, Body=b'#' * size)
+    aws.table.put_item(Item={'job_id': job_id, 'user_id': 'user-1', 'job_status': 'PENDING'})
+    return aws.send(job_id, key=key)
+
+
+def test_job_too_big_for_this_box_is_deferred_not_failed(aws, free_disk, monkeypatch):
+    monkeypatch.setattr(annotator, 'workspace_factor', 1000.0)
+    message = put_input(aws, 'job-1', 1 * MB)
+    job = annotator.parse_job(message)
+
+    assert not annotator.admit_job(job, message)
+    assert aws.table.get_item(Key={'job_id': 'job-1'})['Item']['job_status'] == 'PENDING'
+    # Hidden for defer_seconds, not deleted
+    assert aws.receive() is None
+    assert annotator.disk_budget.reservations == {}
+
+
+def test_job_over_max_input_is_failed(aws, free_disk, monkeypatch):
+    monkeypatch.setattr(annotator, 'max_input_bytes', MB // 2)
+    message = put_input(aws, 'job-1', 1 * MB)
+    job = annotator.parse_job(message)
+
+    assert not annotator.admit_job(job, message)
+    item = aws.table.get_item(Key={'job_id': 'job-1'})['Item']
+    assert item['job_status'] == 'FAILED'
+
+
+@pytest.fixture
+def shard_table(aws):
+    distributed.create_table()
+    return distributed.shard_table()
+
+
+def put_shard(shard_table, job_id, shard_no):
+    shard_table.put_item(Item={'job_id': job_id, 'shard_no': shard_no, 'shard_status': 'PENDING',
+                               'claimable': 'Y', 'lease_expires': 0, 'attempts': 0})
+
+
+def test_shard_is_leased_only_with_disk_reserved(shard_table, free_disk, monkeypatch):
+    monkeypatch.setattr(distributed, 'shard_size', 20 * MB)
+    monkeypatch.setattr(annotator, 'workspace_factor', 3.0)
+    put_shard(shard_table, 'job-1', 0)
+
+    admitted = []
+    assert distributed.claim('a', lambda j, s: annotator.admit_shard_work(j, s, admitted)) == ('job-1', 0)
+    assert annotator.disk_budget.reservations['job-1:0'][1] == 60 * MB
+
+    # Not enough room left for a second shard: it stays for other annotators
+    put_shard(shard_table, 'job-1', 1)
+    assert distributed.claim('a', lambda j, s: annotator.admit_shard_work(j, s, [])) is None
+    item = shard_table.get_item(Key={'job_id': 'job-1', 'shard_no': 1})['Item']
+    assert 'lease_owner' not in item and item['attempts'] == 0
+
+    # The reservation goes when the shard's child is settled
+    annotator.settle_job('job-1:0', 0, None)
+    assert annotator.disk_budget.reservations == {}
+
+
+def test_merge_reserves_room_for_every_shard(shard_table, free_disk, monkeypatch):
+    monkeypatch.setattr(distributed, 'shard_size', 10 * MB)
+    monkeypatch.setattr(annotator, 'workspace_factor', 3.0)
+    shard_table.put_item(Item={'job_id': 'job-1', 'shard_no': distributed.MANIFEST,
+                               'shard_status': 'MERGE', 'shard_count': 4, 'claimable': 'Y',
+                               'lease_expires': 0, 'attempts': 0})
+
+    # 4 shards x 10MB x 3 doesn't fit in 90MB
+    assert distributed.claim('a', lambda j, s: annotator.admit_shard_work(j, s, [])) is None
+    free_disk['bytes'] = 200 * MB
+    assert distributed.claim('a', lambda j, s: annotator.admit_shard_work(j, s, [])) == \
+        ('job-1', distributed.MANIFEST)
+    assert annotator.disk_budget.reservations['job-1:-1'][1] == 120 * MB
+
+### EOF
@@ -0,0 +1,39 @@
+# test_aws_clients.py
+#
+# Connection pools sized from the annotator's concurrency, and DynamoDB
+# tables that are never shared between threads
+#
+##
+
+import threading
+
+import annotator
+import aws_clients
+import distributed
+import progress
+import run
+
+
+def test_annotator_pool_holds_every_dispatch_workers_download_parts():
+    pool = annotator.s3.meta.config.max_pool_connections
+    assert pool == annotator.dispatch_workers * annotator.download_concurrency
+
+
+def test_pool_size_from_the_caller_wins_over_the_default(aws):
+    assert aws_clients.client('sqs', annotator.config, max_pool_connections=7) \
+        .meta.config.max_pool_connections == 7
+    assert aws_clients.client('sqs', annotator.config).meta.config.max_pool_connections == \
+        aws_clients.DEFAULT_MAX_POOL_CONNECTIONS
+
+
+def test_each_thread_gets_its_own_table(aws):
+    for jobs_table in (annotator.jobs_table, run.jobs_table, progress.jobs_table,
+                       distributed.jobs_table):
+        tables = []
+        thread = threading.Thread(target=lambda: tables.append(jobs_table()))
+        thread.start()
+        thread.join()
+        assert tables[0].meta.client is not jobs_table().meta.client
+        assert jobs_table().meta.client is jobs_table().meta.client
+
+### EOF
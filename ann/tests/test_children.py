@@ -0,0 +1,63 @@
+# test_children.py
+#
+# Children cut off by the drain deadline are killed with everything
+# they started
+#
+##
+
+import os
+import sys
+import time
+
+import annotator
+
+# Starts a grandchild that outlives it unless its group is killed
+PARENT = '''
+import subprocess, sys, time
+grandchild = subprocess.Popen([sys.executable, '-c', 'import time; time.sleep(60)'])
+with open(sys.argv[1], 'w') as f:
+    f.write(str(grandchild.pid))
+time.sleep(60)
+'''
+
+
+def alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    # A zombie waiting for init to reap it is dead too
+    with open(f"/proc/{pid}/stat") as f:
+        return f.read().split(')')[-1].split()[0] != 'Z'
+
+
+def wait_for(predicate, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.1)
+    return False
+
+
+def test_abandoned_child_is_killed_with_its_own_children(tmp_path):
+    pid_file = tmp_path / 'grandchild.pid'
+    child = annotator.ChildProcess([sys.executable, '-c', PARENT, str(pid_file)])
+    assert wait_for(lambda: pid_file.exists() and pid_file.read_text())
+    grandchild = int(pid_file.read_text())
+
+    supervisor = annotator.Supervisor(1)
+    supervisor.children['job-1'] = (child, time.time(), None)
+    assert [job_id for job_id, *rest in supervisor.abandon()] == ['job-1']
+
+    assert child.wait(timeout=10) != 0
+    assert wait_for(lambda: not alive(grandchild))
+
+
+def test_kill_of_a_finished_child_is_a_no_op():
+    child = annotator.ChildProcess([sys.executable, '-c', 'pass'])
+    child.wait(timeout=10)
+    child.kill()
+    assert child.returncode == 0
+
+### EOF
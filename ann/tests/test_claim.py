@@ -0,0 +1,117 @@
+# test_claim.py
+#
+# Claiming jobs, taking over stale ones and stamping heartbeats
+#
+##
+
+import time
+
+import annotator
+
+
+def job_for(message):
+    return annotator.parse_job(message)
+
+
+def put_job(aws, job_id, status, **attributes):
+    item = {'job_id': job_id, 'user_id': 'user-1', 'job_status': status}
+    item.update(attributes)
+    aws.table.put_item(Item=item)
+
+
+def test_pending_job_is_claimed_with_a_heartbeat(aws):
+    put_job(aws, 'job-1', 'PENDING')
+    message = aws.send('job-1')
+    job = job_for(message)
+
+    assert annotator.check_job(job, message)
+    assert annotator.claim_job(job, message)
+    item = aws.table.get_item(Key={'job_id': 'job-1'})['Item']
+    assert item['job_status'] == 'RUNNING'
+    assert item['lease_owner'] == annotator.job_owner
+    assert item['heartbeat_at'] >= int(time.time()) - 5
+    annotator.leases.release(message)
+
+
+def test_only_one_claim_of_a_pending_job_wins(aws):
+    put_job(aws, 'job-1', 'PENDING')
+    message = aws.send('job-1')
+    first, second = job_for(message), job_for(message)
+
+    assert annotator.check_job(first, message) and annotator.check_job(second, message)
+    assert annotator.claim_job(first, message)
+    assert not annotator.claim_job(second, message)
+    annotator.leases.release(message)
+
+
+def test_redelivered_message_of_a_healthy_job_is_deferred(aws):
+    # Duplicates, deferrals and late heartbeats all raise the receive count
+    put_job(aws, 'job-1', 'RUNNING', lease_owner='other', heartbeat_at=int(time.time()))
+    first = aws.send('job-1')
+    aws.sqs.change_message_visibility(QueueUrl=aws.queue_url,
+                                      ReceiptHandle=first['ReceiptHandle'],
+                                      VisibilityTimeout=0)
+    message = aws.receive()
+    assert int(message['Attributes']['ApproximateReceiveCount']) > 1
+
+    assert not annotator.check_job(job_for(message), message)
+    item = aws.table.get_item(Key={'job_id': 'job-1'})['Item']
+    assert item['lease_owner'] == 'other'
+    # Hidden again rather than deleted, so a later delivery can take over
+    # should the other annotator die
+    assert aws.visible() == 0
+    assert aws.receive() is None
+
+
+def test_job_with_a_stale_heartbeat_is_taken_over(aws):
+    stale = int(time.time()) - annotator.visibility_timeout - 10
+    put_job(aws, 'job-1', 'RUNNING', lease_owner='other', heartbeat_at=stale)
+    message = aws.send('job-1')
+    job = job_for(message)
+
+    assert annotator.check_job(job, message)
+    assert annotator.claim_job(job, message)
+    item = aws.table.get_item(Key={'job_id': 'job-1'})['Item']
+    assert item['lease_owner'] == annotator.job_owner
+    assert item['heartbeat_at'] > stale
+    annotator.leases.release(message)
+
+
+def test_takeover_fails_once_the_owner_heartbeats_again(aws):
+    stale = int(time.time()) - annotator.visibility_timeout - 10
+    put_job(aws, 'job-1', 'RUNNING', lease_owner='other', heartbeat_at=stale)
+    message = aws.send('job-1')
+    job = job_for(message)
+    assert annotator.check_job(job, message)
+
+    aws.table.update_item(Key={'job_id': 'job-1'}, UpdateExpression='SET heartbeat_at = :now',
+                          ExpressionAttributeValues={':now': int(time.time())})
+    assert not annotator.claim_job(job, message)
+    assert aws.table.get_item(Key={'job_id': 'job-1'})['Item']['lease_owner'] == 'other'
+
+
+def test_distributed_job_without_heartbeat_is_not_taken_over(aws):
+    put_job(aws, 'job-1', 'RUNNING')
+    message = aws.send('job-1')
+
+    assert not annotator.check_job(job_for(message), message)
+    assert aws.table.get_item(Key={'job_id': 'job-1'})['Item']['job_status'] == 'RUNNING'
+
+
+def test_heartbeat_stamps_owned_jobs_and_drops_lost_ones(aws):
+    old = int(time.time()) - 60
+    put_job(aws, 'job-1', 'RUNNING', lease_owner=annotator.job_owner, heartbeat_at=old)
+    put_job(aws, 'job-2', 'RUNNING', lease_owner='other', heartbeat_at=old)
+    ours, lost = aws.send('job-1'), aws.send('job-2')
+    annotator.leases.hold(ours, 'job-1')
+    annotator.leases.hold(lost, 'job-2')
+
+    annotator.leases.heartbeat()
+    assert aws.table.get_item(Key={'job_id': 'job-1'})['Item']['heartbeat_at'] > old
+    assert aws.table.get_item(Key={'job_id': 'job-2'})['Item']['heartbeat_at'] == old
+    assert ours['MessageId'] in annotator.leases.jobs
+    assert lost['MessageId'] not in annotator.leases.jobs
+    annotator.leases.release(ours)
+    annotator.leases.release(lost)
+
+### EOF
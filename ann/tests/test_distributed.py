@@ -0,0 +1,38 @@
+# test_distributed.py
+#
+# Which inputs are annotated by the whole fleet
+#
+##
+
+import pytest
+
+import distributed
+
+MB = 1024 * 1024
+
+
+@pytest.fixture
+def fleet(monkeypatch):
+    monkeypatch.setattr(distributed, 'enabled', True)
+    monkeypatch.setattr(distributed, 'min_size', 4 * MB)
+    monkeypatch.setattr(distributed, 'compressed_ratio', 4.0)
+
+
+def sized(tmp_path, name, size):
+    path = tmp_path / name
+    with open(path, 'wb') as f:
+        f.truncate(size)
+    return str(path)
+
+
+def test_compressed_input_is_sized_as_decompressed(fleet, tmp_path):
+    assert distributed.wanted(sized(tmp_path, 'big.vcf.gz', 1 * MB))
+    assert distributed.wanted(sized(tmp_path, 'big.vcf.bgz', 1 * MB))
+    assert not distributed.wanted(sized(tmp_path, 'small.vcf.gz', MB // 2))
+
+
+def test_plain_input_is_sized_as_it_is(fleet, tmp_path):
+    assert not distributed.wanted(sized(tmp_path, 'small.vcf', 1 * MB))
+    assert distributed.wanted(sized(tmp_path, 'big.vcf', 4 * MB))
+
+### EOF
@@ -0,0 +1,121 @@
+# test_notify.py
+#
+# The completion notifier (util/notify/notify.py): one email per user
+# for the completions of a window, sent within the SES send rate
+#
+# notify.py imports util/helpers.py, which needs psycopg2 for the
+# accounts database; without it these tests are skipped.
+#
+##
+
+import os
+import sys
+import json
+import shutil
+import importlib.util
+
+import pytest
+
+pytest.importorskip('psycopg2')
+
+UTIL_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__)))), 'util')
+# notify.py reads notify_config.ini from the working directory and
+# imports helpers from util/, as on the Utils instance
+shutil.copy(os.path.join(UTIL_DIR, 'notify', 'notify_config.ini'), os.getcwd())
+sys.path.insert(0, UTIL_DIR)
+spec = importlib.util.spec_from_file_location('notify', os.path.join(UTIL_DIR, 'notify', 'notify.py'))
+notify = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(notify)
+
+
+class Clock(object):
+    """Stands in for the time module; sleeping moves the clock on"""
+    def __init__(self):
+        self.now = 1000.0
+        self.slept = 0.0
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+        self.slept += seconds
+
+
+def test_bucket_allows_a_burst_then_the_rate(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(notify, 'time', clock)
+    bucket = notify.TokenBucket(2, 3)
+    for i in range(3):
+        bucket.acquire()
+    assert clock.slept == 0
+    bucket.acquire()
+    assert clock.slept == pytest.approx(0.5)
+
+    # Idle time refills the bucket up to its capacity only
+    clock.now += 60
+    for i in range(3):
+        bucket.acquire()
+    assert clock.slept == pytest.approx(0.5)
+    bucket.acquire()
+    assert clock.slept == pytest.approx(1.0)
+
+
+def test_send_rate_is_capped_by_the_ses_quota(aws, monkeypatch):
+    quota = notify.ses.get_send_quota()['MaxSendRate']
+    monkeypatch.setattr(notify, 'send_rate', quota * 10)
+    assert notify.allowed_send_rate() == quota
+    monkeypatch.setattr(notify, 'send_rate', quota / 10)
+    assert notify.allowed_send_rate() == quota / 10
+
+
+class Stop(BaseException):
+    pass
+
+
+def test_one_email_per_user_for_a_window_of_completions(aws, monkeypatch):
+    # The annotator's jobs table, which aws has created
+    table = aws.dynamodb.Table(notify.dynamodb_table_name)
+    queue_url = aws.sqs.create_queue(QueueName='job_results')['QueueUrl']
+    monkeypatch.setattr(notify, 'queue_url_results', queue_url)
+    monkeypatch.setattr(notify, 'window_seconds', 0)
+
+    completions = [('user-a', 'job-1'), ('user-a', 'job-1'), ('user-a', 'job-2'),
+                   ('user-b', 'job-3')]
+    for user_id, job_id in completions:
+        table.put_item(Item={'job_id': job_id, 'user_id': user_id,
+                             'input_file_name': f"{job_id}.vcf", 'complete_time': 0})
+        body = {'message_type': 'result_message', 'user_id': user_id, 'job_id': job_id}
+        aws.sqs.send_message(QueueUrl=queue_url,
+                             MessageBody=json.dumps({'Message': json.dumps(body)}))
+
+    emails = []
+    monkeypatch.setattr(notify, 'get_user_profile',
+                        lambda id=None: {'email': f"{id}@example.com"})
+    monkeypatch.setattr(notify, 'send_email_ses',
+                        lambda recipients, subject, body: emails.append((recipients, subject)))
+
+    receive_message = notify.sqs.receive_message
+    calls = []
+
+    def receive_once(**kwargs):
+        if calls:
+            raise Stop()
+        calls.append(kwargs)
+        return receive_message(**kwargs)
+    monkeypatch.setattr(notify.sqs, 'receive_message', receive_once)
+
+    with pytest.raises(Stop):
+        notify.main()
+    assert sorted(emails) == [
+        ('user-a@example.com', 'Results available for 2 annotation jobs'),
+        ('user-b@example.com', 'Results available for job job-3')]
+    # Every message, duplicates included, was deleted once emailed
+    attributes = aws.sqs.get_queue_attributes(
+        QueueUrl=queue_url, AttributeNames=['ApproximateNumberOfMessages',
+                                            'ApproximateNumberOfMessagesNotVisible'])
+    assert attributes['Attributes'] == {'ApproximateNumberOfMessages': '0',
+                                        'ApproximateNumberOfMessagesNotVisible': '0'}
+
+### EOF
@@ -0,0 +1,65 @@
+# test_pool.py
+#
+# Warm worker pools and the pipeline's compute pool: a worker that dies
+# fails its job instead of holding the job slot and the message forever
+#
+##
+
+import os
+import time
+
+import pytest
+
+import annotator
+import workers
+
+
+def wait_for(predicate, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        result = predicate()
+        if result is not None:
+            return result
+        time.sleep(0.1)
+    raise AssertionError('timed out')
+
+
+@pytest.fixture
+def pool():
+    pool = annotator.WarmPool(2)
+    pool.start()
+    yield pool
+    pool.terminate()
+
+
+def test_dead_worker_fails_its_job(pool):
+    job = annotator.PoolJob(pool.submit(workers.die))
+    assert wait_for(job.poll) == 1
+
+
+def test_pool_is_replaced_after_a_worker_died(pool):
+    wait_for(annotator.PoolJob(pool.submit(workers.die)).poll)
+    job = annotator.PoolJob(pool.submit(os.getpid))
+    assert wait_for(job.poll) == 0
+
+
+def test_terminate_kills_running_jobs(pool):
+    job = annotator.PoolJob(pool.submit(time.sleep, 60))
+    time.sleep(1)
+    pool.terminate()
+    assert wait_for(job.poll, timeout=10) == 1
+
+
+def test_dead_compute_worker_fails_its_pipeline_job(monkeypatch):
+    monkeypatch.setattr(annotator.run, 'annotate_job', workers.die)
+    pipeline = annotator.Pipeline(1)
+    pipeline.start()
+    try:
+        job = pipeline.submit('/nonexistent/test.vcf', 'user-1', '')
+        assert wait_for(job.poll) == 1
+        assert pipeline.queued == {'compute': 0, 'upload': 0}
+    finally:
+        pipeline.pool.terminate()
+        pipeline.uploads.shutdown()
+
+### EOF
@@ -0,0 +1,93 @@
+# test_progress.py
+#
+# Partial results: only complete records are uploaded, in input order,
+# and the parts stay until the job is COMPLETED
+#
+##
+
+import pytest
+
+import progress
+import run
+
+HEADER = b'##fileformat=VCFv4.2\n#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n'
+
+
+def record(pos):
+    return f"1\t{pos}\t.\tA\tG\t50\tPASS\tDP=10;ANN=x\n".encode('utf-8')
+
+
+@pytest.fixture
+def watcher(tmp_path):
+    input_file = tmp_path / 'input.vcf'
+    input_file.write_bytes(HEADER + record(1) + record(2) + record(3))
+    return progress.Progress('job-1', str(input_file), 'user/job-1/input.annot.vcf')
+
+
+def test_record_being_written_waits_for_a_later_part(watcher, tmp_path):
+    output = tmp_path / 'input.annot.vcf'
+    output.write_bytes(HEADER + record(1) + record(2)[:5])
+    watcher.watch([str(output)])
+
+    data, records = watcher.read_new(1024 * 1024)
+    assert (data, records) == (HEADER + record(1), 1)
+
+    output.write_bytes(HEADER + record(1) + record(2))
+    assert watcher.read_new(1024 * 1024) == (record(2), 1)
+
+
+def test_shards_are_read_in_order_with_one_header(watcher, tmp_path):
+    shards = [tmp_path / 'shard_0.annot.vcf', tmp_path / 'shard_1.annot.vcf']
+    shards[1].write_bytes(HEADER + record(3))
+    watcher.watch([str(path) for path in shards])
+    # The second shard is done first but waits for the first
+    watcher.finished(1)
+    assert watcher.read_new(1024 * 1024) == (b'', 0)
+
+    shards[0].write_bytes(HEADER + record(1) + record(2))
+    watcher.finished(0)
+    assert watcher.read_new(1024 * 1024) == (HEADER + record(1) + record(2) + record(3), 3)
+
+
+def test_flush_uploads_parts_and_records_them_on_the_job(aws, watcher, tmp_path, monkeypatch):
+    monkeypatch.setattr(progress, 'min_part_size', 1)
+    aws.table.put_item(Item={'job_id': 'job-1', 'user_id': 'user-1', 'job_status': 'RUNNING'})
+    output = tmp_path / 'input.annot.vcf'
+    output.write_bytes(HEADER + record(1) + record(2))
+    watcher.watch([str(output)])
+    watcher.total = 3
+
+    watcher.flush()
+    part = aws.s3.get_object(Bucket=progress.s3_results_bucket,
+                             Key=progress.part_key(watcher.prefix, 1))
+    assert part['Body'].read() == HEADER + record(1) + record(2)
+    item = aws.table.get_item(Key={'job_id': 'job-1'})['Item']
+    assert (item['partial_parts'], item['partial_records'], item['progress_percent']) == (1, 2, 66)
+    assert item['s3_key_partial_prefix'] == 'user/job-1/partial/'
+
+
+def test_parts_are_cleared_only_once_the_job_is_completed(aws, tmp_path, monkeypatch):
+    monkeypatch.setattr(progress, 'enabled', True)
+    monkeypatch.setattr(run.journal, 'enabled', False)
+    job_dir = tmp_path / 'job-1'
+    job_dir.mkdir()
+    input_file = job_dir / 'input.vcf'
+    input_file.write_bytes(HEADER + record(1))
+    (job_dir / 'input.annot.vcf').write_bytes(HEADER + record(1))
+    (job_dir / 'input.vcf.count.log').write_text('Total number of variants annotated: 1\n')
+    prefix = progress.partial_prefix(run.result_locations(str(input_file))[2])
+    aws.s3.put_object(Bucket=progress.s3_results_bucket, Key=progress.part_key(prefix, 1),
+                      Body=HEADER)
+
+    def partial_keys():
+        listed = aws.s3.list_objects_v2(Bucket=progress.s3_results_bucket, Prefix=prefix)
+        return [obj['Key'] for obj in listed.get('Contents', [])]
+
+    parts_at_completion = []
+    monkeypatch.setattr(run, 'complete_job',
+                        lambda *args, **kwargs: parts_at_completion.extend(partial_keys()))
+    assert run.publish_results(str(input_file), 'user-1')
+    assert parts_at_completion == [progress.part_key(prefix, 1)]
+    assert partial_keys() == []
+
+### EOF
@@ -0,0 +1,71 @@
+# test_result_cache.py
+#
+# Result cache keys, the logs it stores and hits found before download
+#
+##
+
+import pytest
+
+import annotator
+import result_cache
+import run
+
+
+@pytest.fixture
+def cache(aws, monkeypatch):
+    monkeypatch.setattr(result_cache, 'enabled', True)
+    monkeypatch.setattr(result_cache, 'reference_version', 'test-ref')
+    return aws
+
+
+def test_object_digest_prefers_the_sha256_checksum(monkeypatch):
+    monkeypatch.setattr(result_cache, 'reference_version', 'test-ref')
+    by_etag = result_cache.object_digest({'ETag': '"0123abcd"'})
+    by_checksum = result_cache.object_digest({'ETag': '"0123abcd"', 'ChecksumSHA256': 'q83v'})
+
+    assert by_etag and by_checksum and by_etag != by_checksum
+    assert result_cache.object_digest({'ETag': '"0123abcd"'}) == by_etag
+    monkeypatch.setattr(result_cache, 'reference_version', 'other-ref')
+    assert result_cache.object_digest({'ETag': '"0123abcd"'}) != by_etag
+
+
+def test_multipart_inputs_have_no_object_digest():
+    assert result_cache.object_digest({'ETag': '"0123abcd-3"'}) is None
+    assert result_cache.object_digest({'ETag': '"0123abcd-3"', 'ChecksumSHA256': 'q83v-3'}) is None
+    assert result_cache.object_digest({}) is None
+
+
+def test_stored_log_has_no_job_profile(cache, tmp_path):
+    log_file = tmp_path / 'input.vcf.count.log'
+    log_file.write_text('Total number of variants annotated: 4\n')
+    profile = run.Profile()
+    profile.values['annotate_seconds'] = 1.5
+    run.append_profile(str(log_file), profile)
+    assert run.PROFILE_MARKER in log_file.read_text()
+
+    cache.s3.put_object(Bucket=result_cache.s3_results_bucket, Key='job/result.annot.vcf', Body=b'#\n')
+    result_cache.store('d1', 'job/result.annot.vcf', run.job_log(str(log_file)))
+    assert result_cache.copy_to_job('d1', 'job2/result.annot.vcf', 'job2/result.count.log')
+    log = cache.s3.get_object(Bucket=result_cache.s3_results_bucket, Key='job2/result.count.log')
+    assert log['Body'].read() == b'Total number of variants annotated: 4\n'
+
+
+def test_hit_completes_the_job_without_downloading_its_input(cache, work_dir, monkeypatch):
+    monkeypatch.setattr(annotator, 'download_file_from_s3',
+                        lambda *args: pytest.fail('downloaded'))
+    key = 'inputs/user-1/job-1~test.vcf'
+    cache.s3.put_object(Bucket='gas-inputs', Key=key, Body=b'#CHROM\n')
+    cache.table.put_item(Item={'job_id': 'job-1', 'user_id': 'user-1', 'job_status': 'PENDING'})
+    digest = result_cache.object_digest(cache.s3.head_object(Bucket='gas-inputs', Key=key))
+    for cached_key in result_cache.cache_keys(digest):
+        cache.s3.put_object(Bucket=result_cache.s3_results_bucket, Key=cached_key, Body=b'#\n')
+
+    message = cache.send('job-1', key=key)
+    job = annotator.parse_job(message)
+    assert annotator.handle_message(message, job) is False
+    assert job['cached']
+    assert cache.table.get_item(Key={'job_id': 'job-1'})['Item']['job_status'] == 'COMPLETED'
+    # The request is done with
+    assert cache.receive() is None and cache.visible() == 0
+
+### EOF
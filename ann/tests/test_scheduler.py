@@ -0,0 +1,110 @@
+# test_scheduler.py
+#
+# Fair-share scheduling of buffered jobs, per-user caps and the job
+# slots reserved for premium jobs
+#
+##
+
+import itertools
+
+import pytest
+
+import annotator
+
+MAIN_QUEUE = 'https://sqs.example/main'
+PREMIUM_QUEUE = 'https://sqs.example/premium'
+
+ids = itertools.count()
+
+
+def entry(user_id, tier='free', queue_url=MAIN_QUEUE):
+    message = {'MessageId': f"m{next(ids)}", 'QueueUrl': queue_url}
+    return message, {'job_id': message['MessageId'], 'user_id': user_id, 'tier': tier}
+
+
+@pytest.fixture
+def slots(monkeypatch):
+    monkeypatch.setattr(annotator, 'premium_reserved_slots', 1)
+    monkeypatch.setattr(annotator, 'premium_queue_url', '')
+    monkeypatch.setattr(annotator, 'user_max_jobs', {'premium': 0, 'free': 0})
+    monkeypatch.setattr(annotator, 'user_buffer_size', 100)
+    return {'free': 10}
+
+
+def scheduler_for(slots, max_jobs=10):
+    return annotator.Scheduler(max_jobs, lambda: slots['free'])
+
+
+def test_premium_users_get_weighted_turns(slots):
+    scheduler = scheduler_for(slots)
+    for _ in range(5):
+        scheduler.add(*entry('premium-user', 'premium'))
+        scheduler.add(*entry('free-user'))
+
+    started = [scheduler.next(10)[1]['user_id'] for _ in range(5)]
+    assert started.count('premium-user') == annotator.weights['premium'] // annotator.weights['free']
+    assert started.count('free-user') == 1
+
+
+def test_free_job_waits_for_a_slot_outside_the_reserved_ones(slots):
+    scheduler = scheduler_for(slots, max_jobs=2)
+    slots['free'] = 1
+    scheduler.add(*entry('free-user'))
+
+    assert scheduler.next(1) is None
+    # Kept, not shed, and nothing more is received behind it
+    assert scheduler.shed() == []
+    assert scheduler.room(MAIN_QUEUE) == 0
+
+    slots['free'] = 2
+    assert scheduler.next(2)[1]['user_id'] == 'free-user'
+
+
+def test_free_queue_is_not_polled_while_only_reserved_slots_are_free(slots, monkeypatch):
+    monkeypatch.setattr(annotator, 'premium_queue_url', PREMIUM_QUEUE)
+    scheduler = scheduler_for(slots, max_jobs=4)
+    slots['free'] = 1
+
+    assert scheduler.room(MAIN_QUEUE) == 0
+    assert scheduler.room(PREMIUM_QUEUE) == 1
+    slots['free'] = 3
+    assert scheduler.room(MAIN_QUEUE) == 2
+
+
+def test_waiting_free_job_leaves_the_reserved_slot_to_the_premium_queue(slots, monkeypatch):
+    monkeypatch.setattr(annotator, 'premium_queue_url', PREMIUM_QUEUE)
+    scheduler = scheduler_for(slots, max_jobs=4)
+    slots['free'] = 2
+    scheduler.add(*entry('free-user'))
+    slots['free'] = 1
+
+    assert scheduler.room(MAIN_QUEUE) <= 0
+    assert scheduler.room(PREMIUM_QUEUE) == 1
+
+
+def test_jobs_of_users_at_their_cap_are_shed(slots, monkeypatch):
+    monkeypatch.setattr(annotator, 'user_max_jobs', {'premium': 0, 'free': 1})
+    scheduler = scheduler_for(slots)
+    running = entry('free-user')
+    scheduler.adopt(*running)
+    capped = entry('free-user')
+    scheduler.add(*capped)
+
+    assert scheduler.next(10) is None
+    assert scheduler.shed() == [capped]
+    scheduler.finish(running[0])
+    assert scheduler.pending == []
+
+
+def test_schedule_neither_starts_nor_defers_a_free_job_in_a_reserved_slot(slots, monkeypatch):
+    supervisor = annotator.Supervisor(2)
+    monkeypatch.setattr(annotator, 'supervisor', supervisor)
+    monkeypatch.setattr(annotator, 'scheduler', annotator.Scheduler(2, supervisor.free_slots))
+    monkeypatch.setattr(annotator, 'defer_message', lambda *args: pytest.fail('deferred'))
+    supervisor.reserve()
+    annotator.scheduler.add(*entry('free-user'))
+
+    assert annotator.schedule(2) == []
+    assert len(annotator.scheduler.pending) == 1
+
+### EOF
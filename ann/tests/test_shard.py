@@ -0,0 +1,90 @@
+# test_shard.py
+#
+# Sharded annotation gives the same two output files as annotating the
+# whole input at once
+#
+##
+
+import pytest
+
+import driver
+import shard
+
+HEADER = '##fileformat=VCFv4.2\n#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n'
+
+
+def records(count):
+    return ''.join(f"1\t{pos}\t.\tA\tG\t50\tPASS\tDP={pos}\n" for pos in range(1, count + 1))
+
+
+def annotate_vcf(path):
+    driver.run(path, 'vcf')
+
+
+def test_shards_split_at_record_boundaries_and_keep_the_header(tmp_path):
+    input_file = tmp_path / 'input.vcf'
+    input_file.write_text(HEADER + records(100))
+    paths = shard.split(str(input_file), str(tmp_path / 'shards'), 7)
+    assert len(paths) > 1
+    data = ''
+    for path in paths:
+        with open(path) as f:
+            text = f.read()
+        assert text.startswith(HEADER) and text.endswith('\n')
+        data += text[len(HEADER):]
+    assert data == records(100)
+
+
+def test_results_are_merged_in_input_order_with_one_header(tmp_path):
+    paths = []
+    for i, lines in enumerate(['1\t1\n1\t2\n', '1\t3\n', '1\t4\n']):
+        path = tmp_path / f"shard_{i}.annot.vcf"
+        path.write_text(HEADER + lines)
+        paths.append(str(path))
+    results_file = tmp_path / 'input.annot.vcf'
+    shard.merge_results(paths, str(results_file))
+    assert results_file.read_text() == HEADER + '1\t1\n1\t2\n1\t3\n1\t4\n'
+    assert not any((tmp_path / f"shard_{i}.annot.vcf").exists() for i in range(3))
+
+
+def write_logs(tmp_path, logs):
+    paths = []
+    for i, log in enumerate(logs):
+        path = tmp_path / f"shard_{i}.vcf.count.log"
+        path.write_text(log)
+        paths.append(str(path))
+    return paths
+
+
+def test_count_logs_with_the_same_labels_are_summed(tmp_path):
+    paths = write_logs(tmp_path, ['Total: 3\nANN = 2\n', 'Total: 4\nANN = 1\n'])
+    shard.merge_logs(paths, str(tmp_path / 'input.vcf.count.log'))
+    assert (tmp_path / 'input.vcf.count.log').read_text() == 'Total: 7\nANN = 3\n'
+
+
+@pytest.mark.parametrize('logs', [
+    ['Total: 3\n', 'Variants: 4\n'],
+    ['Total: 3\nAnnotated in 2 seconds\n', 'Total: 4\nAnnotated in 3 seconds\n'],
+])
+def test_other_count_logs_are_concatenated_by_shard(tmp_path, logs):
+    paths = write_logs(tmp_path, logs)
+    shard.merge_logs(paths, str(tmp_path / 'input.vcf.count.log'))
+    assert (tmp_path / 'input.vcf.count.log').read_text() == \
+        ''.join(f"# shard {i}\n{log}" for i, log in enumerate(logs))
+
+
+def test_sharded_run_matches_a_whole_run(tmp_path, monkeypatch):
+    monkeypatch.setattr(shard, 'workers', 2)
+    monkeypatch.setattr(shard, 'shards_per_worker', 2)
+    for name in ('whole', 'sharded'):
+        (tmp_path / name).mkdir()
+        (tmp_path / name / 'input.vcf').write_text(HEADER + records(50))
+    annotate_vcf(str(tmp_path / 'whole' / 'input.vcf'))
+    assert shard.annotate(str(tmp_path / 'sharded' / 'input.vcf'), annotate_vcf) == 4
+
+    for name in ('input.annot.vcf', 'input.vcf.count.log'):
+        assert (tmp_path / 'sharded' / name).read_text() == \
+            (tmp_path / 'whole' / name).read_text()
+    assert not (tmp_path / 'sharded' / 'shards').exists()
+
+### EOF
@@ -0,0 +1,59 @@
+# test_summary.py
+#
+# The summary stored on the job item at completion
+#
+##
+
+import pytest
+
+pytest.importorskip('numpy')
+
+import summary
+
+HEADER = '##fileformat=VCFv4.2\n#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n'
+RECORDS = [
+    '1\t10\t.\tA\tG\t50\tPASS\tAF=0.05;CSQ=G|missense_variant|MODERATE',
+    '1\t20\t.\tAC\tA\t50\tPASS\tgnomAD_AF=0.9;AF=0.95;ANN=A|frameshift_variant|HIGH',
+    '2\t30\t.\tA\tAT\t50\tPASS\tAF=.',
+    '2\t40\t.\tAG\tCT\t50\tPASS\tAF=0.5,0.1;ANN=CT|missense_variant|MODERATE',
+    'X\t50\t.\tA\tG,T\t50\tPASS\tDP=3',
+    'X\t60\t.\tA\t<DEL>\t50\tPASS\tAF=1.5',
+]
+
+
+@pytest.fixture
+def results_file(tmp_path, monkeypatch):
+    monkeypatch.setattr(summary, 'frequency_keys', ['AF'])
+    monkeypatch.setattr(summary, 'frequency_bins', 2)
+    path = tmp_path / 'input.annot.vcf'
+    path.write_text(HEADER + ''.join(line + '\n' for line in RECORDS) + '\n')
+    return str(path)
+
+
+def test_counts_and_histograms(results_file):
+    result = summary.summarize(results_file)
+    assert result['variants'] == 6
+    assert result['by_chromosome'] == {'1': 2, '2': 2, 'X': 2}
+    assert result['by_type'] == {'SNV': 1, 'deletion': 1, 'insertion': 1, 'MNV': 1,
+                                 'multiallelic': 1, 'symbolic': 1}
+    assert result['by_consequence'] == {'missense_variant': 2, 'frameshift_variant': 1,
+                                        'unannotated': 3}
+    # gnomAD_AF is not AF; '.', absent and out-of-range values are missing
+    assert result['allele_frequency']['AF'] == {
+        'bin_edges': ['0.00', '0.50', '1.00'], 'counts': [1, 2], 'missing': 3}
+
+
+def test_chunk_size_does_not_change_the_summary(results_file, monkeypatch):
+    whole = summary.summarize(results_file)
+    monkeypatch.setattr(summary, 'chunk_lines', 4)
+    assert summary.summarize(results_file) == whole
+
+
+def test_rare_categories_are_counted_as_other(results_file, monkeypatch):
+    monkeypatch.setattr(summary, 'max_categories', 1)
+    result = summary.summarize(results_file)
+    assert result['by_consequence'] == {'unannotated': 3, 'other': 3}
+    assert sum(result['by_chromosome'].values()) == 6
+    assert len(result['by_chromosome']) == 2
+
+### EOF
@@ -0,0 +1,93 @@
+# test_variant_cache.py
+#
+# Variant cache: cached runs write the same results file and .count.log
+# as AnnTools would for the whole input
+#
+##
+
+import shutil
+
+import pytest
+
+import variant_cache
+from conftest import annotate_vcf
+
+HEADER = '##fileformat=VCFv4.2\n#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n'
+
+
+def record(pos, ref='A', alt='G'):
+    return f"1\t{pos}\t.\t{ref}\t{alt}\t50\tPASS\tDP=10\n"
+
+
+@pytest.fixture
+def cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(variant_cache, 'db_path', str(tmp_path / 'variant_cache.db'))
+    monkeypatch.setattr(variant_cache, '_db', None)
+    monkeypatch.setattr(variant_cache, 'reference_version', 'test-ref')
+    return tmp_path
+
+
+def annotate(tmp_path, name, records, annotate_file=annotate_vcf):
+    # variant_cache.annotate passes annotate_file just the path
+    job_dir = tmp_path / name
+    job_dir.mkdir()
+    path = job_dir / 'input.vcf'
+    path.write_text(HEADER + ''.join(records))
+    counts = variant_cache.annotate(str(path), lambda path: annotate_file(path, 'vcf'))
+    return counts, (job_dir / 'input.annot.vcf').read_text(), \
+        (job_dir / 'input.vcf.count.log').read_text()
+
+
+def uncached(tmp_path, records):
+    job_dir = tmp_path / 'uncached'
+    shutil.rmtree(job_dir, ignore_errors=True)
+    job_dir.mkdir()
+    path = job_dir / 'input.vcf'
+    path.write_text(HEADER + ''.join(records))
+    annotate_vcf(str(path), 'vcf')
+    return (job_dir / 'input.annot.vcf').read_text(), (job_dir / 'input.vcf.count.log').read_text()
+
+
+def test_partial_hit_run_matches_an_uncached_run(cache):
+    annotate(cache, 'first', [record(1), record(2)])
+    records = [record(1), record(3), record(2), record(4)]
+
+    counts, results, log = annotate(cache, 'second', records)
+    assert counts == (2, 2)
+    assert (results, log) == uncached(cache, records)
+    assert log == 'Total number of variants annotated: 4\n'
+
+
+def test_all_hit_run_writes_a_log_for_the_whole_input(cache):
+    annotate(cache, 'first', [record(1), record(2), record(3)])
+    records = [record(3), record(1)]
+
+    counts, results, log = annotate(cache, 'second', records)
+    assert counts == (2, 0)
+    assert (results, log) == uncached(cache, records)
+
+
+def test_log_with_per_category_counts_bypasses_the_cache(cache):
+    def annotate_with_categories(path, kind):
+        annotate_vcf(path, kind)
+        with open(path + '.count.log') as log:
+            total = int(log.read().split(': ')[1])
+        with open(path + '.count.log', 'a') as log:
+            log.write(f"Variants at even positions: {total // 2}\n")
+
+    annotate(cache, 'first', [record(1), record(2)], annotate_with_categories)
+    counts, _, log = annotate(cache, 'second', [record(1), record(2), record(3)],
+                              annotate_with_categories)
+    assert counts == (0, 3)
+    assert log.endswith('Variants at even positions: 1\n')
+
+
+def test_short_records_go_to_anntools_and_are_not_cached(cache):
+    short = '1\t5\t.\tA\tG\n'
+    annotate(cache, 'first', [record(1), short])
+
+    counts, results, _ = annotate(cache, 'second', [record(1), short])
+    assert counts == (1, 1)
+    assert results.endswith(short)
+
+### EOF
@@ -0,0 +1,15 @@
+# workers.py
+#
+# Functions run in warm worker processes by the tests; kept apart from
+# the test modules so a worker can import them without the annotator
+#
+##
+
+import os
+
+
+# Ends the worker the way an OOM kill or a segfault would
+def die(*args):
+    os.abort()
+
+### EOF
@@ -0,0 +1,18 @@
+# util_path.py
+#
+# Puts the shared utilities in ../util (e.g. aws_clients.py) on sys.path
+#
+# The annotator modules import this before any of them:
+#   import util_path
+#   import aws_clients
+#
+##
+
+import os
+import sys
+
+util_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.path.pardir, 'util')
+if util_dir not in sys.path:
+    sys.path.insert(1, util_dir)
+
+### EOF
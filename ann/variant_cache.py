@@ -0,0 +1,307 @@
+# variant_cache.py
+#
+# Variant-level annotation cache shared across jobs
+#
+# Wraps an AnnTools run: records whose (chrom, pos, ref, alt, reference
+# version) were annotated before are filled in from a local SQLite
+# store and only the misses are sent to AnnTools. Cached values hold
+# just what AnnTools added to a record (its ID and new INFO entries), so
+# no sample data from one user's file is ever copied into another's.
+#
+# The .count.log has to cover the whole input as well. AnnTools' log is
+# kept as a template per reference version, each count that equals the
+# number of records annotated marked to be rewritten with the input's
+# record count. A log with any other count (e.g. per category) can't be
+# split among records, so for such an AnnTools the cache is bypassed and
+# every record goes to AnnTools.
+#
+##
+
+import os
+import json
+import time
+import zlib
+import sqlite3
+import hashlib
+from configparser import ConfigParser
+
+import shard
+
+# Get configuration
+config = ConfigParser()
+config.read('ann_config.ini')
+
+enabled = config.getboolean('variant_cache', 'enabled', fallback=False)
+db_path = config.get('variant_cache', 'path', fallback='./variant_cache.db')
+max_entries = config.getint('variant_cache', 'max_entries', fallback=5000000)
+reference_version = config.get('cache', 'reference_version', fallback='')
+
+# Keys are looked up in batches of this many records
+LOOKUP_BATCH = 500
+# Hits have last_used updated in transactions of this many keys, so the
+# write lock is never held for long
+TOUCH_BATCH = 20000
+# CHROM POS ID REF ALT QUAL FILTER INFO; shorter records aren't cached
+MIN_COLUMNS = 8
+
+_db = None
+_db_pid = None
+
+
+def get_db():
+    # One connection per process; pool workers are forked so never reuse
+    # a parent's connection
+    global _db, _db_pid
+    if _db is None or _db_pid != os.getpid():
+        _db = sqlite3.connect(db_path, timeout=60)
+        _db.execute('PRAGMA journal_mode=WAL')
+        _db.execute('PRAGMA synchronous=NORMAL')
+        _db.execute('CREATE TABLE IF NOT EXISTS variants ('
+                    'key BLOB PRIMARY KEY, value BLOB, last_used INTEGER) WITHOUT ROWID')
+        _db.execute('CREATE INDEX IF NOT EXISTS variants_last_used ON variants (last_used)')
+        _db.execute('CREATE TABLE IF NOT EXISTS headers ('
+                    'reference_version TEXT PRIMARY KEY, lines TEXT, log TEXT)')
+        columns = [c[1] for c in _db.execute('PRAGMA table_info(headers)')]
+        if 'log' not in columns:
+            _db.execute('ALTER TABLE headers ADD COLUMN log TEXT')
+        _db.execute('CREATE TABLE IF NOT EXISTS counters ('
+                    'name TEXT PRIMARY KEY, value INTEGER)')
+        _db.commit()
+        _db_pid = os.getpid()
+    return _db
+
+
+def variant_key(columns):
+    # chrom, pos, ref, alt plus the reference version, as a 16-byte digest
+    raw = '\t'.join([columns[0], columns[1], columns[3], columns[4], reference_version])
+    return hashlib.blake2b(raw.encode('utf-8'), digest_size=16).digest()
+
+
+def info_entries(info):
+    return [] if info in ('', '.') else info.split(';')
+
+
+def annotation_delta(input_columns, annotated_columns):
+    input_info = set(info_entries(input_columns[7]))
+    return {
+        'id': annotated_columns[2] if annotated_columns[2] != input_columns[2] else None,
+        'info': [e for e in info_entries(annotated_columns[7]) if e not in input_info]
+    }
+
+
+def apply_delta(columns, delta):
+    columns = list(columns)
+    if delta['id'] is not None:
+        columns[2] = delta['id']
+    info = info_entries(columns[7]) + delta['info']
+    columns[7] = ';'.join(info) if info else '.'
+    return columns
+
+
+def lookup(db, keys):
+    found = {}
+    for i in range(0, len(keys), LOOKUP_BATCH):
+        batch = keys[i:i + LOOKUP_BATCH]
+        rows = db.execute('SELECT key, value FROM variants WHERE key IN (%s)'
+                          % ','.join('?' * len(batch)), batch)
+        for key, value in rows:
+            found[key] = json.loads(zlib.decompress(value))
+    return found
+
+
+def touch(db, keys):
+    # A short transaction of its own; holding the write lock for a whole
+    # input's scan would make other jobs on this box wait out their timeout
+    if keys:
+        db.executemany('UPDATE variants SET last_used = ? WHERE key = ?',
+                       [(int(time.time()), key) for key in keys])
+        db.commit()
+
+
+def read_header(path):
+    header = []
+    with open(path) as f:
+        for line in f:
+            if not line.startswith('#'):
+                break
+            header.append(line)
+    return header
+
+
+def data_lines(f):
+    for line in f:
+        if line.startswith('#') or not line.strip():
+            continue
+        yield line.rstrip('\n').split('\t')
+
+
+"""Make a template of AnnTools' .count.log from a run over records records
+Counts equal to records are marked to be rewritten; any other count
+makes the template inexact, which it stays for this reference version.
+"""
+def log_template(log, records, previous):
+    exact = previous is None or previous['exact']
+    lines = []
+    for line in log.splitlines():
+        match = shard.COUNT_LINE.match(line)
+        if match and int(match.group(3)) == records:
+            lines.append([match.group(1) + match.group(2), True])
+        else:
+            exact = exact and match is None
+            lines.append([line, False])
+    return {'lines': lines, 'exact': exact}
+
+
+def render_log(template, records):
+    return ''.join((text + str(records) if counted else text) + '\n'
+                   for text, counted in template['lines'])
+
+
+def evict(db):
+    count = db.execute('SELECT COUNT(*) FROM variants').fetchone()[0]
+    if count > max_entries:
+        # Evict down to 90% so we don't evict on every job
+        excess = count - int(max_entries * 0.9)
+        db.execute('DELETE FROM variants WHERE key IN ('
+                   'SELECT key FROM variants ORDER BY last_used LIMIT ?)', (excess,))
+        print(f"Variant cache evicted {excess} least recently used entries")
+
+
+def add_counter(db, name, amount):
+    db.execute('INSERT INTO counters (name, value) VALUES (?, ?) '
+               'ON CONFLICT(name) DO UPDATE SET value = value + excluded.value',
+               (name, amount))
+
+
+"""Annotate input_file_path through the cache
+annotate_file(path) must write path's .annot.vcf and .count.log the way
+driver.run does. Produces the same two output files for the full input,
+records in their original order.
+"""
+def annotate(input_file_path, annotate_file):
+    db = get_db()
+    job_dir = os.path.dirname(input_file_path)
+    results_file = input_file_path.replace('.vcf', '.annot.vcf')
+    log_file = input_file_path + '.count.log'
+    misses_file = os.path.join(job_dir, 'variant_cache_misses.vcf')
+    plan_file = os.path.join(job_dir, 'variant_cache_plan.jsonl')
+
+    input_header = read_header(input_file_path)
+    row = db.execute('SELECT lines, log FROM headers WHERE reference_version = ?',
+                     (reference_version,)).fetchone()
+    cached_header = json.loads(row[0]) if row else None
+    template = json.loads(row[1]) if row and row[1] else None
+    # Without AnnTools' header lines and a log that can be rebuilt for
+    # this reference version a cached record can't be written out, so
+    # treat all as misses
+    usable = cached_header is not None and template is not None and template['exact']
+
+    # Pass 1: look records up in batches, write the misses to their own
+    # VCF and a plan line (cached delta or null) per record
+    total = hits = 0
+    with open(input_file_path) as f, open(misses_file, 'w') as misses, \
+            open(plan_file, 'w') as plan:
+        misses.writelines(input_header)
+        batch = []
+        touched = []
+
+        def flush(batch):
+            # Short records have no key and go to AnnTools as they are
+            keys = [variant_key(columns) if len(columns) >= MIN_COLUMNS else None
+                    for columns in batch]
+            found = lookup(db, [key for key in keys if key]) if usable else {}
+            touched.extend(found)
+            if len(touched) >= TOUCH_BATCH:
+                touch(db, touched)
+                del touched[:]
+            for key, columns in zip(keys, batch):
+                delta = found.get(key)
+                if delta is None:
+                    misses.write('\t'.join(columns) + '\n')
+                plan.write(json.dumps(delta) + '\n')
+            return sum(1 for key in keys if key in found)
+
+        for columns in data_lines(f):
+            total += 1
+            batch.append(columns)
+            if len(batch) >= LOOKUP_BATCH:
+                hits += flush(batch)
+                batch = []
+        hits += flush(batch)
+        touch(db, touched)
+
+    misses_count = total - hits
+    misses_log = ''
+    if misses_count or not usable:
+        annotate_file(misses_file)
+        misses_results = misses_file.replace('.vcf', '.annot.vcf')
+        output_header = read_header(misses_results)
+        with open(misses_file + '.count.log') as f:
+            misses_log = f.read()
+        # Remember the header lines AnnTools adds for this reference, and
+        # the shape of its log
+        added = [line for line in output_header if line not in input_header]
+        if misses_count:
+            template = log_template(misses_log, misses_count, template)
+        db.execute('INSERT OR REPLACE INTO headers (reference_version, lines, log) '
+                   'VALUES (?, ?, ?)',
+                   (reference_version, json.dumps(added), json.dumps(template)))
+        db.commit()
+    else:
+        misses_results = None
+        output_header = input_header[:-1] + cached_header + input_header[-1:]
+
+    # Pass 2: merge cached and freshly annotated records in input order,
+    # caching each fresh record's delta
+    new_entries = []
+    with open(input_file_path) as f, open(plan_file) as plan, \
+            open(misses_results or os.devnull) as misses, \
+            open(results_file, 'w') as out:
+        out.writelines(output_header)
+        annotated = data_lines(misses)
+        for columns, planned in zip(data_lines(f), plan):
+            delta = json.loads(planned)
+            if delta is None:
+                annotated_columns = next(annotated)
+                if annotated_columns[:2] != columns[:2] or annotated_columns[3:5] != columns[3:5]:
+                    raise ValueError(f"AnnTools output out of step with input at {':'.join(columns[:2])}")
+                if min(len(columns), len(annotated_columns)) >= MIN_COLUMNS:
+                    delta = annotation_delta(columns, annotated_columns)
+                    new_entries.append((variant_key(columns),
+                                        zlib.compress(json.dumps(delta).encode('utf-8')),
+                                        int(time.time())))
+                out.write('\t'.join(annotated_columns) + '\n')
+            else:
+                out.write('\t'.join(apply_delta(columns, delta)) + '\n')
+
+    db.executemany('INSERT OR REPLACE INTO variants (key, value, last_used) VALUES (?, ?, ?)',
+                   new_entries)
+    add_counter(db, 'hits', hits)
+    add_counter(db, 'misses', misses_count)
+    evict(db)
+    db.commit()
+
+    counters = dict(db.execute('SELECT name, value FROM counters'))
+    lifetime = counters.get('hits', 0) + counters.get('misses', 0)
+    hit_rate = 100.0 * hits / total if total else 0.0
+    lifetime_rate = 100.0 * counters.get('hits', 0) / lifetime if lifetime else 0.0
+    summary = (f"Variant cache: {total} records, {hits} hits, {misses_count} misses "
+               f"({hit_rate:.1f}% hit rate, {lifetime_rate:.1f}% lifetime)")
+    print(summary)
+    if not hits:
+        with open(log_file, 'w') as f:
+            f.write(misses_log)
+    elif template['exact']:
+        with open(log_file, 'w') as f:
+            f.write(render_log(template, total))
+    else:
+        # This run's misses showed AnnTools' log can't be rebuilt from the
+        # cache; annotate the whole input so both outputs are AnnTools' own
+        annotate_file(input_file_path)
+
+    for path in (misses_file, plan_file, misses_file + '.count.log', misses_results):
+        if path and os.path.exists(path):
+            os.remove(path)
+    return hits, misses_count
+
+### EOF
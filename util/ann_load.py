@@ -0,0 +1,379 @@
+# ann_load.py
+#
+# Annotator load testing script
+#
+# Stages synthetic VCF inputs in the inputs bucket (or a local S3
+# stand-in), then submits jobs the way the web app does: a PENDING item
+# in the annotations table and an SNS-wrapped request message. Jobs go
+# out at a steady or ramping rate, or in bursts, with a mix of input
+# sizes. Their status is polled until every job finishes, and the
+# report gives submit-to-RUNNING and submit-to-COMPLETED latency
+# percentiles and throughput as JSON, so runs of different releases can
+# be compared with --baseline.
+#
+# Run from the util directory (reads ann_load_config.ini):
+#   python ann_load.py --pattern steady --rate 2 --duration 300 \
+#     --sizes 1000:0.8,100000:0.2 --label v1.4 --report load_v1.4.json
+#   python ann_load.py --pattern burst --burst-size 50 --burst-interval 60 \
+#     --duration 300 --baseline load_v1.4.json
+#
+##
+
+import sys
+import time
+import json
+import uuid
+import math
+import random
+import argparse
+import threading
+import aws_clients
+from concurrent.futures import ThreadPoolExecutor
+
+# Get configuration
+from configparser import ConfigParser
+config = ConfigParser()
+config.read('ann_load_config.ini')
+
+cnet_id = config.get('info', 'cnet_id')
+s3_inputs_bucket = config.get('aws', 's3_inputs_bucket')
+topic_arn_requests = config.get('aws', 'topic_arn_requests', fallback='')
+queue_url_requests = config.get('aws', 'queue_url_requests', fallback='')
+dynamodb_table_name = config.get('aws', 'dynamodb_table_name')
+poll_interval = config.getfloat('load', 'poll_interval', fallback=0.5)
+submit_workers = config.getint('load', 'submit_workers', fallback=16)
+
+# AWS clients; endpoint URLs are only set to test against local stand-ins
+s3 = aws_clients.client('s3', config)
+sns = aws_clients.client('sns', config)
+sqs = aws_clients.client('sqs', config)
+dynamodb = aws_clients.resource('dynamodb', config)
+table = dynamodb.Table(dynamodb_table_name)
+
+FINAL_STATUSES = ['COMPLETED', 'FAILED']
+PERCENTILES = [50, 90, 95, 99]
+BASES = 'ACGT'
+
+
+# "1000:0.8,100000:0.2" -> [(1000, 0.8), (100000, 0.2)]: variant records
+# per input and the share of jobs with inputs that size
+def parse_sizes(text):
+    sizes = []
+    for part in text.split(','):
+        records, _, weight = part.partition(':')
+        sizes.append((int(records), float(weight or 1)))
+    return sizes
+
+
+"""Offsets (seconds from the start of the run) at which jobs are sent
+steady: rate jobs/s throughout; ramp: from 0 up to rate jobs/s;
+burst: burst_size jobs at once every burst_interval seconds, on top of
+rate jobs/s
+"""
+def job_offsets(args):
+    if args.pattern == 'ramp':
+        # Rate rate*t/duration sends its k-th job at sqrt(2*duration*k/rate)
+        count = int(args.rate * args.duration / 2)
+        return [math.sqrt(2 * args.duration * k / args.rate) for k in range(count)]
+    offsets = [k / args.rate for k in range(int(args.rate * args.duration))] if args.rate else []
+    if args.pattern == 'burst':
+        burst_starts = [i * args.burst_interval
+                        for i in range(int(math.ceil(args.duration / args.burst_interval)))]
+        offsets += [start for start in burst_starts for _ in range(args.burst_size)]
+    return sorted(offsets)
+
+
+def build_schedule(args, rng):
+    sizes = parse_sizes(args.sizes)
+    jobs = []
+    for offset in job_offsets(args):
+        records = rng.choices([s[0] for s in sizes], weights=[s[1] for s in sizes])[0]
+        jobs.append({
+            'job_id': str(uuid.uuid4()),
+            'user_id': f"ann-load-{rng.randrange(args.users)}",
+            'priority': 'premium' if rng.random() < args.premium_fraction else 'free',
+            'records': records,
+            'offset': offset
+        })
+    return jobs
+
+
+def synthetic_vcf(records, seed):
+    rng = random.Random(seed)
+    lines = ['##fileformat=VCFv4.1\n', '#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n']
+    pos = 0
+    for i in range(records):
+        pos += rng.randint(1, 2000)
+        ref, alt = rng.sample(BASES, 2)
+        lines.append(f"chr{1 + i * 22 // records}\t{pos}\trs{rng.randint(1, 10 ** 8)}\t"
+                     f"{ref}\t{alt}\t{rng.randint(10, 99)}\tPASS\tDP={rng.randint(1, 200)}\n")
+    return ''.join(lines).encode('utf-8')
+
+
+"""Upload a job's input under the key layout the web app uses
+Unless shared_inputs is set every job gets a distinct input (a header
+line naming the job), so the annotator's result cache can't serve it.
+"""
+def stage_input(job, bodies, shared_inputs):
+    job['input_file_name'] = f"load_{job['records']}.vcf"
+    job['s3_key_input_file'] = f"{cnet_id}/{job['user_id']}/{job['job_id']}~{job['input_file_name']}"
+    body = bodies[job['records']]
+    if not shared_inputs:
+        first_line_end = body.index(b'\n') + 1
+        body = (body[:first_line_end] + f"##ann_load_job={job['job_id']}\n".encode('utf-8') +
+                body[first_line_end:])
+    s3.put_object(Bucket=s3_inputs_bucket, Key=job['s3_key_input_file'], Body=body)
+    job['input_bytes'] = len(body)
+
+
+# Persist the job and publish its request exactly as the web app does
+def submit_job(job):
+    job_info = {
+        'job_id': job['job_id'],
+        'user_id': job['user_id'],
+        'input_file_name': job['input_file_name'],
+        's3_inputs_bucket': s3_inputs_bucket,
+        's3_key_input_file': job['s3_key_input_file'],
+        'submit_time': int(time.time()),
+        'job_status': 'PENDING',
+        'priority': job['priority']
+    }
+    job['submitted'] = time.time()
+    try:
+        table.put_item(Item=job_info)
+        if topic_arn_requests:
+            sns.publish(
+                TopicArn=topic_arn_requests,
+                Message=json.dumps({'default': json.dumps(job_info)}),
+                MessageStructure='json',
+                MessageAttributes={
+                    'priority': {'DataType': 'String', 'StringValue': job['priority']}
+                }
+            )
+        else:
+            # What an SNS subscription would deliver to the queue
+            sqs.send_message(
+                QueueUrl=queue_url_requests,
+                MessageBody=json.dumps({'Type': 'Notification', 'Message': json.dumps(job_info)})
+            )
+    except Exception as e:
+        print(f"Failed to submit job {job['job_id']}: {str(e)}")
+        job['submit_error'] = str(e)
+
+
+class StatusPoller(object):
+    """Polls the status of submitted jobs and notes when each was first
+    seen RUNNING and finished. Times are this script's clock, accurate to
+    poll_interval.
+    """
+    def __init__(self, jobs):
+        self.jobs = {job['job_id']: job for job in jobs}
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def pending(self):
+        return [job for job in self.jobs.values()
+                if 'submitted' in job and 'submit_error' not in job and 'finished' not in job]
+
+    def poll(self):
+        pending = self.pending()
+        for i in range(0, len(pending), 100):
+            keys = [{'job_id': job['job_id']} for job in pending[i:i + 100]]
+            try:
+                response = dynamodb.batch_get_item(RequestItems={
+                    dynamodb_table_name: {'Keys': keys, 'ProjectionExpression': 'job_id, job_status'}
+                })
+            except Exception as e:
+                print(f"Failed to poll job statuses: {str(e)}")
+                continue
+            # Unprocessed keys are simply asked for again next poll
+            now = time.time()
+            for item in response.get('Responses', {}).get(dynamodb_table_name, []):
+                job = self.jobs[item['job_id']]
+                status = item.get('job_status')
+                if status != 'PENDING' and 'running' not in job:
+                    # A job that finished between polls started no later
+                    job['running'] = now
+                if status in FINAL_STATUSES:
+                    job['status'] = status
+                    job['finished'] = now
+
+    def run(self):
+        while not self.stopped.is_set():
+            start = time.time()
+            self.poll()
+            self.stopped.wait(max(0, poll_interval - (time.time() - start)))
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        self.poll()
+
+
+def percentile(values, p):
+    # Nearest-rank percentile of a sorted list
+    return values[max(0, int(math.ceil(p / 100.0 * len(values))) - 1)]
+
+
+def summarize(values):
+    values = sorted(values)
+    if not values:
+        return {'count': 0}
+    summary = {'count': len(values), 'mean': round(sum(values) / len(values), 3)}
+    for p in PERCENTILES:
+        summary[f"p{p}"] = round(percentile(values, p), 3)
+    summary['max'] = round(values[-1], 3)
+    return summary
+
+
+def latencies(jobs, event, status=None):
+    return [job[event] - job['submitted'] for job in jobs
+            if event in job and (status is None or job.get('status') == status)]
+
+
+"""Completed jobs per minute: overall, from the first submission to the
+last completion, and sustained, between the 10th and 90th percentile
+completions so ramp-up and the final stragglers are left out
+"""
+def throughput(jobs):
+    submitted = [job['submitted'] for job in jobs if 'submitted' in job]
+    completed = sorted(job['finished'] for job in jobs if job.get('status') == 'COMPLETED')
+    if not completed:
+        return {'overall_per_minute': 0.0, 'sustained_per_minute': None}
+    span = completed[-1] - min(submitted)
+    result = {'overall_per_minute': round(60.0 * len(completed) / span, 3) if span > 0 else None,
+              'sustained_per_minute': None}
+    low, high = int(0.1 * len(completed)), int(math.ceil(0.9 * len(completed))) - 1
+    if high > low and completed[high] > completed[low]:
+        result['sustained_per_minute'] = round(60.0 * (high - low) / (completed[high] - completed[low]), 3)
+    return result
+
+
+def build_report(args, jobs, elapsed):
+    submitted = [job for job in jobs if 'submitted' in job and 'submit_error' not in job]
+    report = {
+        'label': args.label,
+        'args': vars(args),
+        'elapsed_seconds': round(elapsed, 3),
+        'jobs': {
+            'scheduled': len(jobs),
+            'submitted': len(submitted),
+            'submit_errors': len([job for job in jobs if 'submit_error' in job]),
+            'completed': len([job for job in submitted if job.get('status') == 'COMPLETED']),
+            'failed': len([job for job in submitted if job.get('status') == 'FAILED']),
+            'unfinished': len([job for job in submitted if 'finished' not in job])
+        },
+        'submit_to_running_seconds': summarize(latencies(submitted, 'running')),
+        'submit_to_completed_seconds': summarize(latencies(submitted, 'finished', 'COMPLETED')),
+        'throughput': throughput(submitted),
+        'by_priority': {},
+        'by_size': {}
+    }
+    for priority in sorted(set(job['priority'] for job in submitted)):
+        group = [job for job in submitted if job['priority'] == priority]
+        report['by_priority'][priority] = {
+            'submit_to_running_seconds': summarize(latencies(group, 'running')),
+            'submit_to_completed_seconds': summarize(latencies(group, 'finished', 'COMPLETED'))
+        }
+    for records in sorted(set(job['records'] for job in submitted)):
+        group = [job for job in submitted if job['records'] == records]
+        report['by_size'][str(records)] = {
+            'input_bytes': group[0]['input_bytes'],
+            'submit_to_completed_seconds': summarize(latencies(group, 'finished', 'COMPLETED'))
+        }
+    return report
+
+
+# Headline numbers of report next to those of an earlier one
+def compare(report, baseline):
+    rows = [('completed', ['jobs', 'completed']),
+            ('failed', ['jobs', 'failed'])]
+    for name in ['submit_to_running_seconds', 'submit_to_completed_seconds']:
+        rows += [(f"{name} p{p}", [name, f"p{p}"]) for p in PERCENTILES]
+    rows += [('throughput overall/min', ['throughput', 'overall_per_minute']),
+             ('throughput sustained/min', ['throughput', 'sustained_per_minute'])]
+
+    def lookup(data, path):
+        for key in path:
+            data = data.get(key) if isinstance(data, dict) else None
+        return data
+
+    print(f"{'':32} {baseline.get('label') or 'baseline':>12} {report.get('label') or 'this run':>12}")
+    for name, path in rows:
+        old, new = lookup(baseline, path), lookup(report, path)
+        change = ''
+        if isinstance(old, (int, float)) and isinstance(new, (int, float)) and old:
+            change = f"{100.0 * (new - old) / old:+.1f}%"
+        print(f"{name:32} {str(old):>12} {str(new):>12} {change:>8}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Annotator load generator')
+    parser.add_argument('--pattern', choices=['steady', 'ramp', 'burst'], default='steady')
+    parser.add_argument('--rate', type=float, default=1.0,
+                        help='jobs/s (peak rate for ramp, background rate for burst)')
+    parser.add_argument('--duration', type=float, default=60, help='seconds of submissions')
+    parser.add_argument('--burst-size', type=int, default=20)
+    parser.add_argument('--burst-interval', type=float, default=30)
+    parser.add_argument('--sizes', default='1000:1',
+                        help='records:weight mix of input sizes, e.g. 1000:0.8,100000:0.2')
+    parser.add_argument('--users', type=int, default=10)
+    parser.add_argument('--premium-fraction', type=float, default=0.0)
+    parser.add_argument('--shared-inputs', action='store_true',
+                        help='identical inputs per size, e.g. to exercise the result cache')
+    parser.add_argument('--timeout', type=float, default=600,
+                        help='seconds to wait for jobs after the last submission')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--label', default='', help='release or build the run measures')
+    parser.add_argument('--report', default='', help='write the JSON report here')
+    parser.add_argument('--baseline', default='', help='JSON report of an earlier run to compare')
+    args = parser.parse_args()
+    if args.pattern == 'ramp' and args.rate <= 0:
+        parser.error('--pattern ramp needs a positive --rate')
+
+    rng = random.Random(args.seed)
+    jobs = build_schedule(args, rng)
+    if not jobs:
+        parser.error('the schedule has no jobs')
+    print(f"Staging {len(jobs)} inputs in {s3_inputs_bucket}...")
+    bodies = {records: synthetic_vcf(records, args.seed) for records in set(job['records'] for job in jobs)}
+    with ThreadPoolExecutor(max_workers=submit_workers) as uploads:
+        list(uploads.map(lambda job: stage_input(job, bodies, args.shared_inputs), jobs))
+
+    print(f"Submitting {len(jobs)} jobs over {jobs[-1]['offset']:.1f}s ({args.pattern})...")
+    poller = StatusPoller(jobs)
+    poller.start()
+    start = time.time()
+    # Submissions run on a pool so a slow one doesn't hold up the schedule
+    with ThreadPoolExecutor(max_workers=submit_workers) as submissions:
+        for job in jobs:
+            delay = start + job['offset'] - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            submissions.submit(submit_job, job)
+
+    deadline = time.time() + args.timeout
+    while poller.pending() and time.time() < deadline:
+        print(f"{len(poller.pending())} jobs still running...")
+        time.sleep(min(10, max(0, deadline - time.time())))
+    poller.stop()
+
+    report = build_report(args, jobs, time.time() - start)
+    print(json.dumps(report, indent=2))
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"Report written to {args.report}")
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare(report, json.load(f))
+    return 0 if report['jobs']['unfinished'] == 0 else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
+
+### EOF
@@ -9,7 +9,6 @@ __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 
 import os
 import sys
-import boto3
 import json
 from botocore import exceptions
 
@@ -18,6 +17,7 @@ from botocore import exceptions
 # Import utility helpers
 sys.path.insert(1, os.path.realpath(os.path.pardir))
 from helpers import get_user_profile
+import aws_clients
 
 # Get configuration
 from configparser import ConfigParser
@@ -25,11 +25,11 @@ config = ConfigParser()
 config.read('archive_config.ini')
 
 # AWS clients
-sqs = boto3.client('sqs')
-s3 = boto3.client('s3')
-sns = boto3.client('sns')
-glacier = boto3.client('glacier')
-dynamodb = boto3.resource('dynamodb')
+sqs = aws_clients.client('sqs', config)
+s3 = aws_clients.client('s3', config)
+sns = aws_clients.client('sns', config)
+glacier = aws_clients.client('glacier', config)
+dynamodb = aws_clients.resource('dynamodb', config)
 
 s3_results_bucket = config.get('aws', 's3_results_bucket')
 queue_url_archive = config.get('aws', 'queue_url_archive')
@@ -0,0 +1,139 @@
+# aws_clients.py
+#
+# Shared boto3 clients for the annotator, the utilities and the web app
+#
+# Clients are created lazily, once per process, and shared by every
+# thread (boto3 clients are thread-safe; resources are not, so those are
+# kept per thread). All of them use adaptive retry, which adds
+# client-side rate limiting to the standard retry policy, and a
+# connection pool sized by the caller. Throttled attempts and retries
+# are counted per service for metrics.
+#
+##
+
+import os
+import threading
+import boto3
+from botocore.config import Config
+
+DEFAULT_MAX_POOL_CONNECTIONS = 10
+DEFAULT_MAX_ATTEMPTS = 10
+
+# Error codes AWS services answer with when a caller is being throttled
+THROTTLE_CODES = {
+  'Throttling', 'ThrottlingException', 'ThrottledException', 'RequestThrottledException',
+  'TooManyRequestsException', 'ProvisionedThroughputExceededException',
+  'TransactionInProgressException', 'RequestLimitExceeded', 'BandwidthLimitExceeded',
+  'LimitExceededException', 'RequestThrottled', 'SlowDown', 'PriorRequestNotComplete',
+  'EC2ThrottledException'
+}
+
+_lock = threading.Lock()
+_local = threading.local()
+_pid = None
+_session = None
+_clients = {}
+_counts = {}
+
+
+def _reset_after_fork():
+  # Connections must never be shared with a parent process, so a forked
+  # child (e.g. a pool worker) starts with no clients and zero counts
+  global _pid, _session
+  if _pid != os.getpid():
+    _pid = os.getpid()
+    _session = boto3.session.Session()
+    _clients.clear()
+    _counts.clear()
+
+
+def _count(service, kind, amount=1):
+  with _lock:
+    _counts[(service, kind)] = _counts.get((service, kind), 0) + amount
+
+
+def _instrument(service, events):
+  def count_throttle(response=None, **kwargs):
+    # Called after every attempt; the retry decision is botocore's own
+    if response is not None and \
+        response[1].get('Error', {}).get('Code') in THROTTLE_CODES:
+      _count(service, 'throttles')
+
+  def count_retries(parsed=None, **kwargs):
+    attempts = (parsed or {}).get('ResponseMetadata', {}).get('RetryAttempts', 0)
+    if attempts:
+      _count(service, 'retries', attempts)
+
+  events.register('needs-retry', count_throttle, unique_id=f"aws-clients-throttles-{service}")
+  events.register('after-call', count_retries, unique_id=f"aws-clients-retries-{service}")
+
+
+"""Connection pool size, retry attempts and endpoint for service
+Read from the [aws] section of settings (a ConfigParser) when given:
+max_pool_connections, max_attempts and endpoint_url_<service>. A pool
+size the caller computed from its own concurrency takes precedence.
+"""
+def _options(service, settings, endpoint_url, pool=None):
+  attempts = DEFAULT_MAX_ATTEMPTS
+  if settings is not None:
+    pool = pool or settings.getint('aws', 'max_pool_connections', fallback=0)
+    attempts = settings.getint('aws', 'max_attempts', fallback=attempts)
+    endpoint_url = endpoint_url or \
+      settings.get('aws', f"endpoint_url_{service}", fallback='') or None
+  return pool or DEFAULT_MAX_POOL_CONNECTIONS, attempts, endpoint_url
+
+
+def _botocore_config(pool, attempts, signature_version):
+  return Config(max_pool_connections=pool,
+    retries={'mode': 'adaptive', 'total_max_attempts': attempts},
+    signature_version=signature_version)
+
+
+"""Shared client for service, e.g. client('s3', config)
+Every caller in a process asking for the same service, region,
+endpoint and options gets the same client. Callers that share it
+between threads pass max_pool_connections for their concurrency.
+"""
+def client(service, settings=None, region_name=None, endpoint_url=None,
+  signature_version=None, max_pool_connections=None):
+  pool, attempts, endpoint_url = _options(service, settings, endpoint_url,
+    max_pool_connections)
+  key = (service, region_name, endpoint_url, pool, attempts, signature_version)
+  with _lock:
+    _reset_after_fork()
+    if key not in _clients:
+      # Session.client is not thread-safe, so creation stays under the lock
+      new_client = _session.client(service, region_name=region_name,
+        endpoint_url=endpoint_url,
+        config=_botocore_config(pool, attempts, signature_version))
+      _instrument(service, new_client.meta.events)
+      _clients[key] = new_client
+    return _clients[key]
+
+
+"""Shared resource for service, e.g. resource('dynamodb', config)
+Resources are not thread-safe, so each thread gets its own.
+"""
+def resource(service, settings=None, region_name=None, endpoint_url=None):
+  pool, attempts, endpoint_url = _options(service, settings, endpoint_url)
+  key = (service, region_name, endpoint_url, pool, attempts)
+  with _lock:
+    _reset_after_fork()
+    if getattr(_local, 'pid', None) != _pid:
+      _local.pid = _pid
+      _local.resources = {}
+    if key not in _local.resources:
+      new_resource = _session.resource(service, region_name=region_name,
+        endpoint_url=endpoint_url, config=_botocore_config(pool, attempts, None))
+      _instrument(service, new_resource.meta.client.meta.events)
+      _local.resources[key] = new_resource
+    return _local.resources[key]
+
+
+# {service: count} of throttled attempts or of retries in this process
+def counts(kind):
+  with _lock:
+    _reset_after_fork()
+    return {service: n for (service, k), n in _counts.items() if k == kind}
+
+### EOF
@@ -10,7 +10,7 @@ __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 
 import os
 import json
-import boto3
+import aws_clients
 from botocore.exceptions import ClientError
 
 # Get util configuration
@@ -23,12 +23,12 @@ config.read(os.path.join(os.path.abspath(os.path.dirname(__file__)), 'util_confi
 def send_email_ses(recipients=None, 
   sender=None, subject=None, body=None):
 
-  ses = boto3.client('ses', region_name=config['aws']['AwsRegionName'])
+  ses = aws_clients.client('ses', region_name=config['aws']['AwsRegionName'])
 
   try:
     response = ses.send_email(
       Destination = {
-        'ToAddresses': (recipients if type(recipients) == "list" else [recipients])
+        'ToAddresses': (recipients if isinstance(recipients, list) else [recipients])
       },
       Message={
         'Body': {'Text': {'Charset': "UTF-8", 'Data': body}},
@@ -36,7 +36,7 @@ def send_email_ses(recipients=None,
       },
       Source=(sender or config['gas']['EmailDefaultSender']))
   except ClientError as e:
-    raise ClientError
+    raise
 
   return response
 
@@ -48,7 +48,7 @@ import psycopg2.extras
 """
 def get_user_profile(id=None, db_name=None):
   # Get database connection details from AWS Secrets Manager
-  asm = boto3.client('secretsmanager', region_name=config['aws']['AwsRegionName'])
+  asm = aws_clients.client('secretsmanager', region_name=config['aws']['AwsRegionName'])
   try:
     asm_response = asm.get_secret_value(SecretId='rds/accounts_database')
     rds_secret = json.loads(asm_response['SecretString'])
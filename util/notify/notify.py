@@ -0,0 +1,224 @@
+# notify.py
+#
+# NOTE: This file lives on the Utils instance
+#
+# Emails users when their annotation jobs complete. Results messages are
+# received in batches; the completions of one user that arrive within
+# [notify] window_seconds of each other go out as a single email, and a
+# token bucket keeps the sends within the SES send rate. A message is
+# deleted only once its email was sent, so a failed send is retried when
+# the message is redelivered.
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import os
+import sys
+import json
+import math
+import time
+import datetime
+from botocore import exceptions
+
+# Reference: https://boto3.amazonaws.com/v1/documentation/api/latest/index.html
+
+# Import utility helpers
+sys.path.insert(1, os.path.realpath(os.path.pardir))
+from helpers import get_user_profile, send_email_ses
+import aws_clients
+
+# Get configuration
+from configparser import ConfigParser
+config = ConfigParser()
+config.read('notify_config.ini')
+
+queue_url_results = config.get('aws', 'queue_url_results')
+dynamodb_table_name = config.get('aws', 'dynamodb_table_name')
+region_name = config.get('aws', 'region_name')
+window_seconds = config.getfloat('notify', 'window_seconds', fallback=30)
+batch_size = min(config.getint('notify', 'batch_size', fallback=10), 10)
+visibility_timeout = config.getint('notify', 'visibility_timeout', fallback=300)
+send_rate = config.getfloat('notify', 'send_rate', fallback=1)
+burst = config.getint('notify', 'burst', fallback=5)
+annotation_url = config.get('notify', 'annotation_url')
+
+# AWS clients
+sqs = aws_clients.client('sqs', config, region_name=region_name)
+ses = aws_clients.client('ses', region_name=region_name)
+dynamodb = aws_clients.resource('dynamodb', config, region_name=region_name)
+
+
+class TokenBucket(object):
+    """Allows rate sends per second on average and up to capacity at once
+    """
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.time()
+
+    def refill(self):
+        now = time.time()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    # Block until a token is available and take it
+    def acquire(self):
+        self.refill()
+        while self.tokens < 1:
+            time.sleep((1 - self.tokens) / self.rate)
+            self.refill()
+        self.tokens -= 1
+
+
+"""Emails per second allowed by config and by the account's SES quota
+"""
+def allowed_send_rate():
+    try:
+        quota = ses.get_send_quota()
+        return min(send_rate, quota['MaxSendRate'])
+    except Exception as e:
+        print(f"Failed to read SES send quota, using {send_rate}/s: {str(e)}")
+        return send_rate
+
+
+"""Job items for a list of job IDs, read in batches of up to 100
+"""
+def get_jobs(job_ids):
+    jobs = {}
+    job_ids = list(dict.fromkeys(job_ids))
+    for i in range(0, len(job_ids), 100):
+        keys = [{'job_id': job_id} for job_id in job_ids[i:i + 100]]
+        while keys:
+            response = dynamodb.batch_get_item(RequestItems={
+                dynamodb_table_name: {'Keys': keys}
+            })
+            for item in response['Responses'].get(dynamodb_table_name, []):
+                jobs[item['job_id']] = item
+            keys = response.get('UnprocessedKeys', {}).get(dynamodb_table_name, {}).get('Keys', [])
+    return jobs
+
+
+def delete_messages(receipts):
+    receipts = list(receipts)
+    for i in range(0, len(receipts), 10):
+        try:
+            response = sqs.delete_message_batch(
+                QueueUrl=queue_url_results,
+                Entries=[{'Id': str(n), 'ReceiptHandle': receipt}
+                         for n, receipt in enumerate(receipts[i:i + 10])]
+            )
+            for failed in response.get('Failed', []):
+                print(f"Failed to delete a message from the queue: {failed.get('Message')}")
+        except Exception as e:
+            print(f"Failed to delete messages from the queue: {str(e)}")
+
+
+def email_body(jobs):
+    lines = ["The following annotation jobs have completed:", ""]
+    for job in jobs:
+        complete = datetime.datetime.fromtimestamp(int(job.get('complete_time', 0)))
+        lines.append(f"{job.get('input_file_name', job['job_id'])} "
+                     f"(completed {complete.strftime('%Y-%m-%d %H:%M:%S')})")
+        lines.append(f"  {annotation_url}{job['job_id']}")
+    lines.append("")
+    return '\n'.join(lines)
+
+
+"""Send one user's email for a group of completed jobs
+Returns True if it was sent or there was nobody to send it to.
+"""
+def notify_user(user_id, job_ids, send_tokens):
+    jobs = list(get_jobs(job_ids).values())
+    if not jobs:
+        print(f"No items found in DynamoDB for jobs {', '.join(job_ids)}")
+        return True
+    profile = get_user_profile(id=user_id)
+    if not profile or not profile['email']:
+        print(f"No email address for user {user_id}")
+        return True
+
+    if len(jobs) == 1:
+        subject = f"Results available for job {jobs[0]['job_id']}"
+    else:
+        subject = f"Results available for {len(jobs)} annotation jobs"
+    send_tokens.acquire()
+    try:
+        send_email_ses(recipients=profile['email'], subject=subject, body=email_body(jobs))
+    except Exception as e:
+        print(f"Failed to email user {user_id}: {str(e)}")
+        return False
+    print(f"Emailed user {user_id} about {len(jobs)} job(s)")
+    return True
+
+
+# (user_id, job_id) of a results message, or None for other messages
+def parse(message):
+    # Results messages come through SNS: the job is in the envelope's
+    # Message
+    body = json.loads(json.loads(message['Body'])['Message'])
+    if body.get('message_type') != 'result_message':
+        return None
+    return body['user_id'], body['job_id']
+
+
+def main():
+    send_tokens = TokenBucket(allowed_send_rate(), burst)
+    # user_id: {'deadline': ..., 'jobs': {job_id: None},
+    #           'receipts': {message ID: receipt handle}}
+    pending = {}
+    while True:
+        # Wake up in time for the earliest group that is due
+        wait = 20
+        if pending:
+            earliest = min(group['deadline'] for group in pending.values())
+            wait = max(0, min(20, math.ceil(earliest - time.time())))
+        try:
+            response = sqs.receive_message(
+                QueueUrl=queue_url_results,
+                MaxNumberOfMessages=batch_size,
+                VisibilityTimeout=visibility_timeout,
+                WaitTimeSeconds=wait
+            )
+        except exceptions.ClientError as e:
+            print(f"Failed to receive messages: {str(e)}")
+            time.sleep(5)
+            continue
+
+        for message in response.get('Messages', []):
+            try:
+                completion = parse(message)
+            except (ValueError, KeyError, TypeError) as e:
+                print(f"Dropping malformed message {message['MessageId']}: {str(e)}")
+                delete_messages([message['ReceiptHandle']])
+                continue
+            if completion is None:
+                delete_messages([message['ReceiptHandle']])
+                continue
+            user_id, job_id = completion
+            group = pending.setdefault(user_id, {
+                'deadline': time.time() + window_seconds, 'jobs': {}, 'receipts': {}})
+            # Duplicate messages for a job are all deleted after one email;
+            # a redelivered message replaces its earlier receipt handle
+            group['jobs'][job_id] = None
+            group['receipts'][message['MessageId']] = message['ReceiptHandle']
+
+        now = time.time()
+        for user_id in [u for u, group in pending.items() if group['deadline'] <= now]:
+            group = pending.pop(user_id)
+            try:
+                sent = notify_user(user_id, list(group['jobs']), send_tokens)
+            except Exception as e:
+                print(f"Failed to notify user {user_id}: {str(e)}")
+                sent = False
+            # Unsent messages become visible again and are retried
+            if sent:
+                delete_messages(group['receipts'].values())
+
+if __name__ == "__main__":
+    main()
+
+
+### EOF
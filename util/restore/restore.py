@@ -19,16 +19,17 @@ from configparser import ConfigParser
 # Import utility helpers
 sys.path.insert(1, os.path.realpath(os.path.pardir))
 import helpers
+import aws_clients
 
 # Get configuration
 config = ConfigParser()
 config.read('restore_config.ini')
 
 # AWS clients
-sqs = boto3.client('sqs')
-sns = boto3.client('sns')
-glacier = boto3.client('glacier')
-dynamodb = boto3.resource('dynamodb')
+sqs = aws_clients.client('sqs', config)
+sns = aws_clients.client('sns', config)
+glacier = aws_clients.client('glacier', config)
+dynamodb = aws_clients.resource('dynamodb', config)
 
 # Configuration parameters
 s3_results_bucket = config.get('aws', 's3_results_bucket')
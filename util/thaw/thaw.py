@@ -11,7 +11,6 @@ __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 
 import os
 import sys
-import boto3
 import re
 import json
 import time
@@ -22,17 +21,18 @@ import shutil
 # Import utility helpers
 sys.path.insert(1, os.path.realpath(os.path.pardir))
 import helpers
+import aws_clients
 
 # Get configuration
 config = ConfigParser()
 config.read('thaw_config.ini')
 
 # AWS clients
-sqs = boto3.client('sqs')
-s3 = boto3.client('s3')
-sns = boto3.client('sns')
-glacier = boto3.client('glacier')
-dynamodb = boto3.resource('dynamodb')
+sqs = aws_clients.client('sqs', config)
+s3 = aws_clients.client('s3', config)
+sns = aws_clients.client('sns', config)
+glacier = aws_clients.client('glacier', config)
+dynamodb = aws_clients.resource('dynamodb', config)
 
 # Configuration parameters
 cnet_id = config.get('info', 'cnet_id')
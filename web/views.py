@@ -8,23 +8,28 @@
 ##
 __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 
+import os
+import sys
 import uuid
 import time
 import json
 import datetime
-import boto3
 from boto3.dynamodb.conditions import Key
-from botocore.client import Config
+from boto3.dynamodb.types import TypeDeserializer
 from decimal import Decimal
 from botocore.exceptions import ClientError
 
 from flask import (abort, flash, redirect, render_template,
-  request, session, url_for, Flask, jsonify)
+  request, session, url_for, Flask, jsonify, Response, stream_with_context)
 
 from gas import app, db
 from decorators import authenticated, is_premium
 from auth import get_profile, update_profile
 
+# Shared AWS clients (util/aws_clients.py), created once per process
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.path.pardir, 'util'))
+import aws_clients
+
 
 # Reference: https://boto3.amazonaws.com/v1/documentation/api/latest/index.html
 
@@ -40,9 +45,9 @@ but you can replace the code below with your own if you prefer.
 @authenticated
 def annotate():
   # Create a session client to the S3 service
-  s3 = boto3.client('s3',
+  s3 = aws_clients.client('s3',
     region_name=app.config['AWS_REGION_NAME'],
-    config=Config(signature_version='s3v4'))
+    signature_version='s3v4')
 
   bucket_name = app.config['AWS_S3_INPUTS_BUCKET']
   user_id = session['primary_identity']
@@ -105,7 +110,7 @@ def create_annotation_job_request():
 
   # Persist job to database
   # Move your code here...
-  dynamodb = boto3.resource('dynamodb')
+  dynamodb = aws_clients.resource('dynamodb', region_name=app.config['AWS_REGION_NAME'])
   table = dynamodb.Table('qixshawnchen_annotations')
   job_info = {
     'job_id': job_id,
@@ -114,21 +119,27 @@ def create_annotation_job_request():
     "s3_inputs_bucket": bucket_name,
     "s3_key_input_file": s3_key,
     "submit_time": int(time.time()),
-    "job_status": "PENDING"
+    "job_status": "PENDING",
+    # Premium jobs are scheduled ahead of free ones by the annotator
+    "priority": "premium" if session.get('role') == "premium_user" else "free"
   }
   table.put_item(Item=job_info)
   
 
   # Send message to request queue
   # Move your code here...
-  sns = boto3.client('sns', region_name=app.config['AWS_REGION_NAME'])
+  sns = aws_clients.client('sns', region_name=app.config['AWS_REGION_NAME'])
   # 'arn:aws:sns:us-east-1:659248683008:qixshawnchen_job_requests'
   topic_arn_requests = app.config['AWS_SNS_JOB_REQUEST_TOPIC']
   
   sns.publish(
     TopicArn=topic_arn_requests,
     Message=json.dumps({'default': json.dumps(job_info)}),
-    MessageStructure='json'
+    MessageStructure='json',
+    # Lets a subscription filter policy route premium jobs to their own queue
+    MessageAttributes={
+      'priority': {'DataType': 'String', 'StringValue': job_info['priority']}
+    }
   )
   print("message to annotator.py sent seuccessfully")
 
@@ -144,7 +155,7 @@ def annotations_list():
   user_id = session["primary_identity"]
   
   # Initialize DynamoDB resource
-  dynamodb = boto3.resource('dynamodb')
+  dynamodb = aws_clients.resource('dynamodb', region_name=app.config['AWS_REGION_NAME'])
   table = dynamodb.Table('qixshawnchen_annotations')
   try:
     # Query the table for annotations by the user
@@ -176,23 +187,49 @@ def annotations_list():
   return render_template('annotations.html', annotations=annotations)
 
 
+"""Results summary the annotator stored on a job item, ready to display
+item is in the low-level client's format; returns None if the job has
+no summary, e.g. one completed from the result cache.
+"""
+def result_summary(item):
+  if 'result_summary' not in item:
+    return None
+  stored = TypeDeserializer().deserialize(item['result_summary'])
+  by_count = lambda counts: sorted(((name, int(n)) for name, n in counts.items()),
+    key=lambda entry: -entry[1])
+  frequencies = {}
+  for key, histogram in stored.get('allele_frequency', {}).items():
+    edges = histogram['bin_edges']
+    frequencies[key] = {
+      'bins': [(f"{edges[i]}-{edges[i + 1]}", int(n)) for i, n in enumerate(histogram['counts'])],
+      'missing': int(histogram['missing'])
+    }
+  return {
+    'variants': int(stored['variants']),
+    'by_chromosome': by_count(stored.get('by_chromosome', {})),
+    'by_type': by_count(stored.get('by_type', {})),
+    'by_consequence': by_count(stored.get('by_consequence', {})),
+    'allele_frequency': frequencies
+  }
+
+
 # Need a logic to manage the membership
 """Display details of a specific annotation job
 """
 @app.route('/annotations/<id>', methods=['GET'])
 @authenticated
 def annotation_details(id):
-  s3 = boto3.client('s3')
+  s3 = aws_clients.client('s3', region_name=app.config['AWS_REGION_NAME'])
   user_id = session["primary_identity"]  # Get the currently authenticated user's ID
   if not user_id:
     abort(403)  # User is not authenticated
 
   # Initialize DynamoDB resource
-  dynamodb = boto3.resource('dynamodb')
+  dynamodb = aws_clients.resource('dynamodb', region_name=app.config['AWS_REGION_NAME'])
   table = dynamodb.Table(app.config['AWS_DYNAMODB_ANNOTATIONS_TABLE'])
   
   # Initialize DynamoDB client
-  dynamodb_client = boto3.client('dynamodb')
+  dynamodb_client = aws_clients.client('dynamodb', region_name=app.config['AWS_REGION_NAME'])
   
   try:  # Get DynamoDB Record
     response = dynamodb_client.get_item(
@@ -238,6 +275,13 @@ def annotation_details(id):
     abort(500)
   annotation['input_file_url'] = response_input
 
+  # Long-running jobs upload the records annotated so far
+  if annotation['job_status'] == 'RUNNING':
+    if 'progress_percent' in item:
+      annotation['progress_percent'] = int(item['progress_percent']['N'])
+    if int(item.get('partial_parts', {}).get('N', 0)) > 0:
+      annotation['partial_records'] = int(item['partial_records']['N'])
+      annotation['partial_file_url'] = url_for('annotation_partial', id=annotation['job_id'])
 
   if annotation['job_status'] == 'COMPLETED' or annotation['job_status'] == 'RESTORED' or annotation['job_status'] == 'RESTORING' or annotation['job_status'] == 'ARCHIVED': 
     submit_time_stamp_complete = int(item['complete_time']['N'])
@@ -255,7 +299,7 @@ def annotation_details(id):
       annotation['restore_message'] = "The file is currently being unarchived and should be available within several hours for Premium members. Please check back later. Note that if you cancel your membership, any files not yet archived will need to be archived again."
     else:  
       try:  # Download results file to user
-        dynamodb_client = boto3.client('dynamodb')
+        dynamodb_client = aws_clients.client('dynamodb', region_name=app.config['AWS_REGION_NAME'])
         new_path1 = item['s3_key_log_file']['S']
         new_path = new_path1.replace('test.vcf.count.log', 'restored_test.annot.vcf')
         print(new_path)
@@ -273,9 +317,59 @@ def annotation_details(id):
         abort(500)
       annotation['result_file_url'] = response
   #annotation['result_file_url'] = item['s3_key_log_file']['S']
+  summary = result_summary(item)
   
-  return render_template('annotation_details.html', annotation=annotation, free_access_expired=free_access_expired)
+  return render_template('annotation_details.html', annotation=annotation, free_access_expired=free_access_expired, summary=summary)
+
+
+
+"""Download the results a running job has uploaded so far
+The annotator uploads them in ordered parts (see ann/progress.py); they
+are streamed back to back as one VCF. The parts are deleted once the
+job completes, so a missing part means the job has completed: before
+the download starts, the user is sent to its details page; during it,
+the download ends at the last part, which ends on a record boundary.
+"""
+@app.route('/annotations/<id>/partial', methods=['GET'])
+@authenticated
+def annotation_partial(id):
+  dynamodb = aws_clients.resource('dynamodb', region_name=app.config['AWS_REGION_NAME'])
+  table = dynamodb.Table(app.config['AWS_DYNAMODB_ANNOTATIONS_TABLE'])
+  s3_client = aws_clients.client('s3', region_name=app.config['AWS_REGION_NAME'])
+
+  annotation = table.get_item(Key={'job_id': id}).get('Item', None)
+  if not annotation or annotation['user_id'] != session['primary_identity']:
+    abort(403, description="Not authorized to view this job")
+  if annotation['job_status'] != 'RUNNING' or not annotation.get('partial_parts'):
+    abort(404, description="No partial results available")
+
+  prefix = annotation['s3_key_partial_prefix']
+  keys = [f"{prefix}part_{number:05d}.annot.vcf"
+    for number in range(1, int(annotation['partial_parts']) + 1)]
+
+  def get_part(key):
+    try:
+      return s3_client.get_object(Bucket=app.config['AWS_S3_RESULTS_BUCKET'], Key=key)['Body']
+    except ClientError as e:
+      if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+        return None
+      raise
+
+  first = get_part(keys[0])
+  if first is None:
+    return redirect(url_for('annotation_details', id=id))
+
+  def parts():
+    for number, key in enumerate(keys):
+      body = first if number == 0 else get_part(key)
+      if body is None:
+        return
+      for chunk in body.iter_chunks(1024 * 1024):
+        yield chunk
 
+  file_name = annotation['input_file_name'].split('.')[0] + '.partial.annot.vcf'
+  return Response(stream_with_context(parts()), mimetype='text/plain',
+    headers={'Content-Disposition': f"attachment; filename={file_name}"})
 
 
 """Display the log file contents for an annotation jobpa
@@ -286,11 +380,11 @@ def annotation_log(id):
   # Get the currently authenticated user's ID
   user_id = session["primary_identity"]
   # Initialize DynamoDB client
-  dynamodb = boto3.resource('dynamodb')
+  dynamodb = aws_clients.resource('dynamodb', region_name=app.config['AWS_REGION_NAME'])
   table = dynamodb.Table('qixshawnchen_annotations')
 
   # Initialize S3 client
-  s3_client = boto3.client('s3')
+  s3_client = aws_clients.client('s3', region_name=app.config['AWS_REGION_NAME'])
   try:
     # Retrieve annotation job details from DynamoDB
     response = table.get_item(Key={'job_id': id})
@@ -346,7 +440,7 @@ def subscribe():
     user_id = session['primary_identity']
     glacier_vault = app.config['AWS_GLACIER_VAULT']
     topic_arn_restore = app.config['AWS_SNS_JOB_RESTORE_TOPIC']
-    sns = boto3.client('sns', region_name=app.config['AWS_REGION_NAME'])
+    sns = aws_clients.client('sns', region_name=app.config['AWS_REGION_NAME'])
 
     
     message_restore = {'message_type': 'restore_message',